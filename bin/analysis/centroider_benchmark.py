@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Compares centroiding backends (see modules/camera/centroiders.py) by time per frame
+and centroid error, over the same set of frames.
+
+By default, frames are rendered by the simulated camera (modules/camera/sim), with
+spots at random known positions. Alternately, argue archived FITS images with -i (and
+their bias image with -bias), in which case errors are relative to the reference
+'gaussian' backend's centroids.
+'''
+import os
+import sys
+import argparse
+import numpy as np
+from astropy.io import fits
+this_file_dir = os.path.realpath(os.path.dirname(__file__))
+os.chdir(this_file_dir)
+sys.path.append('../../modules')
+sys.path.append('../../modules/camera')
+sys.path.append('../../modules/camera/sim')
+import globals as gl
+import centroiders
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('-n', '--num_dots', type=int, default=100, help='number of dots in each frame')
+parser.add_argument('-f', '--num_frames', type=int, default=5, help='number of simulated frames')
+parser.add_argument('-b', '--fitbox', type=int, default=4, help='window size for centroiding in pixels')
+parser.add_argument('-cen', '--centroiders', type=str, nargs='+', default=list(centroiders.registry), help='backends to compare')
+parser.add_argument('-g', '--guesses', action='store_true', help='centroid near the known (or reference) positions, rather than full-frame detection')
+parser.add_argument('-i', '--images', type=str, nargs='+', default=[], help='archived FITS images to use instead of simulated frames')
+parser.add_argument('-bias', '--bias', type=str, default=None, help='FITS bias image to subtract from archived images')
+parser.add_argument('-s', '--seed', type=int, default=0, help='random seed for simulated frames')
+inputs = parser.parse_args()
+
+if __name__ == '__main__':
+    if inputs.images:
+        bias = fits.getdata(inputs.bias).astype(np.int32) if inputs.bias else 0
+        frames = [fits.getdata(path).astype(np.int32) - bias for path in inputs.images]
+        truths = None
+        print(f'Benchmarking {len(frames)} archived images, relative to the reference gaussian centroids')
+    else:
+        import sim_grab_cen
+        sim = sim_grab_cen.Sim_Grab_Cen(size_fitbox=inputs.fitbox, seed=inputs.seed)
+        frames, truths = [], []
+        for i in range(inputs.num_frames):
+            sim.place_random_spots(inputs.num_dots)
+            frames.append(sim.render(sim.spots_px).astype(np.int32) - sim.bias)
+            truths.append(np.array(sim.spots_px))
+        print(f'Benchmarking {len(frames)} simulated frames of {inputs.num_dots} dots')
+    centroiders.benchmark(frames, inputs.num_dots, truths, names=inputs.centroiders, guesses=inputs.guesses,
+                          size_fitbox=inputs.fitbox, write_fits=False, save_dir=gl.dirs['temp'])
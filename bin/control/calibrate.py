@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Runs datum initialization or a datum / motor calibration on all connected positioners
+(or a listed subset), several at a time, and saves a table of the results to the data
+directory.
+'''
+import os
+import sys
+import argparse
+this_file_dir = os.path.realpath(os.path.dirname(__file__))
+os.chdir(this_file_dir)
+sys.path.append('../../modules')
+sys.path.append('../../modules/motors')
+import globals as gl
+from fleet_calibration import FleetCalibration, procedures
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('procedure', type=str, choices=list(procedures), help='procedure to run')
+parser.add_argument('-p', '--pos_ids', type=int, nargs='*', default=None, help='positioner ids to run on (default all available)')
+parser.add_argument('-c', '--max_concurrent', type=int, default=10, help='max number of positioners running the procedure at once')
+parser.add_argument('-t', '--timeout', type=float, default=300.0, help='max duration in sec of the procedure on any one positioner')
+parser.add_argument('-d', '--daemon', action='store_true', help='send commands through a running tendo_daemon rather than opening the CAN bus directly')
+inputs = parser.parse_args()
+
+if __name__ == '__main__':
+    import simple_logger
+    path_prefix = os.path.join(gl.dirs['temp'], f'calibrate_{gl.timestamp()}')
+    logger, _, _ = simple_logger.start_logger(f'{path_prefix}.log')
+    logger.info(f'Inputs: {inputs}')
+    if inputs.daemon:
+        from tendo_daemon import RemotePositioners
+        pos = RemotePositioners()
+    else:
+        from tendo import Positioners
+        pos = Positioners()
+        pos.connect()
+    fc = FleetCalibration(pos, max_concurrent=inputs.max_concurrent, timeout=inputs.timeout, printfunc=logger.info)
+    table = fc.run(inputs.procedure, inputs.pos_ids)
+    logger.info(f'Results:\n{table}')
+    fc.save(table, name=inputs.procedure.replace('_', ' '))
@@ -7,13 +7,13 @@ for programmatic control.)
 import os
 import sys
 import argparse
-import time
 import math 
 this_file_dir = os.path.realpath(os.path.dirname(__file__))
 os.chdir(this_file_dir)
 sys.path.append('../../modules')
 sys.path.append('../../modules/camera')
 import globals as gl
+import clock
 import fvchandler
 
 # Measurement default parameters
@@ -27,9 +27,10 @@ parser.add_argument('-r', '--num_repeats', type=int, default=1, help=f'number of
 parser.add_argument('-p', '--plot', action='store_true', help='plot measured centroids')
 parser.add_argument('-e', '--exptime', type=float, default=defaults['exptime'], help='camera exposure time in seconds')
 parser.add_argument('-b', '--fitbox', type=int, default=defaults['fitbox'], help='window size for centroiding in pixels')
-parser.add_argument('-d', '--take_darks', action='store_true', help='take dark images (shutter closed). typically not needed, since we keep the test stand in a dark enough enclosure')
+parser.add_argument('-cen', '--centroider', type=str, default='gaussian', help='centroiding backend for image cameras, see modules/camera/centroiders.py')
+parser.add_argument('-d', '--take_darks', action='store_true', help='subtract master dark images (shutter closed), taken once per exposure time and CCD temperature. typically not needed, since we keep the test stand in a dark enough enclosure')
 parser.add_argument('-im', '--save_images', action='store_true', help='save image files to disk')
-parser.add_argument('-bs', '--save_biases', action='store_true', help='save bias image files to disk')
+parser.add_argument('-bs', '--save_biases', action='store_true', help='keep master bias and dark images in files on disk, for reuse by later runs. Otherwise every new run takes 9 bias exposures on its first image (an existing SBIG_bias_image.FITS is not used)')
 parser.add_argument('-se', '--sim_errmax', type=float, default=defaults['sim_errmax'], help='measurement error max for simulator')
 parser.add_argument('-sb', '--sim_badmatchfreq', type=float, default=defaults['sim_badmatchfreq'], help='how often the simulator returns [0,0], indicating a bad match')
 inputs = parser.parse_args()
@@ -52,16 +53,19 @@ if __name__ == '__main__':
                               take_darks=inputs.take_darks,
                               save_images=inputs.save_images,
                               save_biases=inputs.save_biases,
+                              centroider=inputs.centroider,
                               printfunc=logger.info,
                              ) 
     f.min_energy = -math.inf  # suppress checks on dot quality here, since standalone mode often for setup
     xy = []
     peaks = []
-    start_time = time.time()
-    for i in range(inputs.num_repeats):
+    start_time = clock.time()
+    stream = f.measure_stream(inputs.num_dots, inputs.num_repeats)  # next image is taken while this one is centroided
+    for these_xy, these_peaks, these_fwhms, imgfiles, meta in stream:
+        i = meta['frame']
         meas_name = f'measurement {i+1} of {inputs.num_repeats}'
-        logger.info(f'Beginning {meas_name}')
-        these_xy, these_peaks, these_fwhms, imgfiles = f.measure(inputs.num_dots)
+        logger.info(f'Completed {meas_name}: acquired in {meta["acquire_end"] - meta["acquire_start"]:.2f} sec, '
+                    f'centroided {meta["centroid_end"] - meta["acquire_end"]:.2f} sec after')
         if imgfiles:
             logger.info(f'Images for {meas_name} stored at {imgfiles}')
         xy.extend(these_xy)
@@ -99,6 +103,6 @@ if __name__ == '__main__':
         plt.savefig(plot_path)
         plt.close(fig)
         logger.info(f'Plot saved to {plot_path}')
-    total_time = time.time() - start_time
+    total_time = clock.time() - start_time
     logger.info(f'Run completed in {total_time:.1f} sec ({total_time/inputs.num_repeats}) per image)')
 
@@ -6,13 +6,13 @@ Created on Tue Sep 21 15:28:27 2021
 @author: ldrd
 """
 
-import time
 import os, sys
 this_file_dir = os.path.realpath(os.path.dirname(__file__))
 os.chdir(this_file_dir)
 sys.path.append('../../modules')
 sys.path.append('../../modules/motors')
 import globals as gl
+import clock
 from tendo import Positioners
 
 # connect to positioners
@@ -34,8 +34,8 @@ approx_gear_ratio = round(gear_ratio)  # as of 2021-10-13, firmware only support
 for p in pos.available_positioners():
     pos[p].set_alpha_reduction_ratio(approx_gear_ratio)
     pos[p].set_beta_reduction_ratio(approx_gear_ratio)
-print(f'Pausing {gl.reboot_delay} sec for reboot.'}
-time.sleep(gl.reboot_delay)
+print(f'Pausing {gl.reboot_delay} sec for reboot.')
+clock.sleep(gl.reboot_delay)
 
 # notes per Ricardo 2021-10-05
 # - upon reboot, LEDs blink
@@ -44,3 +44,85 @@ def fitgaussian(data):
 	errorfunction = lambda p: ravel(gaussian(*p)(*indices(data.shape)) -data)
 	p, success = optimize.leastsq(errorfunction, params)
 	return p
+
+def moments_batch(stack):
+	"""Returns array (N, 6) of initial (bias, height, x, y, width_x, width_y) for a stack of
+	N boxes, of shape (N, h, w), from their moments. Like moments(), with x along the rows
+	and y along the columns. Only pixels above 10% of the peak (over the median) are
+	counted, so that background noise does not bias the widths."""
+	stack = np.asarray(stack, dtype=float)
+	n, h, w = stack.shape
+	bias = np.median(stack.reshape(n, -1), axis=1)
+	data = stack - bias[:, None, None]
+	data[data < 0.1*data.max(axis=(1, 2))[:, None, None]] = 0
+	total = data.sum(axis=(1, 2))
+	total = np.where(total > 0, total, 1.)
+	X, Y = np.indices((h, w))
+	x = (X*data).sum(axis=(1, 2))/total
+	y = (Y*data).sum(axis=(1, 2))/total
+	width_x = np.sqrt(((X - x[:, None, None])**2*data).sum(axis=(1, 2))/total)
+	width_y = np.sqrt(((Y - y[:, None, None])**2*data).sum(axis=(1, 2))/total)
+	height = data.max(axis=(1, 2))
+	return np.column_stack([bias, height, x, y, np.maximum(width_x, 0.5), np.maximum(width_y, 0.5)])
+
+def _model_and_jacobian(p, X, Y):
+	"""Gaussian model (N, M) and its analytic Jacobian (N, M, 6) at params p (N, 6),
+	for pixel coordinates X, Y of shape (M,)."""
+	bias, height, cx, cy, wx, wy = [p[:, k, None] for k in range(6)]
+	u = (X - cx)/wx
+	v = (Y - cy)/wy
+	g = np.exp(-(u**2 + v**2)/2)
+	hg = height*g
+	model = bias + hg
+	jac = np.stack([np.ones_like(g), g, hg*u/wx, hg*v/wy, hg*u**2/wx, hg*v**2/wy], axis=-1)
+	return model, jac
+
+def fitgaussians(stack, max_iter=100, tol=1e-8):
+	"""Fits the same gaussian model as fitgaussian() to a stack of N equal-size boxes,
+	array of shape (N, h, w), all at once, by vectorized Levenberg-Marquardt with analytic
+	Jacobians.
+
+	Returns (params, converged), where params is array (N, 6) of (bias, height, x, y,
+	width_x, width_y) as from fitgaussian(), and converged is boolean array (N,)."""
+	stack = np.asarray(stack, dtype=float)
+	n, h, w = stack.shape
+	X, Y = [a.ravel().astype(float) for a in np.indices((h, w))]
+	data = stack.reshape(n, -1)
+	p = moments_batch(stack)
+	model, jac = _model_and_jacobian(p, X, Y)
+	resid = model - data
+	cost = (resid**2).sum(axis=1)
+	lam = np.full(n, 1e-3)
+	active = np.ones(n, dtype=bool)
+	converged = np.zeros(n, dtype=bool)
+	eye = np.eye(6)
+	for i in range(max_iter):
+		if not active.any():
+			break
+		idx = np.flatnonzero(active)
+		J = jac[idx]
+		Jt = J.transpose(0, 2, 1)
+		A = Jt @ J
+		grad = (Jt @ resid[idx][..., None])[..., 0]
+		damped = A + lam[idx, None, None]*(A*eye + 1e-12*eye)
+		try:
+			step = -np.linalg.solve(damped, grad[..., None])[..., 0]
+		except np.linalg.LinAlgError:
+			step = np.stack([-np.linalg.lstsq(d, g, rcond=None)[0] for d, g in zip(damped, grad)])
+		trial = p[idx] + step
+		trial_model, trial_jac = _model_and_jacobian(trial, X, Y)
+		trial_resid = trial_model - data[idx]
+		trial_cost = (trial_resid**2).sum(axis=1)
+		better = np.isfinite(trial_cost) & (trial_cost <= cost[idx]) & np.all(np.abs(trial[:, 4:]) > 0.1, axis=1)
+		good = idx[better]
+		done = better & ((cost[idx] - trial_cost) <= tol*np.maximum(cost[idx], 1e-300))
+		p[good] = trial[better]
+		jac[good] = trial_jac[better]
+		resid[good] = trial_resid[better]
+		cost[good] = trial_cost[better]
+		lam[good] /= 10
+		lam[idx[~better]] *= 10
+		converged[idx[done]] = True
+		active[idx[done | (lam[idx] > 1e10)]] = False
+	converged &= np.all(np.isfinite(p), axis=1)
+	return p, converged
@@ -2,41 +2,150 @@ import numpy as np
 import mahotas as mh
 #from pylab import imshow, show
 import pyfits
-from msgfitter import fitgaussian
+from msgfitter import fitgaussian, fitgaussians
 from scipy.ndimage.measurements import center_of_mass
+from scipy.ndimage import maximum_filter
 
 import os
+import sys
+import atexit
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
 
+# With argument parallel=None, centroiding is spread across a pool of processes when
+# there are at least this many spots. Below it, the overhead isn't worth it.
+parallel_min_spots = 200
+_pool = None
+_scratch = threading.local()
 
-def remove_hot_pixels(image,nsigma=5):
+
+def remove_hot_pixels(image,nsigma=5,bad_pixels=None,roi=None):
 	"""
 	Remove isolated hot pixels in the image. The mean value of the original image is
-	calculated and a mean + nsigma threshold cut is applied. Hot pixels receive a new value of
-	the average of their 4 next neighbors.
+	calculated (from every other row and column, for speed, and only from the pixels
+	read out if roi is argued, see roi_sample) and a mean + nsigma
+	threshold cut is applied. Hot pixels whose 4 next
+	neighbors are all below the threshold (i.e. not part of a spot) receive the median
+	of their in-frame neighbors. This catches transients, like cosmic rays.
+
+	Argue bad_pixels (rows, cols) from a bad pixel map, to first replace the known hot
+	pixels regardless of threshold (see replace_bad_pixels). Modifies image in place,
+	and returns it.
 	"""
-	im_mean=np.mean(image)
-	im_sig=np.std(image)
-	hot_thresh=im_mean+nsigma*im_sig
+	if bad_pixels is not None:
+		replace_bad_pixels(image, bad_pixels)
+	sample = roi_sample(image, roi)
+	hot_thresh = np.mean(sample) + nsigma*np.std(sample)
+	rows, cols = np.nonzero(np.greater(image, hot_thresh, out=scratch('hot', np.shape(image), bool)))
+	if len(rows):
+		neighbors = _neighbor_values(image, rows, cols, _cross)
+		isolated = np.all(np.isnan(neighbors) | (neighbors < hot_thresh), axis=1)
+		if np.any(isolated):
+			_replace_with_median(image, rows[isolated], cols[isolated], neighbors[isolated])
+	return image
 
-	hp_img = np.copy(image)
-	hp_img = hp_img.astype(np.uint32)
-	low_values_indices = hp_img < hot_thresh  # Where values are low
-	
-	hp_img[low_values_indices] = 0
-	ind = zip(*np.where(hp_img > hot_thresh))
-	xlimit=len(hp_img[0])
-	ylimit=len(hp_img)
-		
-	for i in ind:
-		if i[0] == 0 or i[0]==ylimit-1 or i[1]==0 or i[1]==xlimit-1:
-			print('Edge hot spot')
-			image[i[0],i[1]] =np.median(image)
-		else:
-			neighborsum=hp_img[i[0]+1,i[1]] + hp_img[i[0]-1,i[1]] + hp_img[i[0],i[1]-1] + hp_img[i[0],i[1]+1]
-			if neighborsum == 0:
-				image[i[0],i[1]] = (image[i[0]+1,i[1]]+image[i[0]-1,i[1]]+image[i[0],i[1]-1]+image[i[0],i[1]+1])/4.
-	del hp_img        
-	return image 
+def roi_sample(image, roi=None, step=2):
+	"""
+	Returns 1d array of the pixels of image in every step'th row and column. If roi is
+	argued as (row bands, column range), as in the camera drivers' set_roi(), only the
+	pixels read out are taken, since the others are zeros which would bias statistics.
+	"""
+	bands, columns = roi if roi is not None else (None, None)
+	if bands is None and columns is None:
+		return image[::step, ::step].ravel()
+	cols = slice(columns[0], columns[1], step) if columns is not None else slice(None, None, step)
+	bands = bands if bands is not None else [(0, np.shape(image)[0])]
+	parts = [image[start:stop:step, cols].ravel() for start, stop in bands]
+	sample = np.concatenate(parts) if parts else np.zeros(0)
+	return sample if sample.size else image[::step, ::step].ravel()
+
+def scratch(name, shape, dtype):
+	"""
+	Returns a preallocated array for temporary per-frame results (e.g. threshold masks),
+	which is reused by later calls from the same thread with the same name, shape and
+	dtype, rather than allocating a new full-size array for every frame. Its contents
+	are only valid until the next call with that name.
+	"""
+	buffer = getattr(_scratch, name, None)
+	if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+		buffer = np.empty(shape, dtype=dtype)
+		setattr(_scratch, name, buffer)
+	return buffer
+
+_cross = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+_ring = _cross + [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+
+def _neighbor_values(image, rows, cols, offsets):
+	"""Returns float array of shape (len(rows), len(offsets)) of the values of pixels at
+	offsets (drow, dcol) from each of rows, cols. Nan where outside the image."""
+	height, width = np.shape(image)
+	r = rows[:, None] + np.array([o[0] for o in offsets])
+	c = cols[:, None] + np.array([o[1] for o in offsets])
+	inside = (r >= 0) & (r < height) & (c >= 0) & (c < width)
+	values = image[np.clip(r, 0, height - 1), np.clip(c, 0, width - 1)].astype(float)
+	values[~inside] = np.nan
+	return values
+
+def _replace_with_median(image, rows, cols, neighbors):
+	"""Sets pixels rows, cols to the nanmedian of their neighbor values, where any exist."""
+	valid = ~np.all(np.isnan(neighbors), axis=1)
+	medians = np.nanmedian(neighbors[valid], axis=1)
+	image[rows[valid], cols[valid]] = medians.astype(image.dtype) if np.issubdtype(image.dtype, np.integer) else medians
+
+def replace_bad_pixels(image, bad_pixels):
+	"""
+	Replaces known bad pixels, (rows, cols) as from np.nonzero(bad_pixel_map), with the
+	median of their 8 neighbors, excluding any neighbors which are also bad. Vectorized
+	over all bad pixels at once. Modifies image in place, and returns it.
+	"""
+	rows, cols = (np.asarray(index, dtype=int) for index in bad_pixels)
+	if not len(rows):
+		return image
+	width = np.shape(image)[1]
+	neighbors = _neighbor_values(image, rows, cols, _ring)
+	bad_flat = np.sort(rows*width + cols)
+	r = rows[:, None] + np.array([o[0] for o in _ring])
+	c = cols[:, None] + np.array([o[1] for o in _ring])
+	flat = r*width + c
+	found = np.searchsorted(bad_flat, flat)
+	also_bad = bad_flat[np.minimum(found, len(bad_flat) - 1)] == flat
+	neighbors[also_bad] = np.nan
+	_replace_with_median(image, rows, cols, neighbors)
+	return image
+
+def build_bad_pixel_map(darks, nsigma=5, min_fraction=0.5):
+	"""
+	Returns boolean bad pixel map, True for pixels which are more than nsigma above the
+	background in at least min_fraction of the dark frames. Pixels hot in only a few
+	frames (e.g. cosmic rays) are not included. Argue darks as any iterable of bias-
+	subtracted images (e.g. a generator, taking each exposure as needed), so that only
+	one frame at a time is held in memory. Background and noise are from the median
+	and MAD of a subsample of each frame.
+	"""
+	counts = None
+	n = 0
+	for dark in darks:
+		dark = np.asarray(dark)
+		sample = dark[::7, ::7]
+		background = np.median(sample)
+		noise = max(1.4826*np.median(np.abs(sample - background)), 1.0)
+		hot = dark > background + nsigma*noise
+		counts = hot.astype(np.uint16) if counts is None else counts + hot
+		n += 1
+	assert n > 0, 'no dark frames argued for bad pixel map'
+	return counts >= max(min_fraction*n, 1)
+
+def save_bad_pixel_map(bad_pixel_map, filename):
+	"""Writes boolean bad pixel map to a FITS file, as uint8."""
+	pyfits.PrimaryHDU(np.asarray(bad_pixel_map, dtype=np.uint8)).writeto(filename, overwrite=True)
+
+def load_bad_pixel_map(filename):
+	"""Returns bad pixels (rows, cols) from a FITS file written by save_bad_pixel_map, or
+	None if there is no such file."""
+	if not os.path.isfile(filename):
+		return None
+	return np.nonzero(pyfits.getdata(filename))
 
 def centroid(im, mask=None, w=None, x=None, y=None):
 	"""Compute the centroid of an image with a specified binary mask projected upon it.
@@ -97,7 +206,7 @@ def im2bw(image,level):
 	bw[threshold_indices] = 1
 	return bw
 
-def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_otsu=True, save_dir='', size_fitbox=10):
+def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_otsu=True, save_dir='', size_fitbox=10, batch_fit=False, parallel=None, roi=None):
 # Computes centroids by finding spots and then fitting 2d gaussian
 #
 # Input 
@@ -105,23 +214,28 @@ def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_ots
 #       V: verbose mode
 #       regarding size_fitbox: it's a gaussian fitter box, this value is 1/2 length of side in pixels,
 #                              i.e. the box dimensions are 2*size_fitbox X 2*size_fitbox
+#       batch_fit: whether to fit all spots at once with msgfitter.fitgaussians (any which
+#                  don't converge are refit individually)
+#       parallel: whether to fit spots in a pool of processes, sharing the image (see
+#                 map_shared), or None to decide by number of spots (parallel_min_spots)
+#       roi: (row bands, column range) read out, if not the whole image, so that the hot
+#            pixel threshold is computed from those pixels only (see remove_hot_pixels)
 #
 # Output:
 #       returning the centroids and FWHMs as lists (xcen,ycen,fwhm)
 
-	img[img<0]=0
+	np.maximum(img, 0, out=img)
 
-	img=remove_hot_pixels(img,7)
+	img=remove_hot_pixels(img,7,roi=roi)
 
-	img = img.astype(np.uint16)
 	level_fraction_of_peak = 0.1
-	level_frac = int(level_fraction_of_peak*np.max(np.max(img)))
+	level_frac = int(level_fraction_of_peak*np.max(img))
 	if no_otsu:
 		level = level_frac
 	else:
-		level_otsu = mh.thresholding.otsu(img)
+		level_otsu = mh.thresholding.otsu(img.astype(np.uint16))
 		level = max(level_otsu,level_frac)
-	bw=im2bw(img,level)
+	bw = np.greater(img, level, out=scratch('bw', img.shape, bool)) # like im2bw, but into a reused buffer
 
 	if write_fits:
 		filename = os.path.join(save_dir, 'binary_image.FITS')
@@ -129,11 +243,11 @@ def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_ots
 			os.remove(filename)
 		except:
 			pass
-		hdu=pyfits.PrimaryHDU(bw)    
+		hdu=pyfits.PrimaryHDU(bw.view(np.uint8))    
 		hdu.writeto(filename)
 	else:
 		filename = []
-	labeled, nr_objects = mh.label(bw)
+	labeled, nr_objects = mh.label(bw, out=scratch('labeled', img.shape, np.int32))
 	sizes = mh.labeled.labeled_size(labeled) # size[0] is the background size, sizes[1 and greater] are number of pixels in each region
 	sorted_sizes_indexes = np.argsort(sizes)[::-1] # return in descending order
 	good_spot_indexes = sorted_sizes_indexes[1:n_centroids_to_keep+1] # avoiding the background regions entry at the beginning
@@ -143,7 +257,7 @@ def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_ots
 	# the more simplistic level_frac.
 	if len(good_spot_indexes) < n_centroids_to_keep and not(no_otsu):
 		print('Retrying centroiding using fractional level (' + str(level_fraction_of_peak) + ' * peak) instead of otsu method')
-		return multiCens(img,n_centroids_to_keep,verbose,write_fits,no_otsu=True)
+		return multiCens(img,n_centroids_to_keep,verbose,write_fits,no_otsu=True,batch_fit=batch_fit,parallel=parallel,roi=roi)
 
 	# now loop over the found spots and calculate rough centroids        
 	FWHMSub = []
@@ -170,12 +284,19 @@ def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_ots
 		peaks.append(peak)
 	"""    
 	nbox = size_fitbox
+	pxy = [(int(round(x[0][1])), int(round(x[0][0]))) for x in centers]
+	if _use_parallel(parallel, len(pxy)):
+		batch = {}
+		for fitted in map_shared(img, _fit_chunk, _chunks(list(enumerate(pxy))), nbox=nbox, batch_fit=batch_fit):
+			batch.update(fitted)
+	else:
+		batch = fit_boxes(img, pxy, nbox) if batch_fit else {}
 	for i,x in enumerate(centers):
 		x=x[0]
 		px=int(round(x[1]))
 		py=int(round(x[0]))     
 		data = img[py-nbox:py+nbox,px-nbox:px+nbox]
-		params = fitgaussian(data)
+		params = batch[i] if i in batch else fitgaussian(data)
 		fwhm=abs(2.355*max(params[4],params[5]))
 		if fwhm < .5:
 			print(" fit failed - trying again with smaller fitbox")
@@ -198,10 +319,270 @@ def multiCens(img, n_centroids_to_keep=2, verbose=False, write_fits=True, no_ots
 			print('fwhm = ' + str(FWHMSub[-1]) + ' appears invalid, check if fitbox size (' + str(size_fitbox) + ') is appropriate and dots are sufficiently illuminated')
 			should_save_sample_image = True
 		if should_save_sample_image:
-			if len(os.listdir()) < max_sample_files_to_save:
+			if len(os.listdir(save_dir or '.')) < max_sample_files_to_save:
 				savefile = os.path.join(save_dir, 'peak_' + format(peak,'.1f') + '_fwhm_' + format(FWHMSub[-1],'.3f') + '_sizefitbox_' + str(size_fitbox) + '.FITS')
 				sample = pyfits.PrimaryHDU(img)
-				sample.writeto(savefile)
+				sample.writeto(savefile, overwrite=True)
 				print('wrote a sample image file to ' + savefile)
 			
 	return xCenSub, yCenSub, peaks, FWHMSub, filename
+
+
+def fit_boxes(img, pxy, nbox):
+	"""
+	Fits gaussians to the 2*nbox square boxes around pixels pxy, a list of (px, py), all
+	at once with msgfitter.fitgaussians. Returns dict with keys = index into pxy and
+	values = params as from fitgaussian, only for those boxes which lie wholly inside
+	the image and whose fits converged.
+	"""
+	height, width = np.shape(img)
+	inside = [i for i, (px, py) in enumerate(pxy) if nbox <= py <= height - nbox and nbox <= px <= width - nbox]
+	if not inside:
+		return {}
+	stack = np.stack([img[pxy[i][1]-nbox:pxy[i][1]+nbox, pxy[i][0]-nbox:pxy[i][0]+nbox] for i in inside])
+	params, converged = fitgaussians(stack)
+	return {i: params[k] for k, i in enumerate(inside) if converged[k]}
+
+
+def _fit_chunk(img, indexed_pxy, nbox, batch_fit):
+	"""
+	Fits the boxes around a subset of spots, for multiCens in a worker process. Argue
+	indexed_pxy as a list of (index, (px, py)). Returns dict of index --> params, for
+	boxes wholly inside the image (and if batch_fit, whose fits converged).
+	"""
+	indices = [i for i, _ in indexed_pxy]
+	pxy = [p for _, p in indexed_pxy]
+	if batch_fit:
+		fitted = fit_boxes(img, pxy, nbox)
+		return {indices[k]: params for k, params in fitted.items()}
+	height, width = np.shape(img)
+	return {i: fitgaussian(img[py-nbox:py+nbox,px-nbox:px+nbox]) for i, (px, py) in indexed_pxy
+			if nbox <= py <= height - nbox and nbox <= px <= width - nbox}
+
+
+def _use_parallel(parallel, n_spots):
+	if parallel is None:
+		return n_spots >= parallel_min_spots and (os.cpu_count() or 1) > 1
+	return parallel
+
+
+def _get_pool():
+	"""
+	Process pool, started on first use and kept for subsequent images. Workers are not
+	forked, since other threads (e.g. image acquisition in FVCHandler.measure_stream)
+	may be holding locks at the time, which a forked child would inherit held.
+	"""
+	global _pool
+	if _pool is None:
+		methods = multiprocessing.get_all_start_methods()
+		context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+		_pool = context.Pool(max((os.cpu_count() or 2) - 1, 1))
+		atexit.register(_pool.terminate)
+	return _pool
+
+
+def _chunks(items):
+	"""Splits list into about 2 chunks per pool process, for load balancing."""
+	n = min(len(items), 2*_get_pool()._processes)
+	return [items[k::n] for k in range(n)] if n else []
+
+
+def _shared_call(shm_name, shape, dtype, func, args, kwargs):
+	"""Runs func(img, *args, **kwargs) in a worker, with img a view of shared memory."""
+	# the creating process owns the segment. Before 3.13 attaching registers it again, but
+	# pool workers share the creator's resource tracker, so this is a no-op there, and
+	# unregistering here would drop the creator's registration instead.
+	if sys.version_info >= (3, 13):
+		shm = shared_memory.SharedMemory(name=shm_name, track=False)
+	else:
+		shm = shared_memory.SharedMemory(name=shm_name)
+	try:
+		img = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+		result = func(img, *args, **kwargs)
+		del img
+		return result
+	finally:
+		shm.close()
+
+
+def map_shared(img, func, chunks, **kwargs):
+	"""
+	Runs func(img, chunk, **kwargs) for each chunk in the process pool, and returns the
+	list of results, in order of chunks. The image is copied once into shared memory,
+	rather than pickled to every worker. Func must be a module-level function.
+	"""
+	img = np.ascontiguousarray(img)
+	shm = shared_memory.SharedMemory(create=True, size=max(img.nbytes, 1))
+	try:
+		np.ndarray(img.shape, dtype=img.dtype, buffer=shm.buf)[...] = img
+		jobs = [(shm.name, img.shape, img.dtype.str, func, (chunk,), kwargs) for chunk in chunks]
+		return _get_pool().starmap(_shared_call, jobs)
+	finally:
+		shm.close()
+		shm.unlink()
+
+
+def replace_isolated_pixels(window, threshold):
+	"""
+	Replaces pixels above threshold, whose 4 next neighbors are all below it (i.e. hot
+	pixels rather than spots), with the average of those neighbors. Vectorized, for
+	small windows, or a stack of them with shape (N, h, w) and threshold broadcastable
+	to (N, 1, 1). Returns new array.
+	"""
+	padded = np.pad(window, [(0, 0)]*(np.ndim(window) - 2) + [(1, 1), (1, 1)], mode='edge')
+	neighbors = np.stack([padded[..., 2:, 1:-1], padded[..., :-2, 1:-1], padded[..., 1:-1, 2:], padded[..., 1:-1, :-2]])
+	isolated = (window > threshold) & np.all(neighbors <= threshold, axis=0)
+	return np.where(isolated, neighbors.mean(axis=0), window)
+
+
+def nearest_peak(window, iy0, ix0, threshold, searched):
+	"""
+	Returns (row, col) of the local maximum of window above threshold which is nearest to
+	pixel (iy0, ix0), among those within boolean mask searched, or None if there is none.
+	Unlike the brightest pixel of the whole search area, this doesn't jump to a brighter
+	neighboring spot. A flat top (e.g. saturated) counts as one maximum.
+	"""
+	maxima = (window >= maximum_filter(window, size=3, mode='nearest')) & (window > threshold) & searched
+	labeled, n = mh.label(maxima, Bc=np.ones((3, 3), bool))
+	rows, cols = np.nonzero(labeled)
+	if not len(rows):
+		return None
+	k = np.argmin((rows - iy0)**2 + (cols - ix0)**2)
+	top = labeled == labeled[rows[k], cols[k]]
+	return np.unravel_index(np.argmax(np.where(top, window, -np.inf)), window.shape)
+
+
+def unique_peaks(px, py, gx, gy, found):
+	"""
+	Returns copy of boolean array found, keeping only one guess (gx, gy) per peak pixel
+	(px, py), where several guesses found the same one: the guess nearest to it. The
+	others are set False, i.e. no spot found, to be searched for again in the full frame.
+	"""
+	px, py, gx, gy = [np.asarray(a) for a in (px, py, gx, gy)]
+	found = np.array(found, dtype=bool)
+	claimed = set()
+	for i in np.argsort((px - gx)**2 + (py - gy)**2, kind='stable'):
+		if found[i]:
+			if (px[i], py[i]) in claimed:
+				found[i] = False
+			claimed.add((px[i], py[i]))
+	return found
+
+
+def _fit_stack(stack, batch_fit):
+	"""
+	Fits gaussians to each box of stack, all at once if batch_fit (with any which don't
+	converge refit singly). Returns list of params as from fitgaussian.
+	"""
+	if not batch_fit:
+		return [fitgaussian(data) for data in stack]
+	params, converged = fitgaussians(stack)
+	return [params[k] if converged[k] else fitgaussian(stack[k]) for k in range(len(stack))]
+
+
+def localCens(img, xy_guess, size_fitbox=10, search_radius=None, nsigma=10, verbose=False, batch_fit=False, parallel=None):
+# Computes centroids only near guessed positions, without full-frame spot detection.
+#
+# For each guess, a window of +/- (search_radius + size_fitbox) pixels is cut out, its
+# background and noise are estimated from the median and MAD of the window, isolated
+# hot pixels are replaced, and the local maximum more than nsigma * noise above
+# background which is nearest to the guess (within search_radius) is taken as the
+# spot (see nearest_peak). Where several guesses find the same
+# spot, only the nearest keeps it (see unique_peaks). A 2d gaussian is then fit in a
+# box around that pixel, as in multiCens.
+#
+# Input
+#       img: image as numpy array (bias-subtracted)
+#       xy_guess: list of [x,y] guessed spot positions in pixels, x = column, y = row
+#       size_fitbox: 1/2 length of side of gaussian fitter box in pixels
+#       search_radius: 1/2 length of side of search window, default 2 * size_fitbox
+#       nsigma: detection threshold, in units of the window's noise
+#       batch_fit: whether to fit all spots at once, as in multiCens
+#       parallel: whether to split the fits among a pool of processes, as in multiCens
+#
+# Output:
+#       returning lists (xcen, ycen, peaks, fwhms, found) in the order of xy_guess,
+#       where found is False for windows with no spot (their other values are nan)
+
+	nbox = size_fitbox
+	search = 2*size_fitbox if search_radius is None else search_radius
+	height, width = np.shape(img)
+	xy_guess = np.reshape(xy_guess, (-1, 2))
+	n = len(xy_guess)
+	gx, gy = np.round(xy_guess[:, 0]).astype(int), np.round(xy_guess[:, 1]).astype(int)
+	px, py = np.zeros(n, dtype=int), np.zeros(n, dtype=int)
+	found = np.zeros(n, dtype=bool)
+	boxes = np.zeros((n, 2*nbox, 2*nbox))
+	for i in range(n):
+		r0, r1 = max(gy[i] - search - nbox, 0), min(gy[i] + search + nbox + 1, height)
+		c0, c1 = max(gx[i] - search - nbox, 0), min(gx[i] + search + nbox + 1, width)
+		if not (r0 < r1 and c0 < c1):
+			continue
+		window = np.array(img[r0:r1, c0:c1], dtype=float)
+		background = np.median(window)
+		noise = 1.4826*np.median(np.abs(window - background))
+		threshold = background + nsigma*max(noise, 1.0)
+		window[window < 0] = 0
+		window = replace_isolated_pixels(window, threshold)
+		rows, cols = np.ogrid[r0:r1, c0:c1]
+		searched = (np.abs(rows - gy[i]) <= search) & (np.abs(cols - gx[i]) <= search)
+		peak = nearest_peak(window, gy[i] - r0, gx[i] - c0, threshold, searched)
+		if peak is None:
+			continue
+		iy, ix = peak
+		py[i], px[i] = r0 + iy, c0 + ix
+		if nbox <= py[i] <= height - nbox and nbox <= px[i] <= width - nbox:
+			boxes[i] = window[iy-nbox:iy+nbox,ix-nbox:ix+nbox]
+			found[i] = True
+	duplicates = found & ~unique_peaks(px, py, gx, gy, found)
+	found &= ~duplicates
+	if verbose:
+		for i in np.flatnonzero(~found):
+			reason = 'only a spot nearer another guess' if duplicates[i] else 'no spot'
+			print('found ' + reason + ' near guess (' + str(xy_guess[i][0]) + ', ' + str(xy_guess[i][1]) + ')')
+	fitted = np.flatnonzero(found)
+	if _use_parallel(parallel, len(fitted)):
+		chunks = _chunks(list(fitted))
+		results = _get_pool().starmap(_fit_stack, [(boxes[chunk], batch_fit) for chunk in chunks])
+		params = dict(zip([i for chunk in chunks for i in chunk], [p for result in results for p in result]))
+	else:
+		params = dict(zip(fitted, _fit_stack(boxes[fitted], batch_fit))) if len(fitted) else {}
+	xCenSub, yCenSub, peaks, FWHMSub = [], [], [], []
+	for i in range(n):
+		if not found[i]:
+			for values in (xCenSub, yCenSub, peaks, FWHMSub):
+				values.append(np.nan)
+			continue
+		xCenSub.append(float(px[i])-float(nbox)+params[i][3])
+		yCenSub.append(float(py[i])-float(nbox)+params[i][2])
+		FWHMSub.append(abs(2.355*max(params[i][4],params[i][5])))
+		peaks.append(params[i][1])
+	return xCenSub, yCenSub, peaks, FWHMSub, found.tolist()
+
+
+def guidedCens(img, xy_guess, verbose=False, write_fits=True, save_dir='', size_fitbox=10, search_radius=None, batch_fit=False, parallel=None, roi=None):
+# Computes centroids near guessed positions with localCens, and only for any guesses
+# where no spot was found falls back to full-frame detection with multiCens. In the
+# fallback, the fit boxes of spots already found are blanked out, and the remaining
+# number of spots is searched for. This includes any guess which only found a spot
+# claimed by a nearer guess, so that a close neighbor is not blanked out with it.
+#
+# Output is the same as multiCens: lists (xcen, ycen, peaks, fwhms, filename).
+# Spots found near their guesses come first, in guess order, then any from the fallback.
+
+	xcen, ycen, peaks, fwhms, found = localCens(img, xy_guess, size_fitbox, search_radius, verbose=verbose, batch_fit=batch_fit, parallel=parallel)
+	keep = [i for i in range(len(found)) if found[i]]
+	xcen, ycen, peaks, fwhms = [[values[i] for i in keep] for values in (xcen, ycen, peaks, fwhms)]
+	n_missing = len(found) - len(keep)
+	filename = []
+	if n_missing:
+		print('guided centroiding found no spot near ' + str(n_missing) + ' guesses, falling back to full-frame detection')
+		masked = np.array(img, copy=True)
+		for x, y in zip(xcen, ycen):
+			px, py = int(round(x)), int(round(y))
+			masked[max(py-size_fitbox,0):py+size_fitbox+1, max(px-size_fitbox,0):px+size_fitbox+1] = 0
+		more = multiCens(masked, n_missing, verbose, write_fits, save_dir=save_dir, size_fitbox=size_fitbox, batch_fit=batch_fit, parallel=parallel, roi=roi)
+		for values, extra in zip((xcen, ycen, peaks, fwhms), more[:4]):
+			values.extend(extra)
+		filename = more[4]
+	return xcen, ycen, peaks, fwhms, filename
@@ -1,10 +1,12 @@
-import time
+import clock
 import multicens
 import numpy as np
-import gc
 import sbigcam
 import os
-from astropy.io import fits
+import sys
+sys.path.append(os.path.join(os.path.realpath(os.path.dirname(__file__)), '..'))  # for centroiders
+import centroiders
+import calibration
 
 class SBIG_Grab_Cen(object):
 	"""Module for grabbing images and calculating centroids using the SBIG camera.
@@ -12,18 +14,24 @@ class SBIG_Grab_Cen(object):
 	def __init__(self, save_dir='', size_fitbox=4, write_bias=False):  
 		self.__exposure_time = 200 # milliseconds, 90 ms is the minimum
 		self._cam_init()
+		self.frames = calibration.FrameCorrector() # preallocated buffers for corrected images
+		self.calibration = calibration.CalibrationManager(self._dark_exposure, self.ccd_temperature, bias_exposure_time=90, cache_dir=save_dir if write_bias else None) # master bias and dark frames, memory-mapped in save_dir if write_bias
 		self.min_brightness = 200
 		self.max_brightness = 60000
 		self.min_num_nonzero_pixels = 100
 		self.verbose = False
 		self.write_fits = True
-		self.take_darks = False #True # whether to measure a dark image and subtract it out
-		self.write_bias = write_bias
-		self.subtract_bias = True #True # wheather to subtract bias image
+		self.take_darks = False #True # whether to subtract a master dark image (which includes the bias)
+		self.subtract_bias = True #True # wheather to subtract master bias image (if not take_darks)
 		self.flip_horizontal = True # whether to reflect image across y axis
 		self.flip_vertical = False # whether to reflect image across x axis
 		self.save_dir = save_dir
 		self.size_fitbox = size_fitbox # gaussian fitter box dimensions are 2*size_fitbox X 2*size_fitbox
+		self.centroider = 'gaussian' # centroiding backend, see centroiders.registry
+		self.parallel = None # whether to centroid in a pool of processes, None to decide by number of spots (see multicens)
+		self.roi = (None, None) # (row bands, column range) read out, see set_roi()
+		self.bad_pixel_file = os.path.join(save_dir, 'SBIG_bad_pixel_map.FITS')
+		self.bad_pixels = multicens.load_bad_pixel_map(self.bad_pixel_file) # (rows, cols) of known hot pixels, see make_bad_pixel_map()
 
 	def _cam_init(self, temperature=10):
 		self.cam=sbigcam.SBIGCam()
@@ -42,12 +50,13 @@ class SBIG_Grab_Cen(object):
 		self.__exposure_time = int(exposure_time)
 		self.cam.set_exposure_time(self.exposure_time)
 
-	def grab(self, nWin=1, n_retries=3):
+	def grab(self, nWin=1, n_retries=3, xy_guess=None):
 		"""Calls function to grab light and dark images from SBIG camera, then centroids spots.
 		
 		INPUTS:
 			nWin       ... integer, number of centroid windows. For the measure_camera_scale script, nwin should be equal 1
 			n_retries  ... integer, max number of recursive retries in certain cases of getting an error
+			xy_guess   ... optional list of [x,y] guessed spot positions in pixels, see centroid()
 	
 		RETURNS
 			xy         ... list of centroid coordinates for each spot
@@ -56,45 +65,36 @@ class SBIG_Grab_Cen(object):
 			time       ... elapsed time in seconds
 			imgfiles   ... filenames of images produced
 		 """
-		imgfiles = []
-		tic = time.time()
-		if self.take_darks:
-			if self.verbose:
-				print("Taking dark image...")
-			self.cam.set_dark(True)
-			D = self.start_exposure()
-			D = self.flip(D)
-			if self.write_fits:
-				filename = os.path.join(self.save_dir, 'SBIG_dark_image.FITS')
-				try:
-					os.remove(filename)
-				except:
-					print('couldn''t remove file: ' + filename)
-				self.cam.write_fits(D,filename)
-				imgfiles.append(filename)                
-		else:
-			D = None             
+		tic = clock.time()
+		LD, imgfiles = self.acquire()
+		xy, peaks, fwhms, binfile = self.centroid(LD, nWin, xy_guess)
+		minimum = min(peaks)        
+		if minimum < self.min_brightness and n_retries > 0:
+			print('Retrying image grab (' + str(n_retries) + ' attempts remaining) after got back a very low peak brightness value = ' + str(minimum) + ' at (' + str(xy[peaks.index(minimum)][0]) +', ' + str(xy[peaks.index(minimum)][1]) + ')')
+			return self.grab(nWin, n_retries-1, xy_guess)
+		if binfile:
+			imgfiles.append(binfile)
+		toc = clock.time()
+		if self.verbose:
+			print("Time used: "+str(toc-tic)+"\n")
+		return xy,peaks,fwhms,toc-tic,imgfiles
 
+	def acquire(self):
+		"""Grabs light image from SBIG camera, and subtracts the master dark (if take_darks)
+		or else master bias, from the calibration manager. This is the first half of grab(),
+		which may be run for the next image while the previous one is still being centroided.
+
+		RETURNS
+			LD         ... int32 image, light minus dark or bias
+			imgfiles   ... filenames of images produced
+		"""
+		imgfiles = []
 		if self.verbose:
 			print("Taking light image...")
 		self.cam.set_dark(False)
 		L = self.start_exposure()
 		L = self.flip(L)
 
-
-		if self.subtract_bias:
-			if self.verbose:
-				print("Subtracting Bias Image...")
-			filename = os.path.join(self.save_dir, 'SBIG_bias_image.FITS')
-			try:
-				hdul = fits.open(filename)
-				B = hdul[0].data 
-			except:
-				B = np.zeros(np.shape(L), dtype=np.int32)
-				print('No Bias file: ' + filename)
-		else:
-			B = np.zeros(np.shape(L), dtype=np.int32) 
-
 		if self.write_fits:
 			filename = os.path.join(self.save_dir, 'SBIG_light_image.FITS')
 			try:
@@ -104,23 +104,20 @@ class SBIG_Grab_Cen(object):
 					print('couldn''t remove file: ' + filename)
 			self.cam.write_fits(L,filename)
 			imgfiles.append(filename)
-		if self.write_bias:
-			a=input('Warning! Do you really want to save a bias frame?')
-			if a == 'N' or a == 'n' or a=='no' or a=='No' or a=='NO':
-				print('Please change self.write_bias in sbig_grab_cen.py to False')
-				import sys; sys.exit()
-			filename_bias = os.path.join(self.save_dir, 'SBIG_bias_image.FITS')
-			try:
-				os.remove(filename_bias)
-			except:
-				pass
-			self.cam.write_fits(L,filename_bias)
-			print('Save Bias successfully. Please change self.write_bias in sbig_grab_cen.py to False')
-			import sys; sys.exit()
-		
-		if not(self.take_darks):
-			D = np.zeros(np.shape(L), dtype=np.int32)
-		LD = np.array(L,dtype = np.int32) - np.array(D,dtype = np.int32)  - np.array(B,dtype = np.int32)
+
+		if self.take_darks:
+			if self.verbose:
+				print("Subtracting master dark image...")
+			D = self.calibration.dark(self.exposure_time)
+		elif self.subtract_bias:
+			if self.verbose:
+				print("Subtracting master bias image...")
+			D = self.calibration.bias()
+		else:
+			D = None
+		LD = self.frames.correct(L, D) # L is a flipped view of the camera's image, so no copies until here
+		if self.bad_pixels is not None:
+			multicens.replace_bad_pixels(LD, self.bad_pixels)
 		if self.write_fits and (self.take_darks or self.subtract_bias):
 			filename = os.path.join(self.save_dir, 'SBIG_diff_image.FITS')
 			try:
@@ -129,8 +126,6 @@ class SBIG_Grab_Cen(object):
 				pass
 			self.cam.write_fits(LD,filename)
 			imgfiles.append(filename)
-		del L
-		gc.collect()
 		
 		brightness = np.amax(LD)
 		if self.verbose:
@@ -139,30 +134,52 @@ class SBIG_Grab_Cen(object):
 			print('Warning: the brightest spot in the image is undersaturated. Value = ' + str(brightness))
 		elif brightness > self.max_brightness:
 			print('Warning: the brightest spot in the image is oversaturated. Value = ' + str(brightness))
-		del D
-		gc.collect()
+		return LD, imgfiles
 
-		# call routine to determine multiple gaussian-fitted centroids
-		centroiding_tic = time.time()
-		xcen, ycen, peaks, fwhms, binfile = multicens.multiCens(LD, nWin, self.verbose, self.write_fits, save_dir=self.save_dir, size_fitbox=self.size_fitbox)
-		minimum = min(peaks)        
-		if minimum < self.min_brightness and n_retries > 0:
-			print('Retrying image grab (' + str(n_retries) + ' attempts remaining) after got back a very low peak brightness value = ' + str(minimum) + ' at (' + str(xcen[peaks.index(minimum)]) +', ' + str(ycen[peaks.index(minimum)]) + ')')
-			return self.grab(nWin, n_retries-1)
-			
-		if binfile:
-			imgfiles.append(binfile)
+	def centroid(self, LD, nWin=1, xy_guess=None):
+		"""Centroids spots in an image from acquire(). This is the second half of grab().
+
+		INPUTS:
+			LD         ... image, as returned by acquire()
+			nWin       ... integer, number of centroid windows
+			xy_guess   ... optional list of [x,y] guessed spot positions in pixels. If argued, then
+			               spots are centroided in small windows around these, with full-frame
+			               detection only for any not found
+
+		RETURNS
+			xy         ... list of centroid coordinates for each spot
+			peaks      ... list of values of peak brightness for each spot
+			fwhms      ... list of values of fwhm for each spot
+			binfile    ... filename of binary image produced, if any
+		"""
+		centroiding_tic = clock.time()
+		cen = centroiders.get(self.centroider, size_fitbox=self.size_fitbox, verbose=self.verbose, write_fits=self.write_fits, save_dir=self.save_dir, parallel=self.parallel, roi=self.roi)
+		xcen, ycen, peaks, fwhms, binfile = cen.centroid(LD, nWin, xy_guess)
 		xy = [[xcen[i],ycen[i]] for i in range(len(xcen))]
-		centroiding_toc = time.time()
+		centroiding_toc = clock.time()
 		if self.verbose:
 			print('centroiding time: ' + str(centroiding_toc - centroiding_tic))
+		return xy,peaks,fwhms,binfile
 		
-		toc = time.time()
-		if self.verbose:
-			print("Time used: "+str(toc-tic)+"\n")
-		
-		return xy,peaks,fwhms,tic-toc,imgfiles
-		
+	def ccd_temperature(self):
+		"""Returns current CCD temperature in deg C, or None if the query failed."""
+		status = self.cam.query_temperature_status()
+		return status['imaging_ccd_temperature'] if status else None
+
+	def _dark_exposure(self, exposure_time):
+		"""Takes one full-frame dark image of exposure_time [ms], for the calibration manager,
+		restoring the light exposure settings and readout bands afterwards."""
+		bands, columns = self.cam.BANDS, self.cam.BAND_COLUMNS
+		self.cam.set_readout_bands()
+		self.cam.set_exposure_time(int(exposure_time))
+		self.cam.set_dark(True)
+		try:
+			return self.flip(self.start_exposure())
+		finally:
+			self.cam.set_dark(False)
+			self.cam.set_exposure_time(self.exposure_time)
+			self.cam.set_readout_bands(bands, columns)
+
 	def open_camera(self):
 		self.cam.open_camera()
 		self.cam.initialize_shutter()
@@ -195,6 +212,48 @@ class SBIG_Grab_Cen(object):
 				raise ValueError('Image not good, try restarting the camera.')
 		return img
 
+	@property
+	def frame_shape(self):
+		"""(rows, columns) of images returned."""
+		return (self.cam.HEIGHT.value, self.cam.WIDTH.value)
+
+	def set_roi(self, bands=None, columns=None):
+		"""Restricts readout to bands of rows and a range of columns, in the same pixel
+		coordinates as the centroids are returned (i.e. after any flips). Rows between
+		the bands are skipped with the driver's dump lines command, which is much faster
+		than reading them. Images keep their full size, with zeros where not read.
+
+		INPUTS:
+			bands      ... list of (start, stop) row ranges, sorted and not overlapping, or None for all rows
+			columns    ... (start, stop) column range, or None for all columns
+		"""
+		self.roi = (bands, columns)
+		height, width = self.frame_shape
+		if bands is not None and self.flip_vertical:
+			bands = [(height - stop, height - start) for start, stop in bands[::-1]]
+		if columns is not None and self.flip_horizontal:
+			columns = (width - columns[1], width - columns[0])
+		return self.cam.set_readout_bands(bands, columns)
+
+	def make_bad_pixel_map(self, n_darks=5, nsigma=5):
+		"""Takes n_darks full-frame dark images, subtracts the master bias, and maps the
+		pixels which are hot in most of them (multicens.build_bad_pixel_map). The map is
+		saved to bad_pixel_file, from where it is loaded again at initialization, and from
+		then on these pixels are replaced in every image by acquire(). Returns the number
+		of bad pixels found.
+		"""
+		def darks():
+			bias = self.calibration.bias()
+			for i in range(n_darks):
+				if self.verbose:
+					print('Taking dark image ' + str(i + 1) + ' of ' + str(n_darks) + ' for bad pixel map...')
+				yield self.frames.correct(self._dark_exposure(self.exposure_time), bias) # shutter reopened even if interrupted
+		bad_pixel_map = multicens.build_bad_pixel_map(darks(), nsigma)
+		multicens.save_bad_pixel_map(bad_pixel_map, self.bad_pixel_file)
+		self.bad_pixels = np.nonzero(bad_pixel_map)
+		print('Saved bad pixel map with ' + str(len(self.bad_pixels[0])) + ' pixels to ' + self.bad_pixel_file)
+		return len(self.bad_pixels[0])
+
 	def flip(self, img):
 		if self.flip_horizontal:
 			img = np.fliplr(img)
@@ -223,6 +223,11 @@ class ReadoutLinesParams(Structure):
                 ('pixelStart',                      c_ushort),
                 ('pixelLength',                     c_ushort)]
 
+class DumpLinesParams(Structure):
+    _fields_ = [('ccd',                             c_ushort),
+                ('readoutMode',                     c_ushort),
+                ('lineLength',                      c_ushort)]
+
 class EndReadoutParams(Structure):
     _fields_ = [('ccd',                             c_ushort)]
 
@@ -321,6 +326,7 @@ class MiscellaneousControlParams(Structure):
 # general use camera commands
 CC_END_EXPOSURE                 = 2
 CC_READOUT_LINE                 = 3
+CC_DUMP_LINES                   = 4
 CC_QUERY_TEMPERATURE_STATUS     = 6
 CC_ESTABLISH_LINK               = 9
 CC_GET_CCD_INFO                 = 11
@@ -393,6 +399,8 @@ class SBIGCam(object):
         # self.cam_model=cam_model
         self.WIDTH = 0
         self.HEIGHT = 0
+        self.BANDS = None # row bands to read out, None for the whole window
+        self.BAND_COLUMNS = None # column range to read out within bands, None for the whole window width
         # Include sbigudrv.so
         if system() == 'Linux':
             self.SBIG = CDLL("/usr/local/lib/libsbigudrv.so")
@@ -480,6 +488,38 @@ class SBIGCam(object):
         except:
             return False
             
+    def set_readout_bands(self, bands=None, columns=None):
+        """
+        sets a region of interest for readout, as bands of rows, so that the rows
+        between them are skipped (dumped) rather than digitized
+        Input
+            bands: list of (start, stop) row ranges, relative to the window top,
+                   sorted and not overlapping, or None to read out all rows
+            columns: (start, stop) column range, relative to the window left, to
+                     read out within the bands, or None for the whole width
+        Returns:
+            True if success
+            False if failed
+        Images are still returned at full window size, with zeros in the pixels
+        not read out, so that pixel coordinates are unchanged.
+        """
+        if bands is not None:
+            bands = [(int(start), int(stop)) for start, stop in bands]
+            starts = [b[0] for b in bands]
+            stops = [b[1] for b in bands]
+            if any(start >= stop for start, stop in bands) or starts != sorted(starts) \
+                    or any(stops[i] > starts[i + 1] for i in range(len(bands) - 1)):
+                print('Invalid readout bands, must be sorted and not overlapping:', bands)
+                return False
+        if columns is not None:
+            columns = (int(columns[0]), int(columns[1]))
+            if columns[0] >= columns[1]:
+                print('Invalid readout columns:', columns)
+                return False
+        self.BANDS = bands
+        self.BAND_COLUMNS = columns
+        return True
+
     def select_camera(self, name='STF-8300M'):
         """
         sets the CCD chip size in pixels according to
@@ -904,17 +944,20 @@ class SBIGCam(object):
             print ('Readout initiated.')
           
         # Readout
-        rlp = ReadoutLinesParams(ccd = CCD_IMAGING, readoutMode = RM_1X1,
-                                 pixelStart = self.LEFT, pixelLength = self.WIDTH)
-        cameraData = ((c_ushort*(self.WIDTH.value))*self.HEIGHT.value)()
-        for i in range(self.HEIGHT.value):
-            Error = self.SBIG.SBIGUnivDrvCommand(CC_READOUT_LINE, byref(rlp), byref(cameraData, i*self.WIDTH.value*2)) # the 2 is essential
-            if Error != CE_NO_ERROR:
-                print ('Readout failed with error ' + str(Error) + '. Writing readout then closing device and driver.')
-                if Error == 8:
-                    print('(Error 8 means CE_RX_TIMEOUT, "Receive (Rx) timeout error")')
-                break
-        image = np.ctypeslib.as_array(cameraData)
+        if self.BANDS is not None:
+            image, Error = self._readout_bands()
+        else:
+            rlp = ReadoutLinesParams(ccd = CCD_IMAGING, readoutMode = RM_1X1,
+                                     pixelStart = self.LEFT, pixelLength = self.WIDTH)
+            cameraData = ((c_ushort*(self.WIDTH.value))*self.HEIGHT.value)()
+            for i in range(self.HEIGHT.value):
+                Error = self.SBIG.SBIGUnivDrvCommand(CC_READOUT_LINE, byref(rlp), byref(cameraData, i*self.WIDTH.value*2)) # the 2 is essential
+                if Error != CE_NO_ERROR:
+                    print ('Readout failed with error ' + str(Error) + '. Writing readout then closing device and driver.')
+                    if Error == 8:
+                        print('(Error 8 means CE_RX_TIMEOUT, "Receive (Rx) timeout error")')
+                    break
+            image = np.ctypeslib.as_array(cameraData)
         if Error == CE_NO_ERROR and self.verbose:
             print ('Readout successful.')
 
@@ -936,6 +979,39 @@ class SBIGCam(object):
         # hdu.writeto(name)
         return image
        
+    def _readout_bands(self):
+        """
+        reads out only the rows in self.BANDS (and columns in self.BAND_COLUMNS),
+        dumping the rows in between, during a readout already started
+        Returns
+            image at full window size, with zeros in the pixels not read out
+            last error code
+        """
+        height, width = self.HEIGHT.value, self.WIDTH.value
+        first_col, stop_col = self.BAND_COLUMNS if self.BAND_COLUMNS else (0, width)
+        image = np.zeros((height, width), dtype=np.uint16)
+        rlp = ReadoutLinesParams(ccd = CCD_IMAGING, readoutMode = RM_1X1,
+                                 pixelStart = c_ushort(self.LEFT.value + first_col),
+                                 pixelLength = c_ushort(stop_col - first_col))
+        lineData = (c_ushort*(stop_col - first_col))()
+        Error = CE_NO_ERROR
+        next_row = 0
+        for start, stop in self.BANDS:
+            if start > next_row:
+                dlp = DumpLinesParams(ccd = CCD_IMAGING, readoutMode = RM_1X1, lineLength = c_ushort(start - next_row))
+                Error = self.SBIG.SBIGUnivDrvCommand(CC_DUMP_LINES, byref(dlp), None)
+                if Error != CE_NO_ERROR:
+                    print ('Dumping lines failed with error ' + str(Error) + '.')
+                    return image, Error
+            for row in range(start, min(stop, height)):
+                Error = self.SBIG.SBIGUnivDrvCommand(CC_READOUT_LINE, byref(rlp), byref(lineData))
+                if Error != CE_NO_ERROR:
+                    print ('Readout failed with error ' + str(Error) + ' at row ' + str(row) + '.')
+                    return image, Error
+                image[row, first_col:stop_col] = np.ctypeslib.as_array(lineData)
+            next_row = stop
+        return image, Error
+
     def write_fits(self, image, name):
         """
         Writes out image to a FITS file with name 'name'
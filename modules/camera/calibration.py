@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+'''Master bias and dark frames for a camera, kept in memory (or memory-mapped files) and
+reused across images, rather than read from disk or re-exposed for every image.
+
+Each master is the pixel-by-pixel median of n_frames exposures with the shutter closed.
+Masters are keyed by exposure time and CCD temperature (in bins of temperature_tol).
+When one is requested, the camera's current temperature is queried, and the matching
+master is returned if it exists and is younger than max_age. Otherwise (i.e. it is
+stale), fresh exposures are taken and it is replaced.
+
+The bias is just the master dark at the shortest exposure time, bias_exposure_time.
+A master dark at a longer exposure time includes the bias, so an image is corrected by
+subtracting either the master bias or the master dark at its exposure time, not both.
+
+Exposures are combined in streaming fashion: each one is written into a preallocated
+stack of raw frames as it is read out (memory-mapped on disk if cache_dir is set), and
+the median is then taken in strips of rows, to bound memory use.
+
+Raw frames are corrected by FrameCorrector, which subtracts the master into one of a
+ring of preallocated buffers, rather than allocating new full-size arrays per frame.
+
+Example:
+    import calibration
+    cal = calibration.CalibrationManager(expose, temperature, cache_dir=save_dir)
+    frames = calibration.FrameCorrector()
+    image = frames.correct(raw, cal.bias())              # or...
+    image = frames.correct(raw, cal.dark(exposure_time))
+'''
+import os
+import glob
+import time
+import numpy as np
+import clock
+
+
+class CalibrationManager(object):
+    '''Takes, caches and refreshes master calibration frames.
+
+    INPUTS:
+        expose ... function(exposure_time) --> raw image, taking a dark exposure (shutter
+                   closed) of exposure_time [ms], in the same orientation as light images
+        temperature ... function() --> [C] current CCD temperature, or None if unknown
+        n_frames ... number of exposures median-combined into each master
+        bias_exposure_time ... [ms] exposure time of bias frames, i.e. the camera's minimum
+        temperature_tol ... [C] width of temperature bins, for which separate masters are kept
+        max_age ... [s] age after which a master is stale and retaken
+        cache_dir ... directory for memory-mapped masters, from which they are also reloaded
+                      by later runs (if not stale), or None to keep them in memory only
+        printfunc ... function handle, to specify alternate to print (i.e. your logger)
+    '''
+    def __init__(self, expose, temperature=lambda: None, n_frames=9, bias_exposure_time=90,
+                 temperature_tol=1.0, max_age=3600., cache_dir=None, printfunc=print):
+        self.expose = expose
+        self.temperature = temperature
+        self.n_frames = n_frames
+        self.bias_exposure_time = bias_exposure_time
+        self.temperature_tol = temperature_tol
+        self.max_age = max_age
+        self.cache_dir = cache_dir
+        self.printfunc = printfunc
+        self.masters = {}  # keys = (exposure time, temperature bin), values = (frame, created time)
+        self.rows_per_strip = 128  # rows of the stack at a time, when taking the median
+
+    def bias(self):
+        '''Returns int32 master bias frame, for the current CCD temperature.'''
+        return self.dark(self.bias_exposure_time)
+
+    def dark(self, exposure_time):
+        '''Returns int32 master dark frame (which includes the bias) for exposure_time [ms]
+        and the current CCD temperature. Takes new exposures if the master is stale.'''
+        key = (int(exposure_time), self._temperature_bin(self.temperature()))
+        if key not in self.masters and self.cache_dir:
+            self._load(key)
+        if key in self.masters:
+            frame, created = self.masters[key]
+            if clock.time() - created <= self.max_age:
+                return frame
+        return self.refresh(key[0])
+
+    def refresh(self, exposure_time):
+        '''Takes n_frames new dark exposures of exposure_time [ms] and replaces the master
+        for the current CCD temperature. Returns the new master.'''
+        temperature = self.temperature()
+        key = (int(exposure_time), self._temperature_bin(temperature))
+        self.printfunc(f'Taking {self.n_frames} exposures of {key[0]} ms for master '
+                       f'{"bias" if key[0] == self.bias_exposure_time else "dark"} at CCD temperature {temperature} C')
+        frames = (self.expose(key[0]) for i in range(self.n_frames))
+        scratch = self._path(key, 'stack') if self.cache_dir else None
+        master = median_combine(frames, self.n_frames, scratch, self.rows_per_strip)
+        if self.cache_dir:
+            # a new file per refresh, since a mapped file can't be replaced on Windows
+            self.masters.pop(key, None)
+            old_paths = self._paths(key)
+            path = self._path(key, suffix=f'_{time.time_ns()}')
+            np.save(path, master)
+            master = np.load(path, mmap_mode='r')
+            for old_path in old_paths:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass  # still mapped by a frame in use, so left to a later refresh
+        self.masters[key] = (master, clock.time())
+        return master
+
+    def clear(self):
+        '''Forgets all masters in memory, so they are retaken (or reloaded) on next use.'''
+        self.masters = {}
+
+    def _temperature_bin(self, temperature):
+        if temperature is None:
+            return None
+        return int(round(temperature / self.temperature_tol))
+
+    def _path(self, key, kind='master', suffix=''):
+        exposure_time, temperature_bin = key
+        temperature = 'unknown' if temperature_bin is None else format(temperature_bin * self.temperature_tol, '.1f')
+        return os.path.join(self.cache_dir, f'calibration_{kind}_{exposure_time}ms_{temperature}C{suffix}.npy')
+
+    def _paths(self, key):
+        '''Saved master files for key, oldest first.'''
+        return sorted(glob.glob(self._path(key, suffix='_*')), key=os.path.getmtime)
+
+    def _load(self, key):
+        '''Memory-maps the latest master saved by an earlier run, with its age from the file time.'''
+        paths = self._paths(key)
+        if paths:
+            age = time.time() - os.path.getmtime(paths[-1])
+            self.masters[key] = (np.load(paths[-1], mmap_mode='r'), clock.time() - age)
+
+
+class FrameCorrector(object):
+    '''Subtracts master calibration frames from raw frames, into a ring of preallocated
+    int32 buffers, so that no full-size arrays are allocated per frame. Keep one per camera.
+
+    INPUTS:
+        n_buffers ... number of corrected frames which may be in use at once. The default
+                      covers FVCHandler.measure_stream(): one frame being centroided, one
+                      waiting in its queue, and one being acquired.
+    '''
+    def __init__(self, n_buffers=3):
+        self.n_buffers = n_buffers
+        self.buffers = []
+        self.next = 0
+
+    def correct(self, raw, master=None):
+        '''Returns int32 frame raw - master (or just raw, if master is None), written into
+        the next buffer of the ring. It is overwritten after n_buffers more calls. Argue
+        raw in the same orientation as master, e.g. a flipped view of the camera's image.'''
+        raw = np.asarray(raw)
+        if not self.buffers or self.buffers[0].shape != raw.shape:
+            self.buffers = [np.empty(raw.shape, dtype=np.int32) for i in range(self.n_buffers)]
+            self.next = 0
+        out = self.buffers[self.next]
+        self.next = (self.next + 1) % self.n_buffers
+        if master is None:
+            np.copyto(out, raw, casting='unsafe')
+        else:
+            np.subtract(raw, master, out=out, casting='unsafe')
+        return out
+
+
+def median_combine(frames, n_frames, scratch=None, rows_per_strip=128):
+    '''Returns int32 pixel-by-pixel median of n_frames images from iterable frames (e.g. a
+    generator taking each exposure as it is needed). Frames are copied one at a time into
+    a stack of their own dtype, which is memory-mapped to file scratch if argued (and
+    deleted afterwards). The median is then taken over strips of rows_per_strip rows.'''
+    stack = None
+    n = 0
+    try:
+        for frame in frames:
+            frame = np.asarray(frame)
+            if stack is None:
+                shape = (n_frames,) + frame.shape
+                if scratch:
+                    stack = np.lib.format.open_memmap(scratch, mode='w+', dtype=frame.dtype, shape=shape)
+                else:
+                    stack = np.empty(shape, dtype=frame.dtype)
+            stack[n] = frame
+            n += 1
+        assert n > 0, 'no frames to combine'
+        master = np.empty(stack.shape[1:], dtype=np.int32)
+        for start in range(0, master.shape[0], rows_per_strip):
+            strip = np.median(stack[:n, start:start + rows_per_strip], axis=0)
+            np.rint(strip, out=strip)
+            master[start:start + rows_per_strip] = strip
+        return master
+    finally:
+        del stack
+        if scratch and os.path.isfile(scratch):
+            os.remove(scratch)
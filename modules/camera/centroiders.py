@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+'''Centroiding of spots in camera images, independent of the camera which took them.
+
+Each backend is a subclass of Centroider, registered by name, so that camera drivers
+and test scripts can select one with a string:
+
+    gaussian ... 2d gaussian fit to each spot, one at a time (multicens.multiCens)
+    batch_gaussian ... same, but all spots fit at once (msgfitter.fitgaussians)
+    center_of_mass ... background-subtracted center of mass in a box around each spot
+    quadratic ... quadratic interpolation of the log of the peak pixel and its 4
+                  neighbors, which is exact for a gaussian spot sampled at its peak
+
+All backends take a bias-subtracted image, and return the same lists as multiCens.
+Spots are found either by full-frame detection (the largest regions above 10% of the
+brightest pixel), or near argued guesses of their pixel positions.
+
+Example:
+    import centroiders
+    cen = centroiders.get('quadratic', size_fitbox=4)
+    xcen, ycen, peaks, fwhms, binfile = cen.centroid(img, n_spots)            # full-frame detection
+    xcen, ycen, peaks, fwhms, binfile = cen.centroid(img, n_spots, xy_guess)  # near guesses
+
+For choosing a backend by speed and precision, benchmark() runs any of them over the
+same frames, and reports time per frame and centroid errors. See also the script
+bin/analysis/centroider_benchmark.py.
+
+Pixel convention is the same as multiCens: x is the column and y the row of a pixel.
+'''
+import os
+import sys
+import numpy as np
+import mahotas as mh
+from scipy.ndimage import find_objects
+from scipy.spatial import cKDTree
+this_file_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.join(this_file_dir, 'SBIG'))  # for multicens
+import clock
+import multicens
+
+registry = {}  # keys = backend name, values = Centroider subclass
+
+
+def register(cls):
+    '''Class decorator, adding a Centroider subclass to the registry under its name.'''
+    registry[cls.name] = cls
+    return cls
+
+
+def get(name, **kwargs):
+    '''Returns an instance of the named backend. Keyword args are as for Centroider.'''
+    assert name in registry, f'unknown centroider {name} (valid options are {list(registry)})'
+    return registry[name](**kwargs)
+
+
+class Centroider(object):
+    '''Base class for centroiding backends. Subclasses set name and implement measure().
+
+    INPUTS:
+        size_fitbox ... 1/2 length of side of box around each spot, in pixels
+        search_radius ... when guessed positions are argued, spots are searched for within
+                          this many pixels of them, default 2 * size_fitbox
+        nsigma ... detection threshold near guesses, in units of the local noise
+        verbose ... whether to print details
+        write_fits ... whether to write the binary image of detected spots (gaussian backends only)
+        save_dir ... directory for any FITS files written
+        parallel ... whether to fit spots in a pool of processes (gaussian backends only, see multicens)
+        roi ... (row bands, column range) read out, as in the camera drivers' set_roi(), or None
+                for the whole image. Pixels not read out are excluded from the hot pixel statistics.
+    '''
+    name = None
+
+    def __init__(self, size_fitbox=4, search_radius=None, nsigma=10, verbose=False, write_fits=False, save_dir='', parallel=None,
+                 roi=None):
+        self.size_fitbox = size_fitbox
+        self.search_radius = 2 * size_fitbox if search_radius is None else search_radius
+        self.nsigma = nsigma
+        self.verbose = verbose
+        self.write_fits = write_fits
+        self.save_dir = save_dir
+        self.parallel = parallel
+        self.roi = roi
+
+    def centroid(self, img, n_spots=1, xy_guess=None):
+        '''Finds and centroids spots in bias-subtracted image img (which may be modified).
+
+        INPUTS:
+            n_spots ... number of spots to find
+            xy_guess ... optional list of [x,y] guessed spot positions in pixels. If argued,
+                         spots are only searched for near these, with full-frame detection
+                         for the number of any not found
+
+        RETURNS
+            xcen, ycen ... lists of centroid coordinates
+            peaks ... list of peak brightnesses, above background
+            fwhms ... list of full-width half-maxes
+            binfile ... filename of binary image produced, if any
+        '''
+        img = np.asarray(img)
+        np.clip(img, 0, None, out=img)
+        if xy_guess is None:
+            px, py = detect_spots(img, n_spots, roi=self.roi)
+        else:
+            px, py, found = find_near(img, xy_guess, self.size_fitbox, self.search_radius, self.nsigma)
+            if self.verbose:
+                for x, y in np.reshape(xy_guess, (-1, 2))[~found]:
+                    print('no spot found near guess (' + str(x) + ', ' + str(y) + ')')
+            px, py = px[found], py[found]
+            n_missing = len(found) - len(px)
+            if n_missing:
+                print('guided centroiding found no spot near ' + str(n_missing) + ' guesses, falling back to full-frame detection')
+                masked = np.array(img, copy=True)
+                for x, y in zip(px, py):  # only the fit boxes, so that close neighbors remain
+                    masked[max(y - self.size_fitbox, 0):y + self.size_fitbox + 1,
+                           max(x - self.size_fitbox, 0):x + self.size_fitbox + 1] = 0
+                more_x, more_y = detect_spots(masked, n_missing, roi=self.roi)
+                px, py = np.append(px, more_x), np.append(py, more_y)
+        boxes, x0, y0 = cut_boxes(img, px, py, self.size_fitbox)
+        boxes = boxes - background(boxes)[:, None, None]
+        dx, dy, peaks, fwhms = self.measure(boxes)
+        return list(x0 + dx), list(y0 + dy), list(peaks), list(fwhms), []
+
+    def measure(self, boxes):
+        '''Returns arrays (x, y, peak, fwhm) for a stack of background-subtracted boxes of
+        shape (N, 2 * size_fitbox + 1, 2 * size_fitbox + 1), centered on each spot's
+        brightest pixel, with x and y relative to the box's corner pixel.'''
+        raise NotImplementedError
+
+
+@register
+class GaussianCentroider(Centroider):
+    '''2d gaussian fit to each spot, with multicens.multiCens (or guidedCens).'''
+    name = 'gaussian'
+    batch_fit = False
+
+    def centroid(self, img, n_spots=1, xy_guess=None):
+        args = dict(save_dir=self.save_dir, size_fitbox=self.size_fitbox, batch_fit=self.batch_fit, parallel=self.parallel,
+                    roi=self.roi)
+        if xy_guess is not None:
+            return multicens.guidedCens(img, xy_guess, self.verbose, self.write_fits, search_radius=self.search_radius, **args)
+        return multicens.multiCens(img, n_spots, self.verbose, self.write_fits, **args)
+
+
+@register
+class BatchGaussianCentroider(GaussianCentroider):
+    '''2d gaussian fit to all spots at once, with msgfitter.fitgaussians.'''
+    name = 'batch_gaussian'
+    batch_fit = True
+
+
+@register
+class CenterOfMassCentroider(Centroider):
+    '''Center of mass of each box, with the second moments giving the fwhm.'''
+    name = 'center_of_mass'
+
+    def measure(self, boxes):
+        weights = np.clip(boxes, 0, None)
+        total = weights.sum(axis=(1, 2))
+        total = np.where(total > 0, total, 1.)
+        rows, cols = np.indices(boxes.shape[1:])
+        x = (weights * cols).sum(axis=(1, 2)) / total
+        y = (weights * rows).sum(axis=(1, 2)) / total
+        var_x = (weights * (cols - x[:, None, None])**2).sum(axis=(1, 2)) / total
+        var_y = (weights * (rows - y[:, None, None])**2).sum(axis=(1, 2)) / total
+        fwhm = 2.355 * np.sqrt(np.maximum(var_x, var_y))
+        return x, y, boxes.max(axis=(1, 2)), fwhm
+
+
+@register
+class QuadraticCentroider(Centroider):
+    '''Peak interpolated along each axis by a parabola through the log of the brightest
+    pixel and its two neighbors. Where that fails (e.g. neighbors at or below background),
+    the brightest pixel's own position is returned.'''
+    name = 'quadratic'
+
+    def measure(self, boxes):
+        c = self.size_fitbox
+        floor = 1e-3 * np.maximum(boxes[:, c, c], 1.)
+        logs = np.log(np.maximum(boxes, floor[:, None, None]))
+        peak = logs[:, c, c]
+        x, var_x, shift_x = self._interpolate(logs[:, c, c - 1], peak, logs[:, c, c + 1])
+        y, var_y, shift_y = self._interpolate(logs[:, c - 1, c], peak, logs[:, c + 1, c])
+        fwhm = 2.355 * np.sqrt(np.maximum(var_x, var_y))
+        return c + x, c + y, np.exp(peak + shift_x + shift_y), fwhm
+
+    @staticmethod
+    def _interpolate(left, center, right):
+        '''Returns (offset, variance, log peak increase) of the parabola through three
+        equally spaced log values, or (0, nan, 0) where it does not open downwards.'''
+        curvature = left - 2 * center + right
+        ok = curvature < 0
+        safe = np.where(ok, curvature, -1.)
+        offset = np.where(ok, np.clip(0.5 * (left - right) / safe, -0.5, 0.5), 0.)
+        variance = np.where(ok, -1. / safe, np.nan)
+        return offset, variance, np.where(ok, -0.5 * curvature * offset**2, 0.)
+
+
+def background(boxes):
+    '''Median of the border pixels of each box in a stack of shape (N, h, w).'''
+    border = np.concatenate([boxes[:, 0, :], boxes[:, -1, :], boxes[:, 1:-1, 0], boxes[:, 1:-1, -1]], axis=1)
+    return np.median(border, axis=1)
+
+
+def cut_boxes(img, px, py, half):
+    '''Returns stack of boxes of shape (N, 2 * half + 1, 2 * half + 1) around pixels px,
+    py (integer arrays), and arrays (x0, y0) of each box's corner pixel. Boxes which
+    would cross the edge of the image are shifted inside it.'''
+    height, width = np.shape(img)
+    x0 = np.clip(np.asarray(px, dtype=int) - half, 0, width - 2 * half - 1)
+    y0 = np.clip(np.asarray(py, dtype=int) - half, 0, height - 2 * half - 1)
+    offsets = np.arange(2 * half + 1)
+    rows = y0[:, None, None] + offsets[None, :, None]
+    cols = x0[:, None, None] + offsets[None, None, :]
+    return np.asarray(img[rows, cols], dtype=float), x0, y0
+
+
+def detect_spots(img, n_spots, level_fraction=0.1, roi=None):
+    '''Full-frame spot detection, as in multicens.multiCens: after removing hot pixels (with
+    statistics from the pixels read out in roi, if argued), the n_spots largest connected
+    regions above level_fraction of the brightest pixel are taken as spots. Returns integer
+    arrays (px, py) of the brightest pixel in each.'''
+    img = multicens.remove_hot_pixels(img, 7, roi=roi)
+    bw = np.greater(img, level_fraction * np.max(img), out=multicens.scratch('bw', img.shape, bool))
+    labeled, nr_objects = mh.label(bw, out=multicens.scratch('labeled', img.shape, np.int32))
+    sizes = mh.labeled.labeled_size(labeled)
+    good = np.argsort(sizes[1:])[::-1][:n_spots] + 1  # skipping the background region
+    if not len(good):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    slices = find_objects(labeled)
+    px, py = np.zeros(len(good), dtype=int), np.zeros(len(good), dtype=int)
+    for k, label in enumerate(good):
+        rows, cols = slices[label - 1]
+        region = np.where(labeled[rows, cols] == label, img[rows, cols], -np.inf)
+        iy, ix = np.unravel_index(np.argmax(region), region.shape)
+        px[k], py[k] = cols.start + ix, rows.start + iy
+    return px, py
+
+
+def find_near(img, xy_guess, size_fitbox, search_radius, nsigma=10):
+    '''Finds the spot nearest to each guessed [x,y] position, as in multicens.localCens:
+    the local maximum within search_radius of the guess which is more than nsigma * noise
+    above the window's background (multicens.nearest_peak), ignoring isolated hot pixels.
+    Where several guesses find the same peak, only the nearest keeps it
+    (multicens.unique_peaks). Returns integer arrays (px, py), and boolean array found.'''
+    xy = np.reshape(np.asarray(xy_guess, dtype=float), (-1, 2))
+    gx, gy = np.round(xy[:, 0]).astype(int), np.round(xy[:, 1]).astype(int)
+    half = search_radius + size_fitbox
+    windows, x0, y0 = cut_boxes(img, gx, gy, half)
+    n = len(windows)
+    flat = windows.reshape(n, -1)
+    level = np.median(flat, axis=1)
+    noise = np.maximum(1.4826 * np.median(np.abs(flat - level[:, None]), axis=1), 1.0)
+    threshold = (level + nsigma * noise)[:, None, None]
+    windows = multicens.replace_isolated_pixels(windows, threshold)
+    rows, cols = np.indices(windows.shape[1:])
+    searched = ((np.abs(rows[None] - (gy - y0)[:, None, None]) <= search_radius)
+                & (np.abs(cols[None] - (gx - x0)[:, None, None]) <= search_radius))
+    iy, ix = np.zeros(n, dtype=int), np.zeros(n, dtype=int)
+    found = np.zeros(n, dtype=bool)
+    for i in range(n):
+        peak = multicens.nearest_peak(windows[i], gy[i] - y0[i], gx[i] - x0[i], threshold[i, 0, 0], searched[i])
+        if peak is not None:
+            iy[i], ix[i] = peak
+            found[i] = True
+    px, py = x0 + ix, y0 + iy
+    return px, py, multicens.unique_peaks(px, py, gx, gy, found)
+
+
+def benchmark(frames, n_spots, truths=None, names=None, reference='gaussian', match_radius=None,
+              guesses=False, printfunc=print, **kwargs):
+    '''Runs centroiding backends over the same bias-subtracted frames, and reports time per
+    frame and centroid errors, so that a backend can be chosen by measured cost and precision.
+
+    INPUTS:
+        frames ... list of images
+        n_spots ... number of spots in each frame
+        truths ... list of arrays of true [x,y] spot positions in pixels, one per frame (e.g.
+                   from a simulated camera). If None (e.g. for archived frames), errors are
+                   measured relative to the reference backend's centroids instead.
+        names ... list of backend names, default all registered
+        reference ... backend whose centroids stand in for truth, if truths is None
+        match_radius ... [px] max distance for a centroid to count as found, default size_fitbox
+        guesses ... whether to centroid near the (true or reference) positions, rather than
+                    with full-frame detection
+        printfunc ... function handle, to specify alternate to print (i.e. your logger)
+        kwargs ... passed to each backend's constructor, e.g. size_fitbox
+
+    RETURNS
+        dict with keys = backend name and values = dict of 'time_per_frame' [s], 'rms_error' and
+        'max_error' [px] over all found spots, 'num_found' and 'num_missed' (summed over frames)
+    '''
+    names = list(registry) if names is None else names
+    if truths is None:
+        ref = get(reference, **kwargs)
+        truths = [np.column_stack(ref.centroid(np.array(frame, copy=True), n_spots)[:2]) for frame in frames]
+    gate = match_radius if match_radius else kwargs.get('size_fitbox', 4)
+    results = {}
+    for name in names:
+        cen = get(name, **kwargs)
+        elapsed = 0.
+        errors = []
+        missed = 0
+        for frame, truth in zip(frames, truths):
+            img = np.array(frame, copy=True)  # backends may modify the image
+            truth = np.reshape(truth, (-1, 2))
+            tic = clock.perf_counter()
+            xcen, ycen = cen.centroid(img, n_spots, truth if guesses else None)[:2]
+            elapsed += clock.perf_counter() - tic
+            if len(xcen):
+                dist = cKDTree(np.column_stack([xcen, ycen])).query(truth)[0]
+            else:
+                dist = np.full(len(truth), np.inf)
+            errors.extend(dist[dist <= gate])
+            missed += np.count_nonzero(dist > gate)
+        errors = np.array(errors)
+        results[name] = {'time_per_frame': elapsed / max(len(frames), 1),
+                         'rms_error': float(np.sqrt(np.mean(errors**2))) if len(errors) else np.nan,
+                         'max_error': float(np.max(errors)) if len(errors) else np.nan,
+                         'num_found': len(errors),
+                         'num_missed': missed}
+    printfunc(f'{"centroider":<16}{"sec/frame":>10}{"rms err":>10}{"max err":>10}{"found":>8}{"missed":>8}')
+    for name, r in results.items():
+        printfunc(f'{name:<16}{r["time_per_frame"]:>10.4f}{r["rms_error"]:>10.4f}{r["max_error"]:>10.4f}'
+                  f'{r["num_found"]:>8}{r["num_missed"]:>8}')
+    return results
@@ -6,11 +6,19 @@ camera to take images, detects dots, and returns centroids.
 import os
 import sys
 import math
+import queue
+import itertools
+import threading
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 this_file_dir = os.path.realpath(os.path.dirname(__file__))
 os.chdir(this_file_dir)
 sys.path.append('../../modules')
 import globals as gl
+import clock
 
 # Supported cameras
 cameras = {
@@ -22,6 +30,10 @@ cameras = {
         'driver_path': None,
         'max_adu_counts': None,
         },
+    'sim_image': {
+        'driver_path': './sim/',
+        'max_adu_counts': 2**16 - 1,
+        },
     }  
 
 # Measurement default parameters
@@ -40,13 +52,25 @@ class FVCHandler():
 
     INPUTS:
         params ... dict, shaped like the 'defaults' dictionary above 
-        take_darks ... boolean, whether to take dark exposures (shutter closed)
+        take_darks ... boolean, whether to subtract master dark frames (shutter closed, see calibration.py),
+                       rather than just the master bias
         save_images ... boolean, whether to save FITS files etc to disk
-        save_biases ... boolean, whether to save bias files to disk 
+        save_biases ... boolean, whether to keep master bias and dark frames in files in the temp directory
+                        (memory-mapped, and reused by later runs), rather than only in memory, in which
+                        case each new process takes fresh bias exposures on its first image
+        ref_model ... 'translation' (default), 'similarity' or 'affine', see correct_using_ref()
+        ref_clip_sigma ... threshold for rejecting outlier reference dots, see correct_using_ref()
+        match_radius ... [mm] max distance between expected and measured dots for identification (None for no limit)
+        optimal_match ... boolean, whether to identify dots by globally optimal assignment, rather than closest first
+        guided_centroids ... boolean, whether measure_and_identify() centroids in small windows around the expected
+                             dots, rather than detecting spots in the full frame (see multicens.guidedCens)
+        roi_margin ... [px] if not None, then measure_and_identify() only reads out the CCD rows within this margin
+                       of the expected dots (see roi_bands). Should exceed the centroiding fitbox, plus the expected error.
+        centroider ... name of centroiding backend for image cameras, see centroiders.registry
         printfunc ... function handle, to specify alternate to print (i.e. your logger)
     ''' 
     def __init__(self, params=defaults, take_darks=False, save_images=False,
-                 save_biases=False, printfunc=print):
+                 save_biases=False, ref_model='translation', ref_clip_sigma=3.0, match_radius=None, optimal_match=False, guided_centroids=False, roi_margin=None, centroider='gaussian', printfunc=print):
         self.camera = params['camera']
         assert self.camera in cameras, f'unknown camera identifier {self.camera} (valid options are {cameras.keys()}'
         self.printfunc = printfunc 
@@ -54,6 +78,15 @@ class FVCHandler():
         self.max_attempts = 3  # max number of times to retry an image measurement (if poor dot quality) before quitting hard
         self.exptime = params['exptime']
         self.fitbox = params['fitbox']
+        assert ref_model in {'translation', 'similarity', 'affine'}, f'unknown ref_model {ref_model}'
+        self.ref_model = ref_model
+        self.ref_clip_sigma = ref_clip_sigma
+        self.ref_transform = np.eye(3)  # latest correction fitted in correct_using_ref()
+        self.ref_outliers = []  # latest reference dots rejected in correct_using_ref()
+        self.match_radius = match_radius
+        self.optimal_match = optimal_match
+        self.guided_centroids = guided_centroids
+        self.roi_margin = roi_margin
         driver_path = cameras[self.camera]['driver_path']
         sys.path.append(driver_path)
         if self.camera == 'SBIG':
@@ -61,7 +94,16 @@ class FVCHandler():
             self.sbig = sbig_grab_cen.SBIG_Grab_Cen(save_dir=gl.dirs['temp'], write_bias=save_biases)
             self.sbig.take_darks = take_darks 
             self.sbig.write_fits = save_images
+            self.sbig.centroider = centroider
+            self.max_counts = cameras[self.camera]['max_adu_counts']
+        elif self.camera == 'sim_image':
+            import sim_grab_cen
+            self.sim_image = sim_grab_cen.Sim_Grab_Cen(save_dir=gl.dirs['temp'], size_fitbox=self.fitbox)
+            self.sim_image.write_fits = save_images
+            self.sim_image.centroider = centroider
+            self.sim_errmax = params['sim_errmax']
             self.max_counts = cameras[self.camera]['max_adu_counts']
+            self.printfunc(f'FVCHandler is in simulated image mode with max 2D errors of size {self.sim_errmax}.')
         elif self.camera == 'sim':
             self.sim_errmax = params['sim_errmax']
             self.sim_badmatchfreq = params['sim_badmatchfreq']
@@ -95,7 +137,9 @@ class FVCHandler():
                 fwhms    ... dict of full-width half-maxes of measured dots
                 imgfiles ... list of image file names (if any) returned by camera 
 
-        Output dicts will be keyed by same identifiers as the input dict 'expected'.
+        Output dicts will be keyed by same identifiers as the input dict 'expected',
+        except for any expected dots which could not be identified (i.e. none measured
+        within match_radius, or all nearby dots better matched to others).
         '''
         ref_keys = set() if not ref_keys else set(ref_keys)
         posids = set(expected) - ref_keys 
@@ -103,29 +147,48 @@ class FVCHandler():
         ordered_keys = list(expected.keys())
         expected_xy = [expected[key] for key in ordered_keys]
         num_objects = len(expected_xy)
-        unsorted_xy, unsorted_peaks, unsorted_fwhms, imgfiles = self.measure(num_objects)
+        if self.camera == 'sim_image': # render the simulated dots near the expected_xy
+            errors = np.random.uniform(-self.sim_errmax, self.sim_errmax, size=np.shape(expected_xy))
+            self.sim_image.spots_px = self.obs_to_fvc((np.array(expected_xy) + errors).tolist())
+        imager = self._imager()
+        expected_px = self.obs_to_fvc(expected_xy) if imager is not None else None
+        use_roi = imager is not None and self.roi_margin is not None
+        if use_roi:
+            bands, columns = roi_bands(expected_px, self.roi_margin, imager.frame_shape)
+            imager.set_roi(bands, columns)
+        guess_px = expected_px if self.guided_centroids else None
+        try:
+            unsorted_xy, unsorted_peaks, unsorted_fwhms, imgfiles = self.measure(num_objects, guess_px)
+        finally:
+            if use_roi:
+                imager.set_roi(None, None)
         if self.camera == 'sim': # redo simulated measurements to be near the expected_xy
             jumbled_xy = expected_xy.copy()
-            random.shuffle(jumbled_xy)
+            np.random.shuffle(jumbled_xy)
             for i, xy in enumerate(jumbled_xy):
-                if random.uniform() < self.sim_badmatchfreq:
+                if np.random.uniform() < self.sim_badmatchfreq:
                     unsorted_xy[i] = [0, 0]
                 else:
-                    unsorted_xy[i] = [xy[j] + random.uniform(-self.sim_errmax, self.sim_errmax) for j in [0,1]] 
-        sorted_xyraw, sorted_idxs = self.sort_by_closeness(unsorted_xy, expected_xy)
-        sorted_peaks = [unsorted_peaks[i] for i in sorted_idxs]
-        sorted_fwhms = [unsorted_fwhms[i] for i in sorted_idxs]
-        xyraw = {ordered_keys[i]: sorted_xyraw[i] for i in range(len(sorted_xyraw))}
-        peaks = {ordered_keys[i]: sorted_peaks[i] for i in range(len(sorted_peaks))}
-        fwhms = {ordered_keys[i]: sorted_fwhms[i] for i in range(len(sorted_fwhms))}
-        measured = self.correct_using_ref(xyraw, expected, ref_keys)
+                    unsorted_xy[i] = [xy[j] + np.random.uniform(-self.sim_errmax, self.sim_errmax) for j in [0,1]] 
+        sorted_xyraw, sorted_idxs, unmatched, unexpected = self.sort_by_closeness(
+            unsorted_xy, expected_xy, optimal=self.optimal_match, max_distance=self.match_radius)
+        if unmatched or unexpected:
+            self.printfunc(f'Dot identification: {len(unmatched)} expected dots not found {[ordered_keys[i] for i in unmatched]}, '
+                           f'{len(unexpected)} unexpected dots at {[unsorted_xy[i] for i in unexpected]}')
+        matched = [i for i in range(len(ordered_keys)) if sorted_idxs[i] is not None]
+        xyraw = {ordered_keys[i]: sorted_xyraw[i] for i in matched}
+        peaks = {ordered_keys[i]: unsorted_peaks[sorted_idxs[i]] for i in matched}
+        fwhms = {ordered_keys[i]: unsorted_fwhms[sorted_idxs[i]] for i in matched}
+        measured = self.correct_using_ref(xyraw, expected, ref_keys & set(xyraw))
         return measured, peaks, fwhms, imgfiles
 
-    def measure(self, num_objects=1):
+    def measure(self, num_objects=1, guess_px=None):
         '''Calls for an FVC image capture, transforms the centroids from pixels into
         the units and orientation of the object plane.
 
         INPUTS:  num_objects ... number of dots to look for in the captured image
+                 guess_px ... optional list of (x,y) guessed dot positions on the CCD, in
+                              pixels, to centroid around instead of full-frame detection
 
         Outputs are lists of:
             (x,y) centroids
@@ -133,15 +196,104 @@ class FVCHandler():
             full-width half-maxes
             paths to any image files 
         '''
-        xy_px, peaks, fwhms, imgfiles = self.measure_fvc_pixels(num_objects)
+        xy_px, peaks, fwhms, imgfiles = self.measure_fvc_pixels(num_objects, guess_px=guess_px)
         xy_mm = self.fvc_to_obs(xy_px)
         return xy_mm, peaks, fwhms, imgfiles
 
-    def measure_fvc_pixels(self, num_objects, attempt=1):
+    def measure_stream(self, num_objects=1, num_frames=None):
+        '''Generator for repeated measurements, double-buffered so that the camera
+        acquires image N+1 (in a separate thread) while image N is being centroided.
+        With cameras that produce no images (i.e. 'sim'), the measurements are simply
+        made in sequence.
+
+        Unlike measure(), poor dot quality is only reported (in the metadata and to
+        printfunc), without retries, so as not to stall the stream.
+
+        INPUTS:  num_objects ... number of dots to look for in each image
+                 num_frames ... number of measurements to make, or None to continue
+                                until the caller stops iterating
+
+        Yields tuples of:
+            (x,y) centroids, peak brightness values, full-width half-maxes, and paths
+            to any image files, all as from measure(), plus
+            meta ... dict of per-frame metadata: 'frame' index, clock times
+                     'acquire_start', 'acquire_end', 'centroid_end' [s], and
+                     boolean 'poor_quality'
+        '''
+        imager = self._imager()
+        frames = range(num_frames) if num_frames is not None else itertools.count()
+        if not imager:
+            for i in frames:
+                start = clock.time()
+                xy_mm, peaks, fwhms, imgfiles = self.measure(num_objects)
+                end = clock.time()
+                meta = {'frame': i, 'acquire_start': start, 'acquire_end': end, 'centroid_end': end, 'poor_quality': False}
+                yield xy_mm, peaks, fwhms, imgfiles, meta
+            return
+        imager.exposure_time = self.exptime * 1000  # milliseconds
+        if self.camera == 'sim_image' and not len(imager.spots_px):
+            imager.place_random_spots(num_objects)
+        buffer = queue.Queue(maxsize=1)  # acquired images waiting to be centroided
+        stop = threading.Event()
+        def put(item):
+            while not stop.is_set():
+                try:
+                    buffer.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        def acquire():
+            try:
+                for i in frames:
+                    start = clock.time()
+                    image, imgfiles = imager.acquire()
+                    if not put((i, image, imgfiles, start, clock.time())):
+                        return
+            except Exception as err:
+                put(err)
+                return
+            put(None)
+        producer = threading.Thread(target=acquire, daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = buffer.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                i, image, imgfiles, start, end = item
+                xy_px, peaks, fwhms, binfile = imager.centroid(image, num_objects)
+                del image
+                if binfile:
+                    imgfiles.append(binfile)
+                peaks = [x/self.max_counts for x in peaks]
+                meta = {'frame': i, 'acquire_start': start, 'acquire_end': end, 'centroid_end': clock.time()}
+                energies = [peaks[j] * fwhms[j] for j in range(len(peaks))]
+                meta['poor_quality'] = any([e < self.min_energy for e in energies])
+                if meta['poor_quality']:
+                    self.printfunc(f'Poor dot quality found on image {i}. Gaussian fit peak * energy was {min(energies)} which is less than the minimum threshold {self.min_energy}')
+                yield self.fvc_to_obs(xy_px), peaks, fwhms, imgfiles, meta
+        finally:
+            stop.set()
+            producer.join()
+
+    def _imager(self):
+        '''Returns the object which acquires and centroids images, or None for cameras
+        which produce no images.'''
+        if self.camera == 'SBIG':
+            return self.sbig
+        elif self.camera == 'sim_image':
+            return self.sim_image
+        return None
+
+    def measure_fvc_pixels(self, num_objects, attempt=1, guess_px=None):
         """Gets a measurement from the fiber view camera of the centroid positions
         of all the dots of light landing on the CCD.
         
         INPUTS:  num_objects ... integer, number of dots FVC should look for
+                 guess_px ... optional list of (x,y) guessed dot positions in pixels
         
         OUTPUT:  xy          ... list of measured dot (x,y) positions in FVC pixel coordinates
                  peaks       ... list of the peak brightness values for each dot
@@ -156,7 +308,11 @@ class FVCHandler():
         imgfiles = []
         if self.camera == 'SBIG':
             self.sbig.exposure_time = self.exptime * 1000  # sbig_grab_cen thinks in milliseconds
-            xy, peaks, fwhms, elapsed_time, imgfiles = self.sbig.grab(num_objects)
+            xy, peaks, fwhms, elapsed_time, imgfiles = self.sbig.grab(num_objects, xy_guess=guess_px)
+            peaks = [x/self.max_counts for x in peaks]
+        elif self.camera == 'sim_image':
+            self.sim_image.exposure_time = self.exptime * 1000  # milliseconds, like sbig_grab_cen
+            xy, peaks, fwhms, elapsed_time, imgfiles = self.sim_image.grab(num_objects, xy_guess=guess_px)
             peaks = [x/self.max_counts for x in peaks]
         elif self.camera == 'sim':
             xy = np.random.uniform(low=0, high=1000, size=(num_objects,2)).tolist()
@@ -167,7 +323,7 @@ class FVCHandler():
         if any([e < self.min_energy for e in energies]):
             self.printfunc(f'Poor dot quality found on image attempt {attempt} of {self.max_attempts}. Gaussian fit peak * energy was {min(energies)} which is less than the minimum threshold {self.min_energy}')
             if attempt < self.max_attempts:
-                return self.measure_fvc_pixels(num_objects, attempt + 1)
+                return self.measure_fvc_pixels(num_objects, attempt + 1, guess_px)
             else:
                 self.printfunc(f'Max attempts {self.max_attempts} reached and still poor dot quality.')
                 sys.exit(0)
@@ -177,48 +333,136 @@ class FVCHandler():
         '''Calculates a correction to transform measured reference dots into expected,
         and then applies this to all the measured xy values.
 
+        The correction is a least-squares fit, of the model self.ref_model, reduced
+        as necessary for the number of reference dots available:
+            0 refs  ... no correction
+            1 ref   ... translation
+            2+ refs ... translation, rotation and scale ('similarity')
+            3+ refs ... full 'affine' (only if self.ref_model == 'affine')
+        Reference dots whose residuals are more than self.ref_clip_sigma standard
+        deviations (estimated robustly) from the fit are rejected, and the fit is
+        repeated, so long as enough reference dots remain for the model.
+
+        The fitted 3x3 matrix is stored in self.ref_transform, and the keys of any
+        rejected reference dots in self.ref_outliers.
+
         INPUTS:  measured ... dict with keys = identifiers, values = [x,y] pairs
                  expected ... dict with keys = identifiers, values = [x,y] pairs
                  ref_keys ... set of keys indicating which dots are reference fiducials
 
         OUTPUT:  dict with keys = identifiers, values = [x,y] pairs
         '''
-        assert all([key in measured and key in expected for key in ref_keys]), f'missing ref_key {ref_key}'
-        x_shift, y_shift = 0, 0
-        if any(ref_keys):
-            x_diff = [measured[key][0] - expected[key][0] for key in ref_keys]
-            y_diff = [measured[key][1] - expected[key][1] for key in ref_keys]
-            x_shift = np.median(x_diff)
-            y_shift = np.median(y_diff)
-            # If we have two or more ref dots that are widely enough spaced, consider
-            # applying rotation and scale corrections here. You'd especially want to
-            # check for "widely-enough spaced", to ensure measurement noise isn't
-            # significant.
-        corrected = [[measured[key][0] + x_shift, measured[key][1] + y_shift] for key in measured]
-        return corrected
-
-    def sort_by_closeness(self, unknown_xy, expected_xy):
+        missing = [key for key in ref_keys if key not in measured or key not in expected]
+        assert not missing, f'missing ref_keys {missing}'
+        keys = list(ref_keys)
+        src = np.array([measured[key] for key in keys], dtype=float).reshape(-1, 2)
+        dst = np.array([expected[key] for key in keys], dtype=float).reshape(-1, 2)
+        models = ['translation', 'similarity', 'affine']
+        model = models[min(models.index(self.ref_model), max(len(keys) - 1, 0), 2)]
+        min_refs = models.index(model) + 1
+        use = np.ones(len(keys), dtype=bool)
+        matrix = np.eye(3)
+        if keys:
+            while True:
+                matrix = fit_transform(src[use], dst[use], model)
+                err = np.hypot(*(apply_transform(matrix, src) - dst).T)
+                sigma = 1.4826 * np.median(err[use])  # robust, assuming mostly good refs
+                reject = use & (err > self.ref_clip_sigma * sigma) & (sigma > 0)
+                if not reject.any() or np.sum(use & ~reject) < min_refs:
+                    break
+                use &= ~reject
+        self.ref_transform = matrix
+        self.ref_outliers = [key for key, ok in zip(keys, use) if not ok]
+        if self.ref_outliers:
+            self.printfunc(f'Rejected reference dots {self.ref_outliers} as outliers from {model} fit')
+        all_keys = list(measured)
+        xy = np.array([measured[key] for key in all_keys], dtype=float).reshape(-1, 2)
+        corrected = apply_transform(matrix, xy)
+        return {key: corrected[i].tolist() for i, key in enumerate(all_keys)}
+
+    def sort_by_closeness(self, unknown_xy, expected_xy, optimal=False, max_distance=None):
         """Sorts the list unknown_xy so that each point is at the same index
         as its closest-distance match in the list expected_xy.
+
+        By default, matches are made greedily, closest pair first, using a KD-tree
+        to find candidates. With optimal=True, the matching instead minimizes the
+        total squared distance over all dots (Hungarian algorithm). Pairs farther
+        apart than max_distance (if argued) are never matched.
+
+        OUTPUT:  xy ... list of unknown points, ordered like expected_xy, with None
+                        for any expected point which was not matched
+                 sorted_idxs ... list of indices into unknown_xy, ordered likewise
+                 unmatched_expected ... list of indices into expected_xy with no match
+                 unexpected ... list of indices into unknown_xy matching no expected point
         """
         if len(unknown_xy) != len(expected_xy):
             self.printfunc(f'unknown_xy length {len(unknown_xy)} != expected_xy length {len(expected_xy)}')
-        xy = [None]*len(expected_xy)
-        sorted_idxs = [None]*len(expected_xy)
-        dist = []
-        for e in expected_xy:
-            delta = np.array(unknown_xy) - np.array(e)
-            dist.append(np.sqrt(np.sum(delta**2,axis=1)).tolist())
-        dist = np.array(dist)
-        for i in range(len(unknown_xy)):
-            min_idx_1D = np.argmin(dist)
-            unknown_min_idx = np.mod(min_idx_1D,len(unknown_xy))
-            expected_min_idx = np.int(np.floor(min_idx_1D/len(expected_xy)))
-            xy[expected_min_idx] = unknown_xy[unknown_min_idx]
-            sorted_idxs[expected_min_idx] = unknown_min_idx
-            dist[expected_min_idx,:] = np.inf # disable used up "expected" row
-            dist[:,unknown_min_idx] = np.inf # disable used up "unknown" column
-        return xy, sorted_idxs
+        unknown = np.reshape(np.array(unknown_xy, dtype=float), (-1, 2))
+        expected = np.reshape(np.array(expected_xy, dtype=float), (-1, 2))
+        gate = np.inf if max_distance is None else max_distance
+        if len(unknown) == 0 or len(expected) == 0:
+            pairs = []
+        elif optimal:
+            pairs = self._match_optimal(unknown, expected, gate)
+        else:
+            pairs = self._match_greedy(unknown, expected, gate)
+        sorted_idxs = [None]*len(expected)
+        for e, u in pairs:
+            sorted_idxs[e] = u
+        xy = [None if u is None else unknown_xy[u] for u in sorted_idxs]
+        unmatched_expected = [e for e, u in enumerate(sorted_idxs) if u is None]
+        unexpected = sorted(set(range(len(unknown))) - {u for e, u in pairs})
+        return xy, sorted_idxs, unmatched_expected, unexpected
+
+    @staticmethod
+    def _match_greedy(unknown, expected, gate, k=4):
+        """Closest-pair-first matching. Candidates are the k nearest unknown points of
+        each expected point. Rounds repeat on the leftovers until no more matches."""
+        pairs = []
+        free_u = np.arange(len(unknown))
+        free_e = np.arange(len(expected))
+        while len(free_u) and len(free_e):
+            kk = min(k, len(free_u))
+            dist, idx = cKDTree(unknown[free_u]).query(expected[free_e], k=kk, distance_upper_bound=gate)
+            dist, idx = np.reshape(dist, (len(free_e), kk)), np.reshape(idx, (len(free_e), kk))
+            e_idx = np.repeat(free_e, kk)
+            ok = np.isfinite(dist.ravel())
+            order = np.argsort(dist.ravel()[ok], kind='stable')
+            used_u, used_e = set(), set()
+            for e, u in zip(e_idx[ok][order], free_u[idx.ravel()[ok][order]]):
+                if e not in used_e and u not in used_u:
+                    pairs.append((int(e), int(u)))
+                    used_e.add(e)
+                    used_u.add(u)
+            if not used_e:
+                break
+            free_u = np.array([u for u in free_u if u not in used_u], dtype=int)
+            free_e = np.array([e for e in free_e if e not in used_e], dtype=int)
+        return pairs
+
+    @staticmethod
+    def _match_optimal(unknown, expected, gate):
+        """Minimum total squared distance matching. With a finite gate, the problem is
+        split into independent clusters of points within gate of one another, each
+        solved separately."""
+        if not np.isfinite(gate):
+            cost = np.sum((expected[:, None, :] - unknown[None, :, :])**2, axis=-1)
+            rows, cols = linear_sum_assignment(cost)
+            return [(int(e), int(u)) for e, u in zip(rows, cols)]
+        near = cKDTree(expected).sparse_distance_matrix(cKDTree(unknown), gate, output_type='coo_matrix')
+        n_e = len(expected)
+        graph = coo_matrix((np.ones(near.nnz), (near.row, n_e + near.col)), shape=(n_e + len(unknown),)*2)
+        n_clusters, labels = connected_components(graph, directed=False)
+        pairs = []
+        big = 1e6 * gate**2 + 1.
+        for c in np.unique(labels[:n_e][np.isin(labels[:n_e], labels[n_e:])]):
+            e_idx = np.flatnonzero(labels[:n_e] == c)
+            u_idx = np.flatnonzero(labels[n_e:] == c)
+            cost = np.sum((expected[e_idx, None, :] - unknown[None, u_idx, :])**2, axis=-1)
+            cost[cost > gate**2] = big  # not allowed
+            rows, cols = linear_sum_assignment(cost)
+            pairs += [(int(e_idx[r]), int(u_idx[k])) for r, k in zip(rows, cols) if cost[r, k] < big]
+        return pairs
 
     def fvc_to_obs(self, xy_px):
         '''Convert a list or tuple of xy values in fvc pixel space to physical
@@ -245,7 +489,7 @@ class FVCHandler():
         xy_scaled = xy_np / self.mm_per_px
         rot = FVCHandler.rotmat2D_deg(-self.angle_deg)
         xy_rotated = np.dot(rot, xy_scaled)
-        xy_translated = xy_rotated - [self.x0_mm, self.y0_mm]
+        xy_translated = xy_rotated - [[self.x0_px], [self.y0_px]]
         xy_px = np.transpose(xy_translated).tolist()
         return xy_px
     
@@ -256,3 +500,62 @@ class FVCHandler():
         return np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
 
 
+def roi_bands(xy_px, margin, shape, min_gap=None):
+    '''Bands of rows and range of columns covering all the points xy_px, within margin.
+
+    INPUTS:  xy_px ... list of (x,y) in pixels
+             margin ... [px] around each point
+             shape ... (rows, columns) of the image
+             min_gap ... bands separated by fewer rows than this are merged, since skipping
+                         a few rows saves little (default 2 * margin)
+
+    OUTPUT:  bands ... list of (start, stop) row ranges, sorted and not overlapping
+             columns ... (start, stop) column range
+    '''
+    xy = np.reshape(np.array(xy_px, dtype=float), (-1, 2))
+    if not len(xy):
+        return None, None
+    height, width = shape
+    min_gap = 2 * margin if min_gap is None else min_gap
+    starts = np.clip(np.floor(xy[:, 1] - margin), 0, height).astype(int)
+    stops = np.clip(np.ceil(xy[:, 1] + margin) + 1, 0, height).astype(int)
+    order = np.argsort(starts)
+    bands = []
+    for start, stop in zip(starts[order], stops[order]):
+        if bands and start <= bands[-1][1] + min_gap:
+            bands[-1][1] = max(bands[-1][1], stop)
+        elif stop > start:
+            bands.append([start, stop])
+    columns = (int(np.clip(np.floor(xy[:, 0].min() - margin), 0, width)),
+               int(np.clip(np.ceil(xy[:, 0].max() + margin) + 1, 0, width)))
+    return [tuple(int(r) for r in band) for band in bands], columns
+
+
+def fit_transform(src, dst, model='similarity'):
+    '''Least-squares fit of a 2D transform taking points src to dst, arrays of shape (N, 2).
+    Model is 'translation', 'similarity' (translation, rotation and scale), or 'affine'.
+    Returns 3x3 homogeneous matrix.'''
+    src, dst = np.asarray(src, dtype=float), np.asarray(dst, dtype=float)
+    matrix = np.eye(3)
+    if model == 'translation':
+        matrix[:2, 2] = np.mean(dst - src, axis=0)
+    elif model == 'similarity':
+        # x' = a*x - b*y + tx, y' = b*x + a*y + ty
+        x, y = src[:, 0], src[:, 1]
+        one, zero = np.ones_like(x), np.zeros_like(x)
+        A = np.concatenate([np.column_stack([x, -y, one, zero]), np.column_stack([y, x, zero, one])])
+        (a, b, tx, ty), *_ = np.linalg.lstsq(A, np.concatenate([dst[:, 0], dst[:, 1]]), rcond=None)
+        matrix[:2] = [[a, -b, tx], [b, a, ty]]
+    elif model == 'affine':
+        A = np.column_stack([src, np.ones(len(src))])
+        params, *_ = np.linalg.lstsq(A, dst, rcond=None)
+        matrix[:2] = params.T
+    else:
+        assert False, f'unknown transform model {model}'
+    return matrix
+
+
+def apply_transform(matrix, xy):
+    '''Applies 3x3 homogeneous matrix to points xy, array of shape (N, 2).'''
+    xy = np.asarray(xy, dtype=float)
+    return xy @ matrix[:2, :2].T + matrix[:2, 2]
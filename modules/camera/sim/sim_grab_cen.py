@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+'''Simulated camera, for running the full image measurement pipeline without hardware.
+
+Renders frames like the SBIG STF-8300M's (3352 x 2532 pixels, uint16), with Gaussian
+spots at argued pixel positions, on top of a bias level, read noise and a fixed set of
+hot pixels, clipped at saturation. The frames are then bias-subtracted and centroided
+by the same centroiders backends used for the real camera, so timings and centroid
+errors are representative of a real measurement.
+
+Same interface as SBIG_Grab_Cen. Set spots_px before each grab, or else the first
+grab places num_objects spots at random (place_random_spots) and keeps them for
+subsequent grabs.
+
+All random draws come from one generator, seeded at construction, so runs are
+reproducible. Exposure time is spent with clock.sleep(), so runs in virtual time
+(see clock.py) only cost the rendering and centroiding.
+'''
+import os
+import sys
+import numpy as np
+from astropy.io import fits
+this_file_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.join(this_file_dir, '..'))  # for centroiders
+import clock
+import centroiders
+import calibration
+import multicens
+
+
+class Sim_Grab_Cen(object):
+    '''Simulated equivalent of sbig_grab_cen.SBIG_Grab_Cen.
+
+    INPUTS:
+        save_dir ... directory for any FITS files written
+        size_fitbox ... gaussian fitter box dimensions are 2*size_fitbox X 2*size_fitbox
+        seed ... for the random number generator
+    '''
+    def __init__(self, save_dir='', size_fitbox=4, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.width = 3352  # pixels
+        self.height = 2532  # pixels
+        self.saturation = 2**16 - 1  # ADU
+        self.bias_level = 1000  # ADU
+        self.bias_column_noise = 5.0  # ADU rms, fixed column-to-column pattern in the bias
+        self.read_noise = 10.0  # ADU rms
+        self.gain = 1.5  # electrons per ADU, for spot shot noise
+        self.hot_pixel_fraction = 2e-5
+        self.hot_pixel_range = [2000, 20000]  # ADU above bias
+        self.spot_peak = 20000.  # ADU at nominal exposure time
+        self.spot_peak_scatter = 0.1  # fractional rms variation in peak brightness between spots
+        self.spot_fwhm = 3.0  # pixels
+        self.spot_fwhm_scatter = 0.1  # fractional rms
+        self.nominal_exposure_time = 200  # milliseconds
+        self.readout_time = 0.0  # seconds, added to each exposure
+        self.spots_px = []  # list of [x,y] spot centers in pixels, for the next grab
+        self.roi = (None, None)  # (row bands, column range) to read out, see set_roi()
+        self.min_brightness = 200
+        self.max_brightness = 60000
+        self.verbose = False
+        self.write_fits = False
+        self.save_dir = save_dir
+        self.size_fitbox = size_fitbox
+        self.centroider = 'gaussian'  # centroiding backend, as in SBIG_Grab_Cen
+        self.parallel = None  # whether to centroid in a pool of processes, as in SBIG_Grab_Cen
+        self.exposure_time = self.nominal_exposure_time
+        self.bias = self._make_bias()
+        self.frames = calibration.FrameCorrector()
+        self.hot_pixels = self._make_hot_pixels()
+        self.bad_pixel_file = os.path.join(save_dir, 'sim_bad_pixel_map.FITS')
+        self.bad_pixels = multicens.load_bad_pixel_map(self.bad_pixel_file)  # (rows, cols), see make_bad_pixel_map()
+
+    def _make_bias(self):
+        '''Master bias frame, as int32, including a fixed column pattern.'''
+        columns = self.rng.normal(0, self.bias_column_noise, self.width)
+        bias = np.round(self.bias_level + columns).astype(np.int32)
+        return np.broadcast_to(bias, (self.height, self.width)).copy()
+
+    def _make_hot_pixels(self):
+        '''Fixed hot pixel (rows, cols, levels), the same in every frame.'''
+        n = int(round(self.hot_pixel_fraction * self.width * self.height))
+        rows = self.rng.integers(0, self.height, n)
+        cols = self.rng.integers(0, self.width, n)
+        levels = self.rng.uniform(*self.hot_pixel_range, n)
+        return rows, cols, levels
+
+    def render(self, spots_px):
+        '''Returns a simulated raw uint16 frame with spots centered at spots_px, a list
+        of [x,y] in pixels. Pixel [row, col] is centered at x = col, y = row.'''
+        frame = self.bias + self.rng.normal(0, self.read_noise, (self.height, self.width)).astype(np.float32)
+        xy = np.reshape(np.array(spots_px, dtype=float), (-1, 2))
+        if len(xy):
+            n = len(xy)
+            exposure_factor = self.exposure_time / self.nominal_exposure_time
+            peaks = self.spot_peak * exposure_factor * (1 + self.spot_peak_scatter * self.rng.standard_normal(n))
+            sigmas = self.spot_fwhm * (1 + self.spot_fwhm_scatter * self.rng.standard_normal(n)) / 2.355
+            sigmas = np.maximum(sigmas, 0.3)
+            r = int(np.ceil(5 * sigmas.max()))
+            offsets = np.arange(-r, r + 1)
+            cols = np.round(xy[:, 0])[:, None, None] + offsets[None, None, :]
+            rows = np.round(xy[:, 1])[:, None, None] + offsets[None, :, None]
+            dist2 = (cols - xy[:, 0, None, None])**2 + (rows - xy[:, 1, None, None])**2
+            signal = np.clip(peaks, 0, None)[:, None, None] * np.exp(-dist2 / (2 * sigmas[:, None, None]**2))
+            signal = self.rng.poisson(signal * self.gain) / self.gain
+            cols, rows = np.broadcast_arrays(cols, rows)
+            inside = (rows >= 0) & (rows < self.height) & (cols >= 0) & (cols < self.width)
+            np.add.at(frame, (rows[inside].astype(int), cols[inside].astype(int)), signal[inside])
+        hot_rows, hot_cols, hot_levels = self.hot_pixels
+        frame[hot_rows, hot_cols] += hot_levels
+        np.clip(frame, 0, self.saturation, out=frame)
+        return np.round(frame).astype(np.uint16)
+
+    def grab(self, nWin=1, n_retries=3, xy_guess=None):
+        """Simulates light image, subtracts bias, then centroids spots.
+
+        INPUTS:
+            nWin       ... integer, number of centroid windows
+            n_retries  ... not used, for compatibility with SBIG_Grab_Cen
+            xy_guess   ... optional list of [x,y] guessed spot positions in pixels, see centroid()
+
+        RETURNS
+            xy         ... list of centroid coordinates for each spot
+            peaks      ... list of values of peak brightness for each spot
+            fwhms      ... list of values of fwhm for each spot
+            time       ... elapsed time in seconds
+            imgfiles   ... filenames of images produced
+        """
+        tic = clock.time()
+        if not len(self.spots_px):
+            self.place_random_spots(nWin)
+        LD, imgfiles = self.acquire()
+        xy, peaks, fwhms, binfile = self.centroid(LD, nWin, xy_guess)
+        if binfile:
+            imgfiles.append(binfile)
+        toc = clock.time()
+        if self.verbose:
+            print('Time used: ' + str(toc - tic) + '\n')
+        return xy, peaks, fwhms, toc - tic, imgfiles
+
+    @property
+    def frame_shape(self):
+        '''(rows, columns) of images returned.'''
+        return (self.height, self.width)
+
+    def set_roi(self, bands=None, columns=None):
+        '''Restricts readout to bands of rows and a range of columns, as in SBIG_Grab_Cen.
+        Pixels not read are zero, and the readout time is reduced in proportion.'''
+        self.roi = (bands, columns)
+        return True
+
+    def _apply_roi(self, frame):
+        '''Zeros the pixels outside the roi. Returns fraction of pixels read.'''
+        bands, columns = self.roi
+        if bands is None and columns is None:
+            return 1.0
+        read = np.zeros(frame.shape, dtype=bool)
+        cols = slice(*columns) if columns is not None else slice(None)
+        for start, stop in (bands if bands is not None else [(0, self.height)]):
+            read[start:stop, cols] = True
+        frame[~read] = 0
+        return np.count_nonzero(read) / read.size
+
+    def place_random_spots(self, n):
+        '''Sets spots_px to n random positions, away from the edges of the frame.'''
+        margin = 50
+        self.spots_px = np.column_stack([self.rng.uniform(margin, self.width - margin, n),
+                                         self.rng.uniform(margin, self.height - margin, n)]).tolist()
+
+    def make_bad_pixel_map(self, n_darks=5, nsigma=5):
+        '''Renders n_darks frames with no spots, subtracts the bias, maps the pixels which
+        are hot in most of them, and saves the map, as in SBIG_Grab_Cen. Returns the number
+        of bad pixels.'''
+        darks = (self.frames.correct(self.render([]), self.bias) for i in range(n_darks))
+        bad_pixel_map = multicens.build_bad_pixel_map(darks, nsigma)
+        multicens.save_bad_pixel_map(bad_pixel_map, self.bad_pixel_file)
+        self.bad_pixels = np.nonzero(bad_pixel_map)
+        print('Saved bad pixel map with ' + str(len(self.bad_pixels[0])) + ' pixels to ' + self.bad_pixel_file)
+        return len(self.bad_pixels[0])
+
+    def acquire(self):
+        """Simulates light image of spots_px and subtracts bias. First half of grab(),
+        as in SBIG_Grab_Cen.
+
+        RETURNS
+            LD         ... int32 image, light minus bias
+            imgfiles   ... filenames of images produced
+        """
+        imgfiles = []
+        L = self.render(self.spots_px)
+        fraction_read = self._apply_roi(L)
+        clock.sleep(self.exposure_time / 1000 + self.readout_time * fraction_read)
+        if self.write_fits:
+            filename = os.path.join(self.save_dir, 'sim_light_image.FITS')
+            fits.PrimaryHDU(L).writeto(filename, overwrite=True)
+            imgfiles.append(filename)
+        LD = self.frames.correct(L, self.bias)
+        if self.bad_pixels is not None:
+            multicens.replace_bad_pixels(LD, self.bad_pixels)
+        brightness = np.amax(LD)
+        if brightness < self.min_brightness:
+            print('Warning: the brightest spot in the image is undersaturated. Value = ' + str(brightness))
+        elif brightness > self.max_brightness:
+            print('Warning: the brightest spot in the image is oversaturated. Value = ' + str(brightness))
+        return LD, imgfiles
+
+    def centroid(self, LD, nWin=1, xy_guess=None):
+        """Centroids spots in an image from acquire(). Second half of grab(). With xy_guess,
+        uses guided centroiding near those pixel positions, as in SBIG_Grab_Cen.
+
+        RETURNS
+            xy         ... list of centroid coordinates for each spot
+            peaks      ... list of values of peak brightness for each spot
+            fwhms      ... list of values of fwhm for each spot
+            binfile    ... filename of binary image produced, if any
+        """
+        centroiding_tic = clock.time()
+        cen = centroiders.get(self.centroider, size_fitbox=self.size_fitbox, verbose=self.verbose, write_fits=self.write_fits, save_dir=self.save_dir, parallel=self.parallel, roi=self.roi)
+        xcen, ycen, peaks, fwhms, binfile = cen.centroid(LD, nWin, xy_guess)
+        xy = [[xcen[i], ycen[i]] for i in range(len(xcen))]
+        if self.verbose:
+            print('centroiding time: ' + str(clock.time() - centroiding_tic))
+        return xy, peaks, fwhms, binfile
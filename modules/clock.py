@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+'''Single point through which all sleeps, timeouts and timestamps pass, so that runs
+against simulated or replayed hardware need not take as long as real ones.
+
+Code should call clock.sleep(), clock.time() and clock.perf_counter() in place of the
+functions of the same names in the standard time module. By default these are exactly
+the real ones. To run in virtual time instead, e.g. in a test or benchmark:
+
+    import clock
+    clock.set_clock(clock.VirtualClock())           # instantaneous
+    clock.set_clock(clock.VirtualClock(speed=100))  # 100x faster than real time
+    ...
+    clock.set_clock(clock.Clock())                  # back to real time
+
+Note that this only affects code which goes through this module. Timestamps for file
+names (globals.timestamp) are still real.
+'''
+import time as _time
+import threading
+
+
+class Clock:
+    '''Real time. Same behavior as the standard time module.'''
+    def time(self):
+        return _time.time()
+
+    def perf_counter(self):
+        return _time.perf_counter()
+
+    def sleep(self, seconds):
+        _time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    '''Virtual time, which advances only when slept.
+
+    INPUTS:
+        speed ... None for instantaneous sleeps, or a factor by which to accelerate, i.e.
+                  each sleep really waits seconds / speed
+        start ... [s] initial value of time(), default is the real time now
+        tick ... [s] amount by which each read of time() or perf_counter() advances the
+                 clock, so that loops polling for a timeout (without sleeping) still end
+    '''
+    def __init__(self, speed=None, start=None, tick=1e-4):
+        self.speed = speed
+        self.tick = tick
+        self._now = _time.time() if start is None else start
+        self._lock = threading.Lock()
+
+    def _advance(self, seconds):
+        with self._lock:
+            self._now += seconds
+            return self._now
+
+    def time(self):
+        return self._advance(self.tick)
+
+    def perf_counter(self):
+        return self._advance(self.tick)
+
+    def sleep(self, seconds):
+        if self.speed:
+            _time.sleep(seconds / self.speed)
+        self._advance(max(seconds, 0.))
+
+
+_clock = Clock()
+
+
+def get_clock():
+    return _clock
+
+
+def set_clock(clock):
+    '''Sets the clock used by all subsequent calls through this module.'''
+    global _clock
+    _clock = clock
+
+
+def time():
+    return _clock.time()
+
+
+def perf_counter():
+    return _clock.perf_counter()
+
+
+def sleep(seconds):
+    _clock.sleep(seconds)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Predicts collisions between neighboring robots, from their arm angles.
+
+Each robot's alpha and beta arms are modeled as capsules in the global frame, i.e.
+line segments (from the alpha axis to the beta axis, and from the beta axis to the
+fiber) padded all around by a half-width. Two robots interfere when any capsule of
+one comes closer to any capsule of the other than the sum of their half-widths.
+
+Only pairs of robots whose patrol disks overlap are checked (the broad phase, from
+robot_layout.RobotLayout.pairs). The narrow phase then computes segment-to-segment
+distances for all those pairs in vectorized numpy, so that every time sample of a
+planned fleet move can be checked in one call.
+
+Example:
+    from robot_layout import RobotLayout
+    from collisions import CollisionChecker
+    layout = RobotLayout.from_csv()
+    checker = CollisionChecker(layout, half_width_a=1.0, half_width_b=1.0)
+    hits = checker.check(a_arm, b_arm)  # a_arm, b_arm of shape (T, N) --> hits (T, M)
+    checker.colliding_ids(a_arm[0], b_arm[0])  # --> list of (pos_id, pos_id)
+'''
+import numpy as np
+from trillium_transforms import arm2gbl
+
+# Which segment of robot i is checked against which segment of robot j, for each pair.
+# Alpha-alpha is included, for layouts tight enough that the alpha arms may touch.
+segment_combos = [('alpha', 'alpha'), ('alpha', 'beta'), ('beta', 'alpha'), ('beta', 'beta')]
+
+
+class CollisionChecker:
+    '''Checks all neighboring pairs of a RobotLayout for interference.
+
+    INPUTS:
+        layout ... robot_layout.RobotLayout
+        half_width_a, half_width_b ... [mm] capsule radii of alpha and beta arms
+                                       (scalars, or arrays with one value per robot)
+    '''
+    def __init__(self, layout, half_width_a, half_width_b):
+        self.layout = layout
+        n = len(layout)
+        self.half_width = {'alpha': np.broadcast_to(np.asarray(half_width_a, dtype=float), n),
+                           'beta': np.broadcast_to(np.asarray(half_width_b, dtype=float), n)}
+
+    def arm_points(self, a_arm, b_arm):
+        '''Returns global xy of each robot's alpha axis, beta axis and fiber, as arrays
+        of shape (..., N, 2), for arm angles of shape (..., N) in layout row order.'''
+        L = self.layout
+        a_gbl, b_gbl = arm2gbl(a_arm, b_arm, L.offset_a)
+        a_rad, b_rad = np.radians(a_gbl), np.radians(b_gbl)
+        center = np.broadcast_to(np.stack([L.center_x, L.center_y], axis=-1), np.shape(a_rad) + (2,))
+        elbow = center + L.length_a[:, None] * np.stack([np.cos(a_rad), np.sin(a_rad)], axis=-1)
+        fiber = elbow + L.length_b[:, None] * np.stack([np.cos(b_rad), np.sin(b_rad)], axis=-1)
+        return center, elbow, fiber
+
+    def clearance(self, a_arm, b_arm):
+        '''Returns array of shape (..., M) of the minimum clearance [mm] between the arm
+        envelopes of each neighboring pair (layout.pairs). Negative means interference.'''
+        center, elbow, fiber = self.arm_points(a_arm, b_arm)
+        segments = {'alpha': (center, elbow), 'beta': (elbow, fiber)}
+        i, j = self.layout.pairs[:, 0], self.layout.pairs[:, 1]
+        result = np.full(np.shape(a_arm)[:-1] + (len(i),), np.inf)
+        for seg_i, seg_j in segment_combos:
+            p1, q1 = segments[seg_i]
+            p2, q2 = segments[seg_j]
+            dist = segment_distance(p1[..., i, :], q1[..., i, :], p2[..., j, :], q2[..., j, :])
+            dist = dist - self.half_width[seg_i][i] - self.half_width[seg_j][j]
+            result = np.minimum(result, dist)
+        return result
+
+    def check(self, a_arm, b_arm):
+        '''Returns boolean array of shape (..., M), True where the neighboring pair
+        (layout.pairs) would collide at the argued arm angles, of shape (..., N).
+
+        Segments whose midpoints are too far apart to touch are rejected cheaply, and
+        the exact distance is only computed for the remaining candidates.'''
+        center, elbow, fiber = self.arm_points(a_arm, b_arm)
+        segments = {'alpha': (center, elbow, self.layout.length_a), 'beta': (elbow, fiber, self.layout.length_b)}
+        i, j = self.layout.pairs[:, 0], self.layout.pairs[:, 1]
+        hits = np.zeros(np.shape(a_arm)[:-1] + (len(i),), dtype=bool)
+        for seg_i, seg_j in segment_combos:
+            p1, q1, len1 = segments[seg_i]
+            p2, q2, len2 = segments[seg_j]
+            p1, q1, p2, q2 = p1[..., i, :], q1[..., i, :], p2[..., j, :], q2[..., j, :]
+            reach = (len1[i] + len2[j]) / 2 + self.half_width[seg_i][i] + self.half_width[seg_j][j]
+            mid = (p1 + q1 - p2 - q2) / 2
+            candidates = np.hypot(mid[..., 0], mid[..., 1]) < np.broadcast_to(reach, hits.shape)
+            if candidates.any():
+                touch = np.broadcast_to(self.half_width[seg_i][i] + self.half_width[seg_j][j], hits.shape)[candidates]
+                dist = segment_distance(p1[candidates], q1[candidates], p2[candidates], q2[candidates])
+                hits[candidates] |= dist < touch
+        return hits
+
+    def colliding_ids(self, a_arm, b_arm):
+        '''Returns list of (pos_id, pos_id) tuples for the pairs which would collide, at
+        one set of arm angles (i.e. a_arm and b_arm of shape (N,)).'''
+        hits = self.check(a_arm, b_arm)
+        return [tuple(ids) for ids in self.layout.pair_ids[hits].tolist()]
+
+    def first_collisions(self, a_arm, b_arm):
+        '''For a planned move, with arm angles of shape (T, N) for T time samples, returns
+        dict with keys (pos_id, pos_id) and values the index of the first time sample
+        at which that pair collides. Empty if the move is collision-free.
+
+        Note that each sample is checked statically, so the samples should be spaced
+        closely enough that arms cannot pass through one another between them.'''
+        hits = self.check(a_arm, b_arm)
+        colliding = np.flatnonzero(hits.any(axis=0))
+        first = hits[:, colliding].argmax(axis=0)
+        return {tuple(self.layout.pair_ids[m].tolist()): int(t) for m, t in zip(colliding, first)}
+
+
+def segment_distance(p1, q1, p2, q2):
+    '''Minimum distance between line segments p1-q1 and p2-q2, vectorized over arrays of
+    shape (..., 2). Uses the clamped closest-points method (c.f. Ericson, "Real-Time
+    Collision Detection", section 5.1.9).'''
+    d1 = q1 - p1
+    d2 = q2 - p2
+    r = p1 - p2
+    a = np.sum(d1*d1, axis=-1)
+    e = np.sum(d2*d2, axis=-1)
+    f = np.sum(d2*r, axis=-1)
+    c = np.sum(d1*r, axis=-1)
+    b = np.sum(d1*d2, axis=-1)
+    denom = a*e - b*b
+    safe_a = np.where(a > 0, a, 1.)
+    safe_e = np.where(e > 0, e, 1.)
+    s = np.where(denom > 0, np.clip((b*f - c*e) / np.where(denom > 0, denom, 1.), 0., 1.), 0.)
+    t = np.where(e > 0, (b*s + f) / safe_e, 0.)
+    s = np.where(t < 0, np.clip(-c / safe_a, 0., 1.), np.where(t > 1, np.clip((b - c) / safe_a, 0., 1.), s))
+    s = np.where(e > 0, s, np.clip(-c / safe_a, 0., 1.))  # segment 2 degenerates to a point
+    s = np.where(a > 0, s, 0.)  # segment 1 degenerates to a point
+    t = np.clip(t, 0., 1.)
+    closest1 = p1 + d1*s[..., None]
+    closest2 = p2 + d2*t[..., None]
+    return np.hypot(*np.moveaxis(closest1 - closest2, -1, 0))
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+'''
+Simulates the motion of a fleet of robots, faster than real time, for evaluating move
+planners and fleet-level throughput without the test stand.
+
+Each robot's state is its alpha and beta gearbox output angles. Moves are commanded
+either point-to-point (like PositionerUnit.goto, with each axis following its own
+speed- and acceleration-limited profile) or as a trajectory_planner.FleetPlan. Time
+advances on a virtual clock, in steps of dt, with all robots updated at once:
+
+    - Commanded motor increments are applied to the gearbox angles, which are then
+      passed through trillium_transforms.box2arm with each robot's travel limits. Where
+      an arm hits a hard stop, the gearbox angle is held at the stop (i.e. the motor
+      field slips, as on the real robots), and the contact is recorded.
+
+    - If a CollisionChecker is given, all neighboring pairs are checked. Colliding
+      robots are stopped, like the firmware does on its collision flag, and the
+      collision is recorded.
+
+Each move returns a MoveReport, with its duration, per-robot durations, contacts and
+collisions. Idle time between moves (e.g. for camera exposures) can be added with
+wait(), which costs nothing to simulate.
+
+Example:
+    from robot_layout import RobotLayout
+    from collisions import CollisionChecker
+    from fleet_simulator import FleetSimulator
+    layout = RobotLayout.from_csv()
+    sim = FleetSimulator(layout, CollisionChecker(layout, half_width_a=1.0, half_width_b=1.0))
+    sim.set_arm({1234: (0, 90), ...})
+    report = sim.goto({1234: (45, 120), ...})
+    sim.wait(2.0)
+    print(report, sim.time)
+'''
+import numpy as np
+import globals as gl
+from trillium_transforms import arm2box, box2arm, box2mot, nom_idler
+from trajectory_planner import trapezoid, trapezoid_position, nom_max_speed, nom_max_accel
+
+contact_tol = 1e-6  # [deg] hard stop penetration below which a contact is taken as numerical roundoff
+
+
+class MoveReport:
+    '''Result of simulating one fleet move.
+
+    start ... [s] virtual clock time at start of the move
+    duration ... [s] time until the last robot stopped
+    robot_durations ... dict with keys pos_id and values [s] time until each moving robot stopped
+    contacts ... dict with keys pos_id and values dict of contact name --> [s] time of
+                 first contact (see trillium_transforms.box2arm)
+    collisions ... dict with keys (pos_id, pos_id) and values [s] time of first collision
+    overspeed ... list of pos_ids whose commanded motion exceeded max_speed
+    '''
+    def __init__(self, start, duration, robot_durations, contacts, collisions, overspeed):
+        self.start = start
+        self.duration = duration
+        self.robot_durations = robot_durations
+        self.contacts = contacts
+        self.collisions = collisions
+        self.overspeed = overspeed
+
+    def __repr__(self):
+        return (f'move at {self.start:.2f} s: duration {self.duration:.2f} s, {len(self.robot_durations)} robots moved,'
+                f' {len(self.contacts)} with hardstop contacts, {len(self.collisions)} collisions,'
+                f' {len(self.overspeed)} overspeed')
+
+
+class FleetSimulator:
+    '''Virtual fleet of robots, moving in virtual time.
+
+    INPUTS:
+        layout ... robot_layout.RobotLayout
+        checker ... collisions.CollisionChecker for the same layout, or None to skip collision checks
+        motor_name ... key of gl.gear_ratio
+        max_speed ... [rpm] max motor speed
+        max_accel ... [rpm/s] max motor acceleration
+        idler ... idler gear ratios, see trillium_transforms
+        dt ... [s] simulation time step
+        check_every ... number of time steps per vectorized collision check
+        stop_on_collision ... whether colliding robots stop, like the firmware does
+    '''
+    def __init__(self, layout, checker=None, motor_name='namiki', max_speed=nom_max_speed,
+                 max_accel=nom_max_accel, idler=nom_idler, dt=0.05, check_every=50, stop_on_collision=True):
+        self.layout = layout
+        self.checker = checker
+        self.gear_ratio = gl.gear_ratio[motor_name]
+        self.max_speed = max_speed * 6.0  # deg/s
+        self.max_accel = max_accel * 6.0  # deg/s^2
+        self.idler = idler
+        self.dt = dt
+        self.check_every = check_every
+        self.stop_on_collision = stop_on_collision
+        self.time = 0.  # [s] virtual clock
+        self.a_box = np.zeros(len(layout))
+        self.b_box = np.zeros(len(layout))
+        self.set_arm(0., max(layout.limits_b[0].min(), 0.))
+
+    @property
+    def arm(self):
+        '''Current (a_arm, b_arm) arrays, in layout row order.'''
+        a_arm, b_arm, _ = self._box2arm(self.a_box, self.b_box)
+        return a_arm, b_arm
+
+    def set_arm(self, a_arm, b_arm=None):
+        '''Sets arm angles, without simulating motion. Either argue arrays (or scalars)
+        a_arm and b_arm in layout row order, or a dict with keys pos_id and values
+        (a_arm, b_arm) for the robots to set.'''
+        if isinstance(a_arm, dict):
+            rows = self.layout.rows(a_arm)
+            angles = np.array(list(a_arm.values()), dtype=float).reshape(-1, 2)
+            self.a_box[rows], self.b_box[rows] = arm2box(angles[:, 0], angles[:, 1], idler=self.idler)
+        else:
+            a_box, b_box = arm2box(a_arm, b_arm, idler=self.idler)
+            self.a_box[:] = a_box
+            self.b_box[:] = b_box
+
+    def wait(self, seconds):
+        '''Advances the virtual clock with no motion.'''
+        self.time += seconds
+
+    def goto(self, targets):
+        '''Point-to-point move to targets, a dict with keys pos_id and values (a_arm, b_arm).
+        Each axis moves independently, with a trapezoidal profile at the motor limits.
+        Returns a MoveReport.'''
+        rows = self.layout.rows(targets)
+        angles = np.array(list(targets.values()), dtype=float).reshape(-1, 2)
+        a_target, b_target = arm2box(angles[:, 0], angles[:, 1], idler=self.idler)
+        a_travel = a_target - self.a_box[rows]
+        b_travel = b_target - self.b_box[rows]
+        a_dur, a_acc = trapezoid(box2mot(a_travel, self.gear_ratio), self.max_speed, self.max_accel)
+        b_dur, b_acc = trapezoid(box2mot(b_travel, self.gear_ratio), self.max_speed, self.max_accel)
+        t = self._time_grid(max(np.max(a_dur, initial=0.), np.max(b_dur, initial=0.)))
+        a_cmd = np.zeros((len(t), len(self.layout)))
+        b_cmd = np.zeros((len(t), len(self.layout)))
+        a_cmd[:, rows] = a_travel * trapezoid_position(t[:, None], a_dur, a_acc)
+        b_cmd[:, rows] = b_travel * trapezoid_position(t[:, None], b_dur, b_acc)
+        return self._simulate(t, a_cmd, b_cmd)
+
+    def run_plan(self, plan):
+        '''Executes a trajectory_planner.FleetPlan, starting from the current state.
+        Returns a MoveReport.'''
+        t = self._time_grid(plan.duration)
+        a_cmd = np.zeros((len(t), len(self.layout)))
+        b_cmd = np.zeros((len(t), len(self.layout)))
+        for pos_id, robot in plan.robots.items():
+            a_box, b_box = arm2box(*robot.sample(t), idler=self.idler)
+            row = self.layout.row(pos_id)
+            a_cmd[:, row] = a_box - a_box[0]
+            b_cmd[:, row] = b_box - b_box[0]
+        return self._simulate(t, a_cmd, b_cmd)
+
+    def _time_grid(self, duration):
+        n = int(np.ceil(duration / self.dt))
+        return np.arange(n + 1) * self.dt if n > 0 else np.zeros(1)
+
+    def _box2arm(self, a_box, b_box):
+        L = self.layout
+        return box2arm(a_box, b_box, limits_a=L.limits_a, limits_b=L.limits_b, idler=self.idler)
+
+    def _simulate(self, t, a_cmd, b_cmd):
+        '''Steps through commanded gearbox displacements a_cmd, b_cmd of shape (T, N),
+        relative to the start of the move, at times t.'''
+        L = self.layout
+        n_steps, n = a_cmd.shape
+        start = self.time
+        da = np.diff(a_cmd, axis=0)
+        db = np.diff(b_cmd, axis=0)
+        moving = (np.abs(a_cmd[-1]) > 0) | (np.abs(b_cmd[-1]) > 0) | np.any(da != 0, axis=0) | np.any(db != 0, axis=0)
+        overspeed = moving & (np.max(np.abs(box2mot(np.concatenate([da, db]), self.gear_ratio)), axis=0, initial=0.)
+                              > self.max_speed * self.dt * (1 + 1e-6))
+        last_motion = np.array([t[np.flatnonzero((da[:, i] != 0) | (db[:, i] != 0)).max(initial=-1) + 1] for i in range(n)])
+        a_arm_hist = np.zeros((n_steps, n))
+        b_arm_hist = np.zeros((n_steps, n))
+        a_arm_hist[0], b_arm_hist[0], _ = self._box2arm(self.a_box, self.b_box)
+        stopped = np.zeros(n, dtype=bool)
+        stop_time = np.full(n, np.inf)
+        contacts = {}
+        collisions = {}
+        reported = np.zeros(len(L.pairs), dtype=bool)
+        k = 0
+        while k < n_steps - 1:
+            end = min(k + self.check_every, n_steps - 1)
+            for step in range(k, end):
+                go = ~stopped
+                self.a_box[go] += da[step, go]
+                self.b_box[go] += db[step, go]
+                a_arm, b_arm, touching = self._box2arm(self.a_box, self.b_box)
+                a_box, b_box = arm2box(a_arm, b_arm, idler=self.idler)  # motor slips at hard stops
+                slipped = go & moving & ((np.abs(a_box - self.a_box) > contact_tol) | (np.abs(b_box - self.b_box) > contact_tol))
+                self.a_box, self.b_box = a_box, b_box
+                a_arm_hist[step + 1], b_arm_hist[step + 1] = a_arm, b_arm
+                if slipped.any():
+                    for name, touched in touching.items():
+                        for i in np.flatnonzero(touched & slipped):
+                            contacts.setdefault(int(L.pos_ids[i]), {}).setdefault(name, start + t[step + 1])
+            if self.checker:
+                hits = self.checker.check(a_arm_hist[k + 1:end + 1], b_arm_hist[k + 1:end + 1]) & ~reported
+                if hits.any():
+                    j = int(np.flatnonzero(hits.any(axis=1))[0])
+                    step = k + 1 + j
+                    new = np.flatnonzero(hits[j])
+                    reported[new] = True
+                    for m in new:
+                        collisions[tuple(L.pair_ids[m].tolist())] = start + t[step]
+                    if self.stop_on_collision:
+                        for i in L.pairs[new].ravel():
+                            if not stopped[i]:
+                                stopped[i] = True
+                                stop_time[i] = t[step]
+                        # roll back to the time of the collision, and continue from there
+                        self.a_box, self.b_box = arm2box(a_arm_hist[step], b_arm_hist[step], idler=self.idler)
+                        k = step
+                        continue
+            k = end
+        robot_durations = {int(L.pos_ids[i]): float(min(last_motion[i], stop_time[i])) for i in np.flatnonzero(moving)}
+        duration = max(robot_durations.values(), default=0.)
+        self.time = start + duration
+        return MoveReport(start, duration, robot_durations, contacts, collisions,
+                          L.pos_ids[overspeed].tolist())
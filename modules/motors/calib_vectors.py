@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+'''Bulk download of the hall sensor and cogging calibration vectors stored on the
+positioners, for tracking calibration drift across the fleet.
+
+Each point of the cogging vectors takes one CAN command per robot, so reading them one
+robot at a time is slow. Here every command is sent to all robots at once (see
+tendo.send_receive_CAN_multi), so the total time scales with the vector length rather
+than with the number of robots.
+
+Downloads are saved as compressed numpy files, one per robot and firmware version, in
+gl.dirs['data']/calib_vectors. Before downloading, a cheap fingerprint (hall calibration
+values and cogging vector length) is read from each robot and compared to its latest
+saved file. Only robots whose fingerprint or firmware changed are downloaded again.
+
+The fingerprint also includes the cogging vectors at n_cogging_samples evenly spaced
+indices, so that a cogging recalibration (which usually keeps the vector length) is
+detected. A change which happens to leave all the sampled points as they were still
+goes undetected, so argue force=True when a complete download must be guaranteed.
+
+Example:
+    from tendo import Positioners
+    from calib_vectors import CalibVectors
+    pos = Positioners()
+    pos.connect()
+    cv = CalibVectors(pos)
+    paths = cv.download()
+    data = cv.load(pos_id=1234)
+'''
+import os
+import glob
+import numpy as np
+import globals as gl
+from defines import (CAN_MAX_RETRIES, POS_CMD_GET_FIRMWARE, POS_CMD_GET_ALPHA_HALL_CALIB, POS_CMD_GET_BETA_HALL_CALIB,
+                     POS_CMD_GET_COGGING_LENGTH, POS_CMD_GET_COGGING_POS, POS_CMD_GET_COGGING_NEG,
+                     POS_CMD_GET_COGGING_ANGLE)
+
+default_dir = os.path.join(gl.dirs['data'], 'calib_vectors')
+
+# array name --> (command, receive_data_type) for the per-index cogging reads
+cogging_commands = {'cogging_angle': (POS_CMD_GET_COGGING_ANGLE, 4),
+                    'cogging_pos': (POS_CMD_GET_COGGING_POS, 4),
+                    'cogging_neg': (POS_CMD_GET_COGGING_NEG, 4)}
+
+
+class CalibVectors:
+    '''Reads and stores calibration vectors of many positioners.
+
+    INPUTS:
+        positioners ... tendo.Positioners (or tendo_daemon.RemotePositioners)
+        directory ... where to save the files
+        max_retries ... number of times a lost command is resent to the robots which did not answer
+        n_cogging_samples ... number of points of the cogging vectors read for the fingerprint
+        printfunc ... function handle, to specify alternate to print (i.e. your logger)
+    '''
+    def __init__(self, positioners, directory=default_dir, max_retries=CAN_MAX_RETRIES, n_cogging_samples=8,
+                 printfunc=print):
+        self.positioners = positioners
+        self.directory = directory
+        self.max_retries = max_retries
+        self.n_cogging_samples = n_cogging_samples
+        self.printfunc = printfunc
+
+    def download(self, pos_ids=None, force=False):
+        '''Downloads calibration vectors from positioners pos_ids (default all available)
+        whose fingerprint differs from their latest saved file (or all of them if
+        force=True). Returns dict with keys pos_id and values the path of the saved file,
+        for those which were downloaded.'''
+        if pos_ids is None:
+            pos_ids = self.positioners.available_positioners()
+        prints = self.fingerprints(pos_ids)
+        todo = []
+        for pos_id, fp in prints.items():
+            latest = self.latest_path(pos_id, fp['firmware'])
+            if force or latest is None or not self._same(fp, self._load_fingerprint(latest)):
+                todo.append(pos_id)
+        self.printfunc(f'Calibration vectors: {len(prints)} positioners read, {len(todo)} changed'
+                       f'{" (forced)" if force else ""}, {len(set(pos_ids) - set(prints))} not responding')
+        if not todo:
+            return {}
+        vectors = self._download_cogging({p: prints[p]['cogging_length'] for p in todo})
+        os.makedirs(self.directory, exist_ok=True)
+        paths = {}
+        timestamp = gl.timestamp()
+        for pos_id in todo:
+            if pos_id not in vectors:
+                continue
+            fp = prints[pos_id]
+            path = os.path.join(self.directory, f'{timestamp} pos{pos_id} fw{fp["firmware"]}.npz')
+            np.savez_compressed(path, pos_id=pos_id, firmware=fp['firmware'], timestamp=timestamp,
+                                alpha_hall=np.array(fp['alpha_hall'], dtype=np.uint16),
+                                beta_hall=np.array(fp['beta_hall'], dtype=np.uint16),
+                                cogging_length=fp['cogging_length'], **vectors[pos_id])
+            paths[pos_id] = path
+        self.printfunc(f'Calibration vectors: saved {len(paths)} files to {self.directory}')
+        return paths
+
+    def fingerprints(self, pos_ids):
+        '''Returns dict with keys pos_id and values dict of firmware, alpha_hall,
+        beta_hall, cogging_length, cogging_samples (firmware being the raw number, as
+        from get_firmware). Positioners which did not answer are omitted.'''
+        firmware = self._multi(pos_ids, POS_CMD_GET_FIRMWARE, 1)
+        alpha_hall = self._multi(list(firmware), POS_CMD_GET_ALPHA_HALL_CALIB, 7)
+        beta_hall = self._multi(list(alpha_hall), POS_CMD_GET_BETA_HALL_CALIB, 7)
+        length = self._multi(list(beta_hall), POS_CMD_GET_COGGING_LENGTH, 1)
+        samples = self._sample_cogging({pos_id: length[pos_id][2] for pos_id in length})
+        return {pos_id: {'firmware': firmware[pos_id][2],
+                         'alpha_hall': list(alpha_hall[pos_id][2]) + list(alpha_hall[pos_id][3]),
+                         'beta_hall': list(beta_hall[pos_id][2]) + list(beta_hall[pos_id][3]),
+                         'cogging_length': length[pos_id][2],
+                         'cogging_samples': samples[pos_id]}
+                for pos_id in samples}
+
+    def _sample_cogging(self, lengths):
+        '''Reads the cogging vectors at the indices from sample_indices(), from all robots
+        at once. Returns dict with keys pos_id and values list of [alpha, beta] * 3 (in the
+        order of cogging_commands) per sampled index. Robots which did not answer are omitted.'''
+        indices = {pos_id: sample_indices(n, self.n_cogging_samples) for pos_id, n in lengths.items()}
+        samples = {pos_id: [] for pos_id in lengths}
+        for k in range(self.n_cogging_samples):
+            pos_ids = [p for p in samples if k < len(indices[p])]
+            index = {p: indices[p][k] for p in pos_ids}
+            rows = {p: [] for p in pos_ids}
+            for command, data_type in cogging_commands.values():
+                replies = self._multi(pos_ids, command, data_type, data1=index, data2=index)
+                for pos_id in pos_ids:
+                    if pos_id in replies:
+                        rows[pos_id] += [int(x) for x in replies[pos_id][2:4]]
+                    else:
+                        del samples[pos_id]
+                pos_ids = [p for p in pos_ids if p in samples]
+            for pos_id in pos_ids:
+                samples[pos_id].append(rows[pos_id])
+        return samples
+
+    def _download_cogging(self, lengths):
+        '''Reads the cogging vectors, index by index, from all robots at once. Returns dict
+        with keys pos_id and values dict of (length x 2) int arrays, columns alpha and beta.
+        Robots which stop answering part way are omitted.'''
+        vectors = {pos_id: {name: np.zeros((n, 2), dtype=np.int32) for name in cogging_commands}
+                   for pos_id, n in lengths.items()}
+        alive = set(lengths)
+        for index in range(max(lengths.values(), default=0)):
+            pos_ids = [p for p in alive if index < lengths[p]]
+            for name, (command, data_type) in cogging_commands.items():
+                replies = self._multi(pos_ids, command, data_type, data1=index, data2=index)
+                for pos_id in pos_ids:
+                    if pos_id in replies:
+                        vectors[pos_id][name][index] = replies[pos_id][2:4]
+                    elif pos_id in alive:
+                        alive.discard(pos_id)
+                        self.printfunc(f'pos{pos_id}-> lost during cogging vectors download at index {index}')
+                pos_ids = [p for p in pos_ids if p in alive]
+        return {pos_id: vectors[pos_id] for pos_id in alive}
+
+    def _multi(self, pos_ids, command, receive_data_type, data1=None, data2=None):
+        '''Sends command to all pos_ids at once, resending to those which did not answer.
+        Returns dict with keys pos_id and values the reply, for those with a good response.'''
+        good = {}
+        pending = list(pos_ids)
+        for attempt in range(self.max_retries + 1):
+            if not pending:
+                break
+            replies = self.positioners.send_receive_multi(pending, command, receive_data_type, data1, data2)
+            for pos_id, reply in replies.items():
+                if reply[1] == 0:
+                    good[pos_id] = reply
+            pending = [p for p in pending if p not in good and replies.get(p, [p, -1])[1] == -1]
+        return good
+
+    def _same(self, fp, saved):
+        return (fp['firmware'] == saved['firmware'] and fp['cogging_length'] == saved['cogging_length']
+                and list(fp['alpha_hall']) == list(saved['alpha_hall'])
+                and list(fp['beta_hall']) == list(saved['beta_hall'])
+                and fp['cogging_samples'] == saved['cogging_samples'])
+
+    def _load_fingerprint(self, path):
+        with np.load(path) as data:
+            indices = sample_indices(int(data['cogging_length']), self.n_cogging_samples)
+            columns = [data[name] for name in cogging_commands]
+            samples = [np.concatenate([c[i] for c in columns]).tolist() for i in indices]
+            return {'firmware': int(data['firmware']), 'cogging_length': int(data['cogging_length']),
+                    'alpha_hall': data['alpha_hall'].tolist(), 'beta_hall': data['beta_hall'].tolist(),
+                    'cogging_samples': samples}
+
+    def latest_path(self, pos_id, firmware=None):
+        '''Path of the most recent saved file for pos_id (optionally of a given firmware
+        number), or None if there is none.'''
+        fw = '*' if firmware is None else firmware
+        paths = sorted(glob.glob(os.path.join(self.directory, f'* pos{pos_id} fw{fw}.npz')))
+        return paths[-1] if paths else None
+
+    def load(self, pos_id, firmware=None):
+        '''Returns dict of the arrays in the most recent saved file for pos_id (optionally
+        of a given firmware number), or None if there is none.'''
+        path = self.latest_path(pos_id, firmware)
+        if path is None:
+            return None
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+
+
+def sample_indices(length, n_samples):
+    '''Returns list of up to n_samples distinct indices, evenly spaced over a vector of length.'''
+    if length <= 0:
+        return []
+    return sorted(set(int(i) for i in np.linspace(0, length - 1, n_samples).round()))
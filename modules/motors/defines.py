@@ -5,6 +5,11 @@ CAN_UID_BIT_SHIFT = 4
 # can timing
 CAN_COM_WATCHDOG_TIMER = 0.5  # [s]
 CAN_DELAY_IF_NO_MESSAGE_FOUND = 0.2
+# can retries and quarantine of unresponsive positioners
+CAN_MAX_RETRIES = 2  # extra attempts after a command receives no response
+CAN_RETRY_BACKOFF = 0.05  # [s] delay before the first retry, doubled for each further retry
+CAN_QUARANTINE_THRESHOLD = 3  # consecutive commands with no response before a positioner is quarantined
+CAN_QUARANTINE_PROBE_INTERVAL = 30.0  # [s] period of the background probe which re-admits quarantined positioners
 
 # positioner steps
 POS_MOTOR_STEPS = 2 ** 30
@@ -32,6 +37,7 @@ POS_RESP_UNKNOWN_COMMAND = 13  # 13   unknown command
 POS_RESP_DATUM_NOT_CALIBRATED = 14  # 14   datum not calibrated
 POS_RESP_HALL_SENSOR_DISABLED = 15  # 15   hall sensors are disabled and can therefore not be used
 pos_response_code = {
+    -3: 'positioner quarantined',
     -2: 'command could not be sent',
     -1: 'no message received',
     0: 'command accepted',
@@ -153,6 +159,27 @@ POS_BOOTLOADER_GET_BACKUP_VERSION = 212
 POS_BOOTLOADER_REQUEST_REBOOT = 213
 POS_BOOTLOADER_GET_ROOT_ACCESS = 222
 
+# commands which are not safe to repeat automatically after a lost response, since the positioner may have executed
+# the first attempt already (relative moves, starts of long procedures, trajectory and firmware streams, reboots)
+CAN_NO_RETRY_COMMANDS = {POS_CMD_GOTO_POSITION_RELATIVE,
+                         POS_CMD_START_TRAJECTORY,
+                         POS_CMD_GOTO_DATUMS,
+                         POS_CMD_CALIB_DATUMS,
+                         POS_CMD_CALIB_DATUM_ALPHA,
+                         POS_CMD_CALIB_DATUM_BETA,
+                         POS_CMD_CALIB_MOTORS,
+                         POS_CMD_CALIB_MOTOR_ALPHA,
+                         POS_CMD_CALIB_MOTOR_BETA,
+                         POS_CMD_CALIB_COGGING,
+                         POS_CMD_CALIB_COGGING_ALPHA,
+                         POS_CMD_CALIB_COGGING_BETA,
+                         POS_CMD_SEND_TRAJECTORY_NEW,
+                         POS_CMD_SEND_TRAJECTORY_DATA,
+                         POS_CMD_SEND_TRAJECTORY_DATA_END,
+                         POS_CMD_REQUEST_REBOOT,
+                         POS_BOOTLOADER_SEND_NEW_FIRMWARE,
+                         POS_BOOTLOADER_FIRMWARE_DATA}
+
 POS_BOOTLOADER_PARAM_POSITIONER_ID = 0  # 0 Positioner CAN ID
 POS_BOOTLOADER_PARAM_POWER_LED_CONTROL = 1  # 1 Power LED control
 POS_BOOTLOADER_PARAM_FIBRE_TYPE = 2  # 2 Fibre type installed
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+'''Runs datum initialization and datum / motor calibrations on many positioners
+concurrently, tracking each one through its status register until done.
+
+The firmware commands (PositionerUnit.init_datum, calib_datum, calib_motor, and their
+alpha / beta variants) return immediately, while the procedures take a while on the
+robot. FleetCalibration starts the procedure on up to max_concurrent positioners at a
+time (limiting power supply and bus load), polls their status registers, starts the
+next positioner whenever one finishes, and finally reads back the calibration errors
+into a single table.
+
+Example:
+    from tendo import Positioners
+    from fleet_calibration import FleetCalibration
+    pos = Positioners()
+    pos.connect()
+    fc = FleetCalibration(pos, max_concurrent=10)
+    table = fc.run('calib_motor')
+    fc.save(table)
+'''
+import os
+from astropy.table import Table
+import globals as gl
+import clock
+from defines import StatusRegistery
+
+# For each procedure: the bit which is set while it is active, the bits which must be
+# set once it has succeeded, and the method (if any) for reading its calibration error.
+procedures = {
+    'init_datum':        {'active': 'DATUM_INITIALIZATION', 'done': ['DATUM_ALPHA_INITIALIZED', 'DATUM_BETA_INITIALIZED'], 'error': None},
+    'init_datum_alpha':  {'active': 'DATUM_INITIALIZATION', 'done': ['DATUM_ALPHA_INITIALIZED'], 'error': None},
+    'init_datum_beta':   {'active': 'DATUM_INITIALIZATION', 'done': ['DATUM_BETA_INITIALIZED'], 'error': None},
+    'calib_datum':       {'active': 'DATUM_CALIBRATION', 'done': ['DATUM_ALPHA_CALIBRATED', 'DATUM_BETA_CALIBRATED'], 'error': 'get_datum_calib_error'},
+    'calib_datum_alpha': {'active': 'DATUM_CALIBRATION', 'done': ['DATUM_ALPHA_CALIBRATED'], 'error': 'get_datum_calib_error'},
+    'calib_datum_beta':  {'active': 'DATUM_CALIBRATION', 'done': ['DATUM_BETA_CALIBRATED'], 'error': 'get_datum_calib_error'},
+    'calib_motor':       {'active': 'MOTOR_CALIBRATION', 'done': ['MOTOR_ALPHA_CALIBRATED', 'MOTOR_BETA_CALIBRATED'], 'error': 'get_motor_calib_error'},
+    'calib_motor_alpha': {'active': 'MOTOR_CALIBRATION', 'done': ['MOTOR_ALPHA_CALIBRATED'], 'error': 'get_motor_calib_error'},
+    'calib_motor_beta':  {'active': 'MOTOR_CALIBRATION', 'done': ['MOTOR_BETA_CALIBRATED'], 'error': 'get_motor_calib_error'},
+    }
+error_units = {'get_datum_calib_error': 'deg', 'get_motor_calib_error': '%'}
+
+
+class FleetCalibration:
+    '''Orchestrates a datum / calibration procedure across a Positioners instance.
+
+    INPUTS:
+        positioners ... tendo.Positioners (or tendo_daemon.RemotePositioners)
+        max_concurrent ... max number of positioners running the procedure at once
+        poll_period ... [s] time between status register polls
+        timeout ... [s] max duration of the procedure on any one positioner, after which it is stopped
+        settle_time ... [s] grace period after starting, before a status register which does
+                        not (yet) show the procedure as active is taken to mean it is finished
+        max_lost_polls ... number of consecutive status polls with no response before giving up on a positioner
+        printfunc ... function handle, to specify alternate to print (i.e. your logger)
+    '''
+    def __init__(self, positioners, max_concurrent=10, poll_period=1.0, timeout=300.0, settle_time=2.0,
+                 max_lost_polls=3, printfunc=print):
+        self.positioners = positioners
+        self.max_concurrent = max_concurrent
+        self.poll_period = poll_period
+        self.timeout = timeout
+        self.settle_time = settle_time
+        self.max_lost_polls = max_lost_polls
+        self.printfunc = printfunc
+        self.bits = StatusRegistery()
+
+    def run(self, procedure, pos_ids=None):
+        '''Runs the named procedure (see keys of module dict 'procedures') on positioners
+        pos_ids (default all available), and returns an astropy Table with one row per
+        positioner: pos_id, procedure, result, duration [s], alpha_error, beta_error,
+        error_units. The result column is one of 'done', 'failed', 'collision',
+        'timeout', 'no response', or 'rejected: <response>'.
+        '''
+        assert procedure in procedures, f'unknown procedure {procedure} (valid options are {list(procedures)})'
+        spec = procedures[procedure]
+        if pos_ids is None:
+            pos_ids = self.positioners.available_positioners() or []  # None if none found
+        queue = list(pos_ids)
+        running = {}  # pos_id --> dict of tracking info
+        results = {}  # pos_id --> dict of row values
+        self.printfunc(f'Starting {procedure} on {len(queue)} positioners, max {self.max_concurrent} at a time')
+        while queue or running:
+            while queue and len(running) < self.max_concurrent:
+                pos_id = queue.pop(0)
+                unit = self.positioners[pos_id]
+                reply = self._quiet(unit, procedure)[0]
+                if reply.response_raw == 0:
+                    running[pos_id] = {'start': clock.time(), 'seen_active': False, 'lost_polls': 0}
+                else:
+                    results[pos_id] = {'result': f'rejected: {reply.response}', 'duration': 0.0}
+            clock.sleep(self.poll_period)
+            for pos_id in list(running):
+                result = self._check(pos_id, spec, running[pos_id])
+                if result:
+                    track = running.pop(pos_id)
+                    results[pos_id] = {'result': result, 'duration': clock.time() - track['start']}
+                    self.printfunc(f'pos{pos_id}-> {procedure}: {result} after {results[pos_id]["duration"]:.1f} s')
+        if spec['error']:
+            for pos_id, row in results.items():
+                if row['result'] == 'done':
+                    reply = self._quiet(self.positioners[pos_id], spec['error'])[0]
+                    if reply.response_raw == 0:
+                        row['alpha_error'], row['beta_error'] = reply.alpha, reply.beta
+        return self._table(procedure, pos_ids, results, error_units.get(spec['error'], ''))
+
+    def _check(self, pos_id, spec, track):
+        '''Polls status register of one running positioner. Returns a final result
+        string if the procedure has ended, else None.'''
+        unit = self.positioners[pos_id]
+        reply = self._quiet(unit, 'get_status')[0]
+        if reply.response_raw != 0:
+            track['lost_polls'] += 1
+            if track['lost_polls'] >= self.max_lost_polls:
+                return 'no response'
+            return None
+        track['lost_polls'] = 0
+        status = reply.status_int
+        elapsed = clock.time() - track['start']
+        active = bool(status & getattr(self.bits, spec['active']))
+        track['seen_active'] |= active
+        if status & (self.bits.COLLISION_ALPHA | self.bits.COLLISION_BETA):
+            self._quiet(unit, 'stop')
+            return 'collision'
+        ended = not active and (track['seen_active'] or elapsed > self.settle_time)
+        if ended and status & self.bits.DISPLACEMENT_COMPLETED:
+            done = all(status & getattr(self.bits, bit) for bit in spec['done'])
+            return 'done' if done else 'failed'
+        if elapsed > self.timeout:  # still running, or ended without completing its displacement
+            self._quiet(unit, 'stop')
+            return 'timeout'
+        return None
+
+    def _quiet(self, unit, method):
+        '''Calls unit.method() with its printouts suppressed.'''
+        previous = unit.print
+        unit.print = False
+        try:
+            return getattr(unit, method)()
+        finally:
+            unit.print = previous
+
+    def _table(self, procedure, pos_ids, results, units):
+        table = Table(names=['pos_id', 'procedure', 'result', 'duration', 'alpha_error', 'beta_error', 'error_units'],
+                      dtype=[int, 'U20', 'U40', float, float, float, 'U4'])
+        for pos_id in pos_ids:
+            row = results[pos_id]
+            table.add_row([pos_id, procedure, row['result'], row['duration'],
+                           row.get('alpha_error', float('nan')), row.get('beta_error', float('nan')), units])
+        table['duration'].format = '.1f'
+        return table
+
+    def save(self, table, name='fleet calibration'):
+        '''Saves table as csv in the data directory, returning the path.'''
+        path = os.path.join(gl.dirs['data'], f'{gl.timestamp()} {name}.csv')
+        table.write(path, format='ascii.csv')
+        self.printfunc(f'Saved results to {path}')
+        return path
@@ -1,4 +1,4 @@
-import time
+import clock
 from serial.tools import list_ports
 import serial
 
@@ -43,8 +43,8 @@ class Lawicel:
                     # Retrieve the serial number
                     handle.write('N\r'.encode())  # C\r
 
-                    watchdog = time.perf_counter()
-                    while handle.inWaiting() < 6 and time.perf_counter() - CAN_DELAY_BETWEEN_CONFIG_COMMANDS < watchdog:
+                    watchdog = clock.perf_counter()
+                    while handle.inWaiting() < 6 and clock.perf_counter() - CAN_DELAY_BETWEEN_CONFIG_COMMANDS < watchdog:
                         _ = 1
 
                     input_buffer = handle.readline(handle.inWaiting())
@@ -81,8 +81,9 @@ class Lawicel:
         self.serial_no = []
         self.success = False
 
-    def send(self, send_str):
-        self.handle.reset_input_buffer()
+    def send(self, send_str, reset_input=True):
+        if reset_input:
+            self.handle.reset_input_buffer()
         self.handle.write(('T' + send_str + '\r').encode())  # t(ID)4(data)\r
 
     def receive(self, timeoutdelay=CAN_TIMEOUT_DELAY, expect_data=False):
@@ -101,12 +102,12 @@ class Lawicel:
         else:
             responseCharacters = responseLength + responseOffset
 
-        watchdog = time.perf_counter()
+        watchdog = clock.perf_counter()
         stayInLoop = True
         nbChar = 0
         previousNbChar = 0
 
-        while (nbChar < responseCharacters or stayInLoop) and time.perf_counter() - timeoutdelay < watchdog:
+        while (nbChar < responseCharacters or stayInLoop) and clock.perf_counter() - timeoutdelay < watchdog:
             nbChar = self.handle.inWaiting()
             if nbChar >= responseCharacters and previousNbChar == nbChar:
                 stayInLoop = False
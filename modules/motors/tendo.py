@@ -1,14 +1,20 @@
 from defines import *
-import time
+import clock
+import threading
 from lawicel import Lawicel
 
 message_stack = []
+health = {}  # PositionerHealth instances, keyed by pos_id
+state = {}  # PositionerState instances, keyed by pos_id
+bus_lock = threading.RLock()  # serializes access to the CAN connections, e.g. with the quarantine probe thread
 
 
 class Positioners():
     def __init__(self):
         self.connections = []
         self.dict = {}
+        self._probe_thread = None
+        self._probe_stop = threading.Event()
 
     def __getitem__(self, key):
         return self.dict[key]
@@ -72,7 +78,7 @@ class Positioners():
             else:
                 print(f'positioner {pos} not in list')
 
-    def available_positioners(self):
+    def available_positioners(self, include_quarantined=False):
         available_pos = []
         for connection in self.connections:
             if not connection.success:
@@ -86,6 +92,8 @@ class Positioners():
                 else:
                     for response in responses:
                         available_pos.append(response[0])
+        if not include_quarantined:
+            available_pos = [pos for pos in available_pos if not is_quarantined(pos)]
         return available_pos
 
     def remove_not_available_positioners(self):
@@ -126,6 +134,179 @@ class Positioners():
                     f'{number}: connection {self.connections[number].type} with nb {self.connections[number].serial_no} could not be closed')
                 print(e)
 
+    def send_receive_multi(self, pos_ids, command, receive_data_type=1, data1=None, data2=None,
+                           can_receive_delay=CAN_DELAY_IF_NO_MESSAGE_FOUND):
+        '''Sends the same command to many positioners at once (see send_receive_CAN_multi),
+        grouped by connection. Returns dict with keys pos_id and values the reply
+        [id, response_code, data1, data2].'''
+        by_connection = {}
+        for pos in pos_ids:
+            connection = self.dict[pos].connection[0]
+            by_connection.setdefault(id(connection), (connection, []))[1].append(pos)
+        replies = {}
+        for connection, group in by_connection.values():
+            replies.update(send_receive_CAN_multi(connection, group, command, receive_data_type,
+                                                  data1, data2, can_receive_delay))
+        return replies
+
+    def get_health(self, positioners=None):
+        '''Returns dict of PositionerHealth instances (keyed by pos_id) for the argued
+        positioners, or by default for all positioners in the list.'''
+        if positioners is None:
+            positioners = self.list_positioners(pr=False)
+        elif isinstance(positioners, int):
+            positioners = [positioners]
+        return {pos: get_health(pos) for pos in positioners if pos != 0}
+
+    def show_health(self):
+        print('positioner health:')
+        for h in self.get_health().values():
+            print(h)
+
+    def quarantined_positioners(self):
+        return [pos for pos in self.list_positioners(pr=False) if is_quarantined(pos)]
+
+    def probe_quarantined(self):
+        '''Sends a single firmware request to each quarantined positioner, bypassing
+        the quarantine, and re-admits those which answer. Returns list of re-admitted
+        pos_ids.'''
+        readmitted = []
+        for pos in self.quarantined_positioners():
+            for connection in self.dict[pos].connection:
+                replies = send_receive_CAN(connection, pos, POS_CMD_GET_FIRMWARE, retries=0, probe=True)
+                if replies and replies[0][1] >= 0:
+                    readmit(pos)
+                    readmitted.append(pos)
+                    print(f'pos{pos}-> answered quarantine probe, re-admitted')
+                    break
+        return readmitted
+
+    def start_quarantine_probe(self, interval=CAN_QUARANTINE_PROBE_INTERVAL):
+        '''Starts a background thread which periodically probes quarantined positioners.'''
+        if self._probe_thread and self._probe_thread.is_alive():
+            return
+        self._probe_stop.clear()
+
+        def probe_loop():
+            while not self._probe_stop.wait(interval):
+                self.probe_quarantined()
+
+        self._probe_thread = threading.Thread(target=probe_loop, name='quarantine probe', daemon=True)
+        self._probe_thread.start()
+
+    def stop_quarantine_probe(self):
+        self._probe_stop.set()
+        if self._probe_thread:
+            self._probe_thread.join()
+            self._probe_thread = None
+
+
+class PositionerHealth:
+    '''Communication health counters for one positioner.'''
+
+    def __init__(self, pos_id):
+        self.pos_id = pos_id
+        self.commands = 0  # commands sent, not counting retries
+        self.retries = 0  # extra attempts made after lost responses
+        self.timeouts = 0  # commands which finally got no response, after all retries
+        self.consecutive_timeouts = 0
+        self.quarantined = False
+        self.quarantine_count = 0  # number of times the positioner has been quarantined
+        self.skipped = 0  # commands not sent because the positioner was quarantined
+        self.last_response_time = None  # [s] clock.time() of last received response
+
+    def __repr__(self):
+        state = 'QUARANTINED' if self.quarantined else 'ok'
+        return (f'pos{self.pos_id}-> {state}, commands={self.commands}, retries={self.retries}, '
+                f'timeouts={self.timeouts}, consecutive timeouts={self.consecutive_timeouts}, '
+                f'quarantined {self.quarantine_count}x, skipped={self.skipped}')
+
+
+def get_health(pos_id):
+    if pos_id not in health:
+        health[pos_id] = PositionerHealth(pos_id)
+    return health[pos_id]
+
+
+def is_quarantined(pos_id):
+    return pos_id in health and health[pos_id].quarantined
+
+
+def quarantine(pos_id):
+    h = get_health(pos_id)
+    if not h.quarantined:
+        h.quarantined = True
+        h.quarantine_count += 1
+        print(f'pos{pos_id}-> quarantined after {h.consecutive_timeouts} consecutive commands with no response')
+
+
+def readmit(pos_id):
+    h = get_health(pos_id)
+    h.quarantined = False
+    h.consecutive_timeouts = 0
+
+
+class StateEntry:
+    def __init__(self, value, timestamp, provenance):
+        self.value = value
+        self.timestamp = timestamp  # [s] clock.time() at which the value became valid
+        self.provenance = provenance  # 'commanded' or 'measured'
+
+    def __repr__(self):
+        return f'{self.value} ({self.provenance}, {clock.time() - self.timestamp:.1f} s ago)'
+
+
+class PositionerState:
+    '''Last-known values for one positioner, so that scripts need not re-read over the
+    bus what a previous command already established.
+
+    Each field holds a StateEntry. Provenance 'commanded' means we told the positioner
+    to take this value, 'measured' means the positioner reported it. The timestamp of a
+    commanded goto position is the time at which the move is expected to be complete.
+    '''
+    fields = ('position',  # (alpha, beta) [deg]
+              'offsets',  # (alpha, beta) [deg]
+              'speed',  # (alpha, beta) [rpm]
+              'current',  # (alpha, beta) [%]
+              'low_power_current',  # (alpha, beta) [%]
+              'alpha_loop',  # (loop, collision detection) like ('closed', True)
+              'beta_loop',  # (loop, collision detection) like ('closed', True)
+              'firmware')
+
+    def __init__(self, pos_id):
+        self.pos_id = pos_id
+        self.entries = {}
+
+    def update(self, field, value, provenance, timestamp=None):
+        assert field in self.fields, f'unknown state field {field}'
+        timestamp = clock.time() if timestamp is None else timestamp
+        self.entries[field] = StateEntry(value, timestamp, provenance)
+
+    def get(self, field, max_age, provenance=None):
+        '''Returns the StateEntry for field if it is valid now and no older than max_age
+        seconds (and matches provenance, if argued), otherwise None.'''
+        entry = self.entries.get(field)
+        if entry is None or (provenance and entry.provenance != provenance):
+            return None
+        age = clock.time() - entry.timestamp
+        return entry if 0 <= age <= max_age else None
+
+    def invalidate(self, *fields):
+        '''Forgets the argued fields, or all fields if none are argued.'''
+        for field in fields or self.fields:
+            self.entries.pop(field, None)
+
+    def __repr__(self):
+        lines = [f'pos{self.pos_id}-> state:']
+        lines += [f'  {field:<18} : {self.entries[field]}' for field in self.fields if field in self.entries]
+        return '\n'.join(lines)
+
+
+def get_state(pos_id):
+    if pos_id not in state:
+        state[pos_id] = PositionerState(pos_id)
+    return state[pos_id]
+
 
 def static_vars(**kwargs):
     def decorate(func):
@@ -136,13 +317,63 @@ def static_vars(**kwargs):
     return decorate
 
 
-@static_vars(UID_COUNT=0)
 def send_receive_CAN(connection, id_pos, command, receive_data_type=1, data1=None, data2=None,
-                     can_receive_delay=CAN_DELAY_IF_NO_MESSAGE_FOUND, manualHexFrame=None):
+                     can_receive_delay=CAN_DELAY_IF_NO_MESSAGE_FOUND, manualHexFrame=None, retries=None, probe=False):
+    '''Sends a command and returns the list of responses [id, response_code, data1, data2].
+
+    Commands to a single positioner which get no response (code -1) are retried up to
+    'retries' times (default CAN_MAX_RETRIES, none for CAN_NO_RETRY_COMMANDS), with an
+    exponential backoff starting at CAN_RETRY_BACKOFF. After CAN_QUARANTINE_THRESHOLD
+    consecutive lost commands, the positioner is quarantined: further commands to it
+    immediately return code -3, without using the bus. Argue probe=True to bypass
+    the quarantine.
+    '''
+    if id_pos == 0 or command is None or not connection:
+        with bus_lock:
+            response = _send_receive_CAN_once(connection, id_pos, command, receive_data_type, data1, data2,
+                                              can_receive_delay, manualHexFrame)
+        for reply in response:
+            if reply[0] != 0 and reply[1] >= 0:
+                get_health(reply[0]).consecutive_timeouts = 0
+                get_health(reply[0]).last_response_time = clock.time()
+        return response
+
+    h = get_health(id_pos)
+    if h.quarantined and not probe:
+        h.skipped += 1
+        return [[id_pos, -3, [], []]]
+    if retries is None:
+        retries = 0 if command in CAN_NO_RETRY_COMMANDS else CAN_MAX_RETRIES
+    h.commands += 1
+    backoff = CAN_RETRY_BACKOFF
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            h.retries += 1
+            clock.sleep(backoff)
+            backoff *= 2
+        with bus_lock:
+            response = _send_receive_CAN_once(connection, id_pos, command, receive_data_type, data1, data2,
+                                              can_receive_delay, manualHexFrame)
+        if response and response[0][1] != -1:
+            break
+    if response and response[0][1] == -1:
+        h.timeouts += 1
+        h.consecutive_timeouts += 1
+        if h.consecutive_timeouts >= CAN_QUARANTINE_THRESHOLD and not probe:
+            quarantine(id_pos)
+    elif response and response[0][1] >= 0:
+        h.consecutive_timeouts = 0
+        h.last_response_time = clock.time()
+    return response
+
+
+@static_vars(UID_COUNT=0)
+def _send_receive_CAN_once(connection, id_pos, command, receive_data_type=1, data1=None, data2=None,
+                           can_receive_delay=CAN_DELAY_IF_NO_MESSAGE_FOUND, manualHexFrame=None):
     response = []
-    send_receive_CAN.UID_COUNT = send_receive_CAN.UID_COUNT + 1
-    if send_receive_CAN.UID_COUNT >= 16:
-        send_receive_CAN.UID_COUNT = 0
+    _send_receive_CAN_once.UID_COUNT = _send_receive_CAN_once.UID_COUNT + 1
+    if _send_receive_CAN_once.UID_COUNT >= 16:
+        _send_receive_CAN_once.UID_COUNT = 0
 
     if command is None:
         return []
@@ -153,7 +384,7 @@ def send_receive_CAN(connection, id_pos, command, receive_data_type=1, data1=Non
 
     ID = id_pos << CAN_ID_BIT_SHIFT
     IDcmd = (command << CAN_CMD_BIT_SHIFT) + ID
-    txCmd = (send_receive_CAN.UID_COUNT << CAN_UID_BIT_SHIFT) + IDcmd
+    txCmd = (_send_receive_CAN_once.UID_COUNT << CAN_UID_BIT_SHIFT) + IDcmd
     txCmd = '%0.8X' % txCmd
 
     if manualHexFrame is not None:
@@ -189,21 +420,8 @@ def send_receive_CAN(connection, id_pos, command, receive_data_type=1, data1=Non
 
         send_str = txCmd + dataLength + manualHexFrame
 
-    elif data1 is None and data2 is None:
-        send_str = txCmd + '0'
-
-    elif data2 is None:
-        dataCmd = '%0.8X' % (swapInt32(data1 % (2 ** 32)))
-        send_str = txCmd + '4' + dataCmd
-
-    elif data1 is None:
-        dataCmd = '%0.8X' % (swapInt32(data2 % (2 ** 32)))
-        send_str = txCmd + '4' + dataCmd
-
     else:
-        data1Cmd = '%0.8X' % (swapInt32(data1 % (2 ** 32)))
-        data2Cmd = '%0.8X' % (swapInt32(data2 % (2 ** 32)))
-        send_str = txCmd + '8' + data1Cmd + data2Cmd
+        send_str = txCmd + encode_data(data1, data2)
 
     try:
         connection.send(send_str)
@@ -216,12 +434,12 @@ def send_receive_CAN(connection, id_pos, command, receive_data_type=1, data1=Non
         response.append([id_pos, response_code, data1, data2])
         return response
 
-    matched_messages = receive_add_to_stack_check_for_message(connection, id_pos, send_receive_CAN.UID_COUNT)
-    start_time = time.perf_counter()
+    matched_messages = receive_add_to_stack_check_for_message(connection, id_pos, _send_receive_CAN_once.UID_COUNT)
+    start_time = clock.perf_counter()
     while ((not matched_messages) or (id_pos == 0)) and (
-            time.perf_counter() - can_receive_delay <= start_time):  # check again received messages if message not found
-        time.sleep(CAN_DELAY_IF_NO_MESSAGE_FOUND)
-        matched_messages = receive_add_to_stack_check_for_message(connection, id_pos, send_receive_CAN.UID_COUNT)
+            clock.perf_counter() - can_receive_delay <= start_time):  # check again received messages if message not found
+        clock.sleep(CAN_DELAY_IF_NO_MESSAGE_FOUND)
+        matched_messages = receive_add_to_stack_check_for_message(connection, id_pos, _send_receive_CAN_once.UID_COUNT)
 
     if not matched_messages:
         # print('error no message received')
@@ -240,6 +458,90 @@ def send_receive_CAN(connection, id_pos, command, receive_data_type=1, data1=Non
     return response
 
 
+def encode_data(data1=None, data2=None):
+    '''Returns the data length and data part of a CAN frame string, for zero, one or two int32 values.'''
+    if data1 is None and data2 is None:
+        return '0'
+    elif data2 is None:
+        return '4' + '%0.8X' % (swapInt32(data1 % (2 ** 32)))
+    elif data1 is None:
+        return '4' + '%0.8X' % (swapInt32(data2 % (2 ** 32)))
+    data1Cmd = '%0.8X' % (swapInt32(data1 % (2 ** 32)))
+    data2Cmd = '%0.8X' % (swapInt32(data2 % (2 ** 32)))
+    return '8' + data1Cmd + data2Cmd
+
+
+def send_receive_CAN_multi(connection, pos_ids, command, receive_data_type=1, data1=None, data2=None,
+                           can_receive_delay=CAN_DELAY_IF_NO_MESSAGE_FOUND):
+    '''Sends the same command to several positioners on one connection back-to-back, and
+    then collects all their replies, so that the robots' processing and the bus round
+    trips overlap rather than add up. Returns dict with keys pos_id and values the reply
+    [id, response_code, data1, data2].
+
+    data1 and data2 may be either single values for all, or dicts with keys pos_id.
+
+    Lost commands are not retried here (code -1 is returned, and counted toward
+    quarantine as usual); the caller can simply resend to the missing ones. Quarantined
+    positioners are skipped with code -3.
+    '''
+    replies = {}
+    targets = []
+    for pos_id in pos_ids:
+        if is_quarantined(pos_id):
+            get_health(pos_id).skipped += 1
+            replies[pos_id] = [pos_id, -3, [], []]
+        else:
+            targets.append(pos_id)
+    if not targets:
+        return replies
+    if not connection:
+        print('no connection is established')
+        return replies
+    with bus_lock:
+        # share the uid counter with single commands, so stale replies can't be confused
+        uid = (_send_receive_CAN_once.UID_COUNT + 1) % 16
+        _send_receive_CAN_once.UID_COUNT = uid
+        pending = set()
+        for i, pos_id in enumerate(targets):
+            d1 = data1.get(pos_id) if isinstance(data1, dict) else data1
+            d2 = data2.get(pos_id) if isinstance(data2, dict) else data2
+            txCmd = (uid << CAN_UID_BIT_SHIFT) + (command << CAN_CMD_BIT_SHIFT) + (pos_id << CAN_ID_BIT_SHIFT)
+            send_str = '%0.8X' % txCmd + encode_data(d1, d2)
+            try:
+                connection.send(send_str, reset_input=(i == 0))  # keep replies already arriving from earlier positioners
+            except Exception as e:
+                print(f'pos{pos_id}-> error message: {e}')
+                replies[pos_id] = [pos_id, -2, [], []]
+                continue
+            get_health(pos_id).commands += 1
+            pending.add(pos_id)
+        start_time = clock.perf_counter()
+        while pending:
+            for message in connection.receive() or []:
+                message_stack.append(message)
+            for message in list(message_stack):
+                if message[0] in pending and message[1] == uid:
+                    message_stack.remove(message)
+                    pending.discard(message[0])
+                    data_1, data_2 = decode_data(message, receive_data_type)
+                    replies[message[0]] = [message[0], message[3], data_1, data_2]
+            if clock.perf_counter() - can_receive_delay > start_time:
+                break
+    now = clock.time()
+    for pos_id in targets:
+        h = get_health(pos_id)
+        if pos_id in pending:
+            replies[pos_id] = [pos_id, -1, [], []]
+            h.timeouts += 1
+            h.consecutive_timeouts += 1
+            if h.consecutive_timeouts >= CAN_QUARANTINE_THRESHOLD:
+                quarantine(pos_id)
+        elif replies[pos_id][1] >= 0:
+            h.consecutive_timeouts = 0
+            h.last_response_time = now
+    return replies
+
+
 def receive_add_to_stack_check_for_message(connection, id_pos, uid):
     new_messages = connection.receive()
     # print(new_messages)
@@ -271,6 +573,7 @@ def decode_data(message, receive_data_type):
     case=4 %int32, int32
     case=5 %uint64
     case=6 %int64
+    case=7 %uint16 x4, returned as data1=(first, second), data2=(third, fourth)
     """
     data1 = []
     data2 = []
@@ -288,6 +591,9 @@ def decode_data(message, receive_data_type):
             data2 = to_signed(swapInt32(int(message[5][8:17], 16)), 4)
         elif receive_data_type == 5:
             data1 = swapInt64(int(message[5][0:16], 16))
+        elif receive_data_type == 7:
+            data1 = (swapInt16(int(message[5][0:4], 16)), swapInt16(int(message[5][4:8], 16)))
+            data2 = (swapInt16(int(message[5][8:12], 16)), swapInt16(int(message[5][12:16], 16)))
     return data1, data2
 
 
@@ -475,6 +781,8 @@ class Response:
         self.move_time_beta = None  # [sec]
         self.alpha = None  #
         self.beta = None  #
+        self.length = None  # cogging vectors length
+        self.cached = False  # True if this response came from the state cache rather than the bus
 
 
 class PositionerUnit:
@@ -487,7 +795,37 @@ class PositionerUnit:
     def update_connection(self, connection):
         self.connection = connection
 
-    def get_firmware(self):
+    @property
+    def state(self):
+        return get_state(self.pos_id)
+
+    def _cached(self, field, max_age, provenance=None):
+        '''Returns cached StateEntry for field, if max_age is not None and the cache has a
+        value no older than max_age seconds. Broadcast unit 0 never uses the cache.'''
+        if max_age is None or self.pos_id == 0:
+            return None
+        entry = self.state.get(field, max_age, provenance)
+        if entry and self.print:
+            print(f"pos{self.pos_id}-> {field} from cache: {entry}")
+        return entry
+
+    def _update_state(self, answer, field, value, provenance, timestamp=None):
+        for answer_inst in answer:
+            if answer_inst.response_raw == 0 and answer_inst.pos_id != 0:
+                get_state(answer_inst.pos_id).update(field, value, provenance, timestamp)
+
+    def _invalidate_state(self, answer, *fields):
+        for answer_inst in answer:
+            if answer_inst.pos_id != 0:
+                get_state(answer_inst.pos_id).invalidate(*fields)
+
+    def get_firmware(self, max_age=None):
+        entry = self._cached('firmware', max_age)
+        if entry:
+            answer_inst = Response(self.pos_id, 0)
+            answer_inst.firmware = entry.value
+            answer_inst.cached = True
+            return [answer_inst]
         answer = []
         for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
             replies = send_receive_CAN(connection, self.pos_id, POS_CMD_GET_FIRMWARE)
@@ -495,6 +833,10 @@ class PositionerUnit:
                 answer_inst = Response(reply[0], reply[1])  # create response instance
                 answer_inst.firmware = reply[2]
                 answer.append(answer_inst)
+                if answer_inst.response_raw == 0 and answer_inst.pos_id != 0:
+                    get_state(answer_inst.pos_id).update('firmware', answer_inst.firmware, 'measured')
+                    if answer_inst.pos_id == self.pos_id:
+                        self.firmware = answer_inst.firmware
                 if self.print:
                     if answer_inst.response_raw == 0:
                         print(f"pos{answer_inst.pos_id}-> firmware number: {answer_inst.firmware}")
@@ -559,6 +901,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> init datum: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> init datum error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def init_datum_alpha(self):
@@ -573,6 +916,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> init datum alpha: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> init datum alpha error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def init_datum_beta(self):
@@ -587,6 +931,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> init datum beta: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> init datum beta error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def calib_datum(self):
@@ -601,6 +946,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> calib datum: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> calib datum error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def calib_datum_alpha(self):
@@ -615,6 +961,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> calib datum alpha: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> calib datum alpha error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def calib_datum_beta(self):
@@ -629,6 +976,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> calib datum beta: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> calib datum beta error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def calib_motor(self):
@@ -643,6 +991,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> calib motor: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> calib motor error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def calib_motor_alpha(self):
@@ -657,6 +1006,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> calib motor alpha: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> calib motor alpha error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def calib_motor_beta(self):
@@ -671,6 +1021,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> calib motor beta: {answer_inst.response}")
                     else:
                         print(f"pos{answer_inst.pos_id}-> calib motor beta error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def get_datum_calib_error(self):
@@ -716,6 +1067,10 @@ class PositionerUnit:
                         f"pos{answer_inst.pos_id}-> go to: alpha={answer_inst.move_time_alpha}, beta={answer_inst.move_time_beta} [sec]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> go to error: {answer_inst.response}")
+        for answer_inst in answer:
+            if answer_inst.response_raw == 0 and answer_inst.pos_id != 0:
+                done = clock.time() + max(answer_inst.move_time_alpha, answer_inst.move_time_beta)
+                get_state(answer_inst.pos_id).update('position', (alpha, beta), 'commanded', timestamp=done)
         return answer
 
     def goto_relative(self, alpha, beta):
@@ -740,9 +1095,26 @@ class PositionerUnit:
                         f"pos{answer_inst.pos_id}-> go to relative: alpha={answer_inst.move_time_alpha}, beta={answer_inst.move_time_beta} [sec]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> go to relative error: {answer_inst.response}")
+        for answer_inst in answer:
+            if answer_inst.pos_id == 0:
+                continue
+            pos_state = get_state(answer_inst.pos_id)
+            previous = pos_state.entries.get('position')
+            if answer_inst.response_raw == 0 and previous:
+                done = clock.time() + max(answer_inst.move_time_alpha, answer_inst.move_time_beta)
+                target = (previous.value[0] + alpha, previous.value[1] + beta)
+                pos_state.update('position', target, 'commanded', timestamp=max(done, previous.timestamp))
+            else:
+                pos_state.invalidate('position')
         return answer
 
-    def get_pos(self):
+    def get_pos(self, max_age=None, provenance=None):
+        entry = self._cached('position', max_age, provenance)
+        if entry:
+            answer_inst = Response(self.pos_id, 0)
+            answer_inst.alpha, answer_inst.beta = entry.value
+            answer_inst.cached = True
+            return [answer_inst]
         answer = []
         for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
             replies = send_receive_CAN(connection, self.pos_id, POS_CMD_GET_ACTUAL_POSITION, receive_data_type=4)
@@ -761,6 +1133,9 @@ class PositionerUnit:
                             f"pos{answer_inst.pos_id}-> position: alpha={answer_inst.alpha}, beta={answer_inst.beta} [deg]")
                     else:
                         print(f"pos{answer_inst.pos_id}-> get position error: {answer_inst.response}")
+        for answer_inst in answer:
+            if answer_inst.response_raw == 0 and answer_inst.pos_id != 0:
+                get_state(answer_inst.pos_id).update('position', (answer_inst.alpha, answer_inst.beta), 'measured')
         return answer
 
     def set_pos(self, alpha, beta):
@@ -778,9 +1153,16 @@ class PositionerUnit:
                     print(f"pos{answer_inst.pos_id}-> position set: alpha={alpha}, beta={beta} [deg]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> position set error: {answer_inst.response}")
+        self._update_state(answer, 'position', (alpha, beta), 'commanded')
         return answer
 
-    def get_offsets(self):
+    def get_offsets(self, max_age=None, provenance=None):
+        entry = self._cached('offsets', max_age, provenance)
+        if entry:
+            answer_inst = Response(self.pos_id, 0)
+            answer_inst.alpha, answer_inst.beta = entry.value
+            answer_inst.cached = True
+            return [answer_inst]
         answer = []
         for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
             replies = send_receive_CAN(connection, self.pos_id, POS_CMD_GET_OFFSETS, receive_data_type=4)
@@ -799,6 +1181,9 @@ class PositionerUnit:
                             f"pos{answer_inst.pos_id}-> offset: alpha={answer_inst.alpha}, beta={answer_inst.beta} [deg]")
                     else:
                         print(f"pos{answer_inst.pos_id}-> get offset error: {answer_inst.response}")
+        for answer_inst in answer:
+            if answer_inst.response_raw == 0 and answer_inst.pos_id != 0:
+                get_state(answer_inst.pos_id).update('offsets', (answer_inst.alpha, answer_inst.beta), 'measured')
         return answer
 
     def set_offsets(self, alpha, beta):
@@ -815,6 +1200,7 @@ class PositionerUnit:
                     print(f"pos{answer_inst.pos_id}-> offset set: alpha={alpha}, beta={beta} [deg]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> offset set error: {answer_inst.response}")
+        self._update_state(answer, 'offsets', (alpha, beta), 'commanded')
         return answer
 
     def set_approach_distance(self, alpha, beta):
@@ -847,6 +1233,7 @@ class PositionerUnit:
                     print(f"pos{answer_inst.pos_id}-> speed set: alpha={alpha_speed}, beta={beta_speed} [rpm]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> speed set error: {answer_inst.response}")
+        self._update_state(answer, 'speed', (alpha_speed, beta_speed), 'commanded')
         return answer
 
     def set_current(self, alpha_current, beta_current):
@@ -867,6 +1254,7 @@ class PositionerUnit:
                     print(f"pos{answer_inst.pos_id}-> current set: alpha={alpha_current}, beta={beta_current} [rpm]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> current set error: {answer_inst.response}")
+        self._update_state(answer, 'current', (alpha_current, beta_current), 'commanded')
         return answer
 
     def get_hall_pos(self):
@@ -911,6 +1299,76 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> get motor calibration error: {answer_inst.response}")
         return answer
 
+    def get_alpha_hall_calib(self):
+        return self._get_hall_calib(POS_CMD_GET_ALPHA_HALL_CALIB, 'alpha')
+
+    def get_beta_hall_calib(self):
+        return self._get_hall_calib(POS_CMD_GET_BETA_HALL_CALIB, 'beta')
+
+    def _get_hall_calib(self, command, axis):
+        '''Hall sensors calibration values (maxA, maxB, minA, minB) of one axis, returned
+        in the response's alpha or beta attribute.'''
+        answer = []
+        for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
+            replies = send_receive_CAN(connection, self.pos_id, command, receive_data_type=7)
+            for reply in replies:  # one reply per positioner per command
+                answer_inst = Response(reply[0], reply[1])  # create response instance
+                values = list(reply[2]) + list(reply[3]) if answer_inst.response_raw == 0 else []
+                setattr(answer_inst, axis, values)
+                answer.append(answer_inst)
+                if self.print:
+                    if answer_inst.response_raw == 0:
+                        print(f"pos{answer_inst.pos_id}-> {axis} hall calibration (maxA, maxB, minA, minB): {values}")
+                    else:
+                        print(f"pos{answer_inst.pos_id}-> get {axis} hall calibration: {answer_inst.response}")
+        return answer
+
+    def get_cogging_length(self):
+        answer = []
+        for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
+            replies = send_receive_CAN(connection, self.pos_id, POS_CMD_GET_COGGING_LENGTH, receive_data_type=1)
+            for reply in replies:  # one reply per positioner per command
+                answer_inst = Response(reply[0], reply[1])  # create response instance
+                answer_inst.length = reply[2] if answer_inst.response_raw == 0 else None
+                answer.append(answer_inst)
+                if self.print:
+                    if answer_inst.response_raw == 0:
+                        print(f"pos{answer_inst.pos_id}-> cogging vectors length: {answer_inst.length}")
+                    else:
+                        print(f"pos{answer_inst.pos_id}-> get cogging vectors length: {answer_inst.response}")
+        return answer
+
+    def get_cogging_pos(self, alpha_index, beta_index):
+        return self._get_cogging_point(POS_CMD_GET_COGGING_POS, 'positive cogging', alpha_index, beta_index)
+
+    def get_cogging_neg(self, alpha_index, beta_index):
+        return self._get_cogging_point(POS_CMD_GET_COGGING_NEG, 'negative cogging', alpha_index, beta_index)
+
+    def get_cogging_angle(self, alpha_index, beta_index):
+        return self._get_cogging_point(POS_CMD_GET_COGGING_ANGLE, 'cogging angle', alpha_index, beta_index)
+
+    def _get_cogging_point(self, command, name, alpha_index, beta_index):
+        '''One point of the cogging vectors, at the argued index for each axis.'''
+        answer = []
+        for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
+            replies = send_receive_CAN(connection, self.pos_id, command, receive_data_type=4,
+                                       data1=alpha_index, data2=beta_index)
+            for reply in replies:  # one reply per positioner per command
+                answer_inst = Response(reply[0], reply[1])  # create response instance
+                if answer_inst.response_raw == 0:
+                    answer_inst.alpha = reply[2]
+                    answer_inst.beta = reply[3]
+                else:
+                    answer_inst.alpha = []
+                    answer_inst.beta = []
+                answer.append(answer_inst)
+                if self.print:
+                    if answer_inst.response_raw == 0:
+                        print(f"pos{answer_inst.pos_id}-> {name} [{alpha_index}, {beta_index}]: alpha={answer_inst.alpha}, beta={answer_inst.beta}")
+                    else:
+                        print(f"pos{answer_inst.pos_id}-> get {name}: {answer_inst.response}")
+        return answer
+
     def save(self):
         answer = []
         for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
@@ -943,9 +1401,16 @@ class PositionerUnit:
                     print(f"pos{answer_inst.pos_id}-> low power current set: alpha={alpha_current}, beta={beta_current} [%]")
                 else:
                     print(f"pos{answer_inst.pos_id}-> get low power current error: {answer_inst.response}")
+        self._update_state(answer, 'low_power_current', (alpha_current, beta_current), 'commanded')
         return answer
 
-    def get_low_power_current(self):
+    def get_low_power_current(self, max_age=None, provenance=None):
+        entry = self._cached('low_power_current', max_age, provenance)
+        if entry:
+            answer_inst = Response(self.pos_id, 0)
+            answer_inst.alpha, answer_inst.beta = entry.value
+            answer_inst.cached = True
+            return [answer_inst]
         answer = []
         for connection in self.connection:  # only broadcast comm 0 has multiple connection handles
             replies = send_receive_CAN(connection, self.pos_id, POS_CMD_GET_LOW_POWER_CURRENT, receive_data_type=4)
@@ -964,6 +1429,9 @@ class PositionerUnit:
                             f"pos{answer_inst.pos_id}-> low power current: alpha={answer_inst.alpha}, beta={answer_inst.beta} [deg]")
                     else:
                         print(f"pos{answer_inst.pos_id}-> get low power current error: {answer_inst.response}")
+        for answer_inst in answer:
+            if answer_inst.response_raw == 0 and answer_inst.pos_id != 0:
+                get_state(answer_inst.pos_id).update('low_power_current', (answer_inst.alpha, answer_inst.beta), 'measured')
         return answer
 
     def switch_on_hall(self):  # broadcast command
@@ -1006,6 +1474,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> Alpha: closed loop, collision detection on")
                     else:
                         print(f"pos{answer_inst.pos_id}-> set alpha closed loop error: {answer_inst.response}")
+        self._update_state(answer, 'alpha_loop', ('closed', True), 'commanded')
         return answer
 
     def set_alpha_closed_loop_no_coll_detect(self):
@@ -1021,6 +1490,7 @@ class PositionerUnit:
                     else:
                         print(
                             f"pos{answer_inst.pos_id}-> set alpha closed loop, coll detect off error: {answer_inst.response}")
+        self._update_state(answer, 'alpha_loop', ('closed', False), 'commanded')
         return answer
 
     def set_alpha_open_loop(self):
@@ -1035,6 +1505,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> Alpha: open loop, collision detection on")
                     else:
                         print(f"pos{answer_inst.pos_id}-> set alpha open loop error: {answer_inst.response}")
+        self._update_state(answer, 'alpha_loop', ('open', True), 'commanded')
         return answer
 
     def set_alpha_open_loop_no_coll_detect(self):
@@ -1050,6 +1521,7 @@ class PositionerUnit:
                     else:
                         print(
                             f"pos{answer_inst.pos_id}-> set alpha open loop, coll detect off error: {answer_inst.response}")
+        self._update_state(answer, 'alpha_loop', ('open', False), 'commanded')
         return answer
 
     def set_beta_closed_loop(self):
@@ -1064,6 +1536,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> Beta: closed loop, collision detection on")
                     else:
                         print(f"pos{answer_inst.pos_id}-> set beta closed loop error: {answer_inst.response}")
+        self._update_state(answer, 'beta_loop', ('closed', True), 'commanded')
         return answer
 
     def set_beta_closed_loop_no_coll_detect(self):
@@ -1079,6 +1552,7 @@ class PositionerUnit:
                     else:
                         print(
                             f"pos{answer_inst.pos_id}-> set beta closed loop, coll detect off error: {answer_inst.response}")
+        self._update_state(answer, 'beta_loop', ('closed', False), 'commanded')
         return answer
 
     def set_beta_open_loop(self):
@@ -1093,6 +1567,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> Beta: open loop, collision detection on")
                     else:
                         print(f"pos{answer_inst.pos_id}-> set beta open loop error: {answer_inst.response}")
+        self._update_state(answer, 'beta_loop', ('open', True), 'commanded')
         return answer
 
     def set_beta_open_loop_no_coll_detect(self):
@@ -1108,6 +1583,7 @@ class PositionerUnit:
                     else:
                         print(
                             f"pos{answer_inst.pos_id}-> set beta open loop, coll detect off error: {answer_inst.response}")
+        self._update_state(answer, 'beta_loop', ('open', False), 'commanded')
         return answer
 
     def switch_on_led(self):
@@ -1206,16 +1682,25 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> rebooting")
                     else:
                         print(f"pos{answer_inst.pos_id}-> request reboot error: {answer_inst.response}")
-        time.sleep(0.1)  # 2021-10-13 [Joe Silber] needed so that successive request_reboots don't interfere
+        clock.sleep(0.1)  # 2021-10-13 [Joe Silber] needed so that successive request_reboots don't interfere
+        for answer_inst in answer:
+            if answer_inst.pos_id != 0:
+                get_state(answer_inst.pos_id).invalidate(*[f for f in PositionerState.fields if f != 'firmware'])
         return answer
 
     def send_trajectory(self, alpha_traj, beta_traj):
+        '''Uploads trajectories alpha_traj and beta_traj, lists of [angle_deg, time_s]
+        points. Angles are absolute and may be negative (they are sent as signed int32
+        motor steps, like goto_absolute). Times must be non-negative.'''
         answer = []
 
-        alpha_traj = [[data_point[0] / 360 * POS_MOTOR_STEPS, data_point[1] / POS_TIME_STEP] for data_point in
-                      alpha_traj]
-        beta_traj = [[data_point[0] / 360 * POS_MOTOR_STEPS, data_point[1] / POS_TIME_STEP] for data_point in
-                     beta_traj]
+        alpha_traj = [[int(round(data_point[0] / 360 * POS_MOTOR_STEPS)), int(round(data_point[1] / POS_TIME_STEP))]
+                      for data_point in alpha_traj]
+        beta_traj = [[int(round(data_point[0] / 360 * POS_MOTOR_STEPS)), int(round(data_point[1] / POS_TIME_STEP))]
+                     for data_point in beta_traj]
+        for position, time_step in alpha_traj + beta_traj:
+            assert -2 ** 31 <= position < 2 ** 31, f'trajectory position {position} steps does not fit in int32'
+            assert 0 <= time_step < 2 ** 31, f'trajectory time {time_step} steps is negative or does not fit in int32'
 
         # start sending trajectory
         replies = send_receive_CAN(self.connection[0], self.pos_id, POS_CMD_SEND_TRAJECTORY_NEW,
@@ -1233,7 +1718,7 @@ class PositionerUnit:
         # send trajectory alpha
         for data_point in alpha_traj:
             replies = send_receive_CAN(self.connection[0], self.pos_id, POS_CMD_SEND_TRAJECTORY_DATA,
-                                       data1=abs(int(round(data_point[0]))), data2=abs(int(round(data_point[1]))))
+                                       data1=data_point[0], data2=data_point[1])
             reply = replies[0]
             # print(f'alpha data point: {pos_response_code[reply[1]]}')
             if reply[1] != 0:  # if command is not accepted return
@@ -1246,7 +1731,7 @@ class PositionerUnit:
         # send trajectory beta
         for data_point in beta_traj:
             replies = send_receive_CAN(self.connection[0], self.pos_id, POS_CMD_SEND_TRAJECTORY_DATA,
-                                       data1=abs(int(round(data_point[0]))), data2=abs(int(round(data_point[1]))))
+                                       data1=data_point[0], data2=data_point[1])
             reply = replies[0]
             # print(f'beta data point: {pos_response_code[reply[1]]}')
             if reply[1] != 0:  # if command is not accepted return
@@ -1283,6 +1768,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> start trajectory")
                     else:
                         print(f"pos{answer_inst.pos_id}-> start trajectory error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def stop_and_clear_collision_flag(self):
@@ -1297,6 +1783,7 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> stop positioner and clear collision flags")
                     else:
                         print(f"pos{answer_inst.pos_id}-> error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def stop(self):  # This command is used to stop the motion of the actuators. It will also reset the trajectories
@@ -1312,13 +1799,14 @@ class PositionerUnit:
                         print(f"pos{answer_inst.pos_id}-> stop positioner")
                     else:
                         print(f"pos{answer_inst.pos_id}-> error: {answer_inst.response}")
+        self._invalidate_state(answer, 'position')
         return answer
 
     def get_alpha_reduction_ratio(self):
         answer = []
         # request reboot
         self.request_reboot()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         # get factory settings
         replies = send_receive_CAN(self.connection[0], self.pos_id, POS_BOOTLOADER_GET_FACTORY_SETTING,
                                    data1=POS_BOOTLOADER_PARAM_ALPHA_REDUCTION, receive_data_type=2)
@@ -1338,7 +1826,7 @@ class PositionerUnit:
         answer = []
         # request reboot
         self.request_reboot()
-        time.sleep(0.1)
+        clock.sleep(0.1)
         # get factory settings
         replies = send_receive_CAN(self.connection[0], self.pos_id, POS_BOOTLOADER_GET_FACTORY_SETTING,
                                    data1=POS_BOOTLOADER_PARAM_BETA_REDUCTION, receive_data_type=2)
@@ -1409,7 +1897,6 @@ class PositionerUnit:
         return answer
 
     def upgrade_firmware(self, firmwareFile):
-        import time
         import zlib
 
         # read the new firmware and store the frames to send
@@ -1430,15 +1917,15 @@ class PositionerUnit:
         # print(firmwareFrames)
         print(
             f"pos{self.pos_id}-> Firmware length: {data['firmwareLength']} Bytes, checksum is {data['firmwareChecksum']}")
-        tStart = time.perf_counter()
+        tStart = clock.perf_counter()
         print(f"pos{self.pos_id}-> Upgrading firmware")
 
         self.request_reboot()
-        time.sleep(2)
+        clock.sleep(2)
 
         replies = send_receive_CAN(self.connection[0], self.pos_id, POS_BOOTLOADER_SEND_NEW_FIRMWARE,
                                    data1=data['firmwareLength'], data2=data['firmwareChecksum'], can_receive_delay=10)
-        time.sleep(2)
+        clock.sleep(2)
         reply = replies[0]
         if reply[1] != 0:
             answer_inst = Response(reply[0], reply[1])  # create response instance
@@ -1503,4 +1990,5 @@ class PositionerUnit:
         else:
             print(f"pos{self.pos_id}-> Firmware upgrade failed")
 
-        print(f"pos{self.pos_id}-> Total time: {time.perf_counter() - tStart:.2f} [s]")
+        print(f"pos{self.pos_id}-> Total time: {clock.perf_counter() - tStart:.2f} [s]")
+        self.state.invalidate('firmware')
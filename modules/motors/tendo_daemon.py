@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''Local daemon which owns the CAN connections and the Positioners registry, and
+serves positioner commands over a Unix domain socket. Any number of scripts can then
+share the bus, without each one re-probing serial ports, reopening the Lawicel channel
+and rediscovering the robots.
+
+Start the daemon once, from the command line:
+    python tendo_daemon.py
+
+Then in your scripts, replace tendo.Positioners with the thin client:
+    from tendo_daemon import RemotePositioners
+    pos = RemotePositioners()
+    for p in pos.available_positioners():
+        pos[p].goto(30, 90)
+
+The client has the same calling interface as Positioners and PositionerUnit. Return
+values have the same attributes as the tendo.Response instances etc (they are generic
+namespace objects on the client side). Printouts made by the commands in the daemon
+are relayed back to the client and printed there, according to the client unit's
+'print' flag.
+
+PROTOCOL:
+
+    One JSON object per line, in each direction. Request:
+        {"target": <pos_id or "positioners">, "method": <name>, "args": [...], "kwargs": {...}}
+    Reply:
+        {"ok": true, "result": <encoded result>, "stdout": <captured printouts>}
+        {"ok": false, "error": <message>, "stdout": <captured printouts>}
+
+    Target 0 is the broadcast unit (Positioners.all). Target "daemon" with method
+    "commands" returns the names of the commands available, as a dict with keys
+    "positioners" and "unit". Results are encoded such that
+    objects become {"__class__": name, "attrs": {...}} and dicts become
+    {"__dict__": [[key, value], ...]}, preserving integer keys like pos_id.
+
+Commands are executed one at a time, in the order received. Only the printouts of the
+thread executing a command are relayed with it; those of other threads in the daemon
+(e.g. the quarantine probe) go to the daemon's own stdout.
+'''
+import os
+import io
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import threading
+import contextlib
+import socketserver
+from types import SimpleNamespace
+
+default_socket_path = os.path.join(tempfile.gettempdir(), 'fiberbots_tendo.sock')
+
+
+def encode(obj):
+    '''Converts a command result into JSON-compatible form.'''
+    if isinstance(obj, dict):
+        return {'__dict__': [[encode(k), encode(v)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple, set)):
+        return [encode(x) for x in obj]
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        return obj
+    if hasattr(obj, '__dict__'):
+        attrs = {k: encode(v) for k, v in vars(obj).items() if not k.startswith('_')}
+        return {'__class__': type(obj).__name__, 'attrs': attrs}
+    return str(obj)
+
+
+def decode(obj):
+    '''Inverse of encode(). Objects come back as SimpleNamespace instances.'''
+    if isinstance(obj, list):
+        return [decode(x) for x in obj]
+    if isinstance(obj, dict):
+        if '__dict__' in obj:
+            return {_hashable(decode(k)): decode(v) for k, v in obj['__dict__']}
+        if '__class__' in obj:
+            return SimpleNamespace(**{k: decode(v) for k, v in obj['attrs'].items()})
+        return {k: decode(v) for k, v in obj.items()}
+    return obj
+
+
+def _hashable(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+def public_methods(cls):
+    '''Returns sorted list of names of the public methods of class cls.'''
+    return sorted(name for name in dir(cls) if not name.startswith('_') and callable(getattr(cls, name, None)))
+
+
+class _ThreadStdout(io.TextIOBase):
+    '''Stands in for sys.stdout, writing the printouts of any thread which is capturing
+    them into its own buffer, and all others to the real stdout.'''
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        return (self.stdout if buffer is None else buffer).write(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+    @contextlib.contextmanager
+    def capture(self):
+        '''Context in which the calling thread's printouts go to the yielded StringIO.'''
+        self.local.buffer = io.StringIO()
+        try:
+            yield self.local.buffer
+        finally:
+            self.local.buffer = None
+
+
+class TendoDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Serves commands to a tendo.Positioners instance over a Unix domain socket.'''
+    daemon_threads = True
+
+    def __init__(self, positioners, socket_path=default_socket_path):
+        self.positioners = positioners
+        self.socket_path = socket_path
+        self.lock = threading.Lock()
+        from tendo import PositionerUnit  # not from positioners.all, which only exists if any were found
+        self.commands = {'positioners': public_methods(type(positioners)), 'unit': public_methods(PositionerUnit)}
+        if not isinstance(sys.stdout, _ThreadStdout):
+            sys.stdout = _ThreadStdout(sys.stdout)
+        self.stdout = sys.stdout
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # stale from a previous run
+        super().__init__(socket_path, _RequestHandler)
+
+    def execute(self, request):
+        '''Executes one decoded request, returning the reply dict.'''
+        with self.lock, self.stdout.capture() as stdout:
+            try:
+                if request['target'] == 'daemon' and request['method'] == 'commands':
+                    return {'ok': True, 'result': encode(self.commands), 'stdout': ''}
+                target = self._resolve(request['target'])
+                method = request['method']
+                if method not in self.commands['positioners' if request['target'] == 'positioners' else 'unit']:
+                    raise AttributeError(f'no command {method} for target {request["target"]}')
+                print_flag = request.get('print', True)
+                previous = getattr(target, 'print', None)
+                if previous is not None:
+                    target.print = print_flag
+                try:
+                    result = getattr(target, method)(*request.get('args', []), **request.get('kwargs', {}))
+                finally:
+                    if previous is not None:
+                        target.print = previous
+                reply = {'ok': True, 'result': encode(result)}
+            except Exception as e:
+                reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+        reply['stdout'] = stdout.getvalue()
+        return reply
+
+    def _resolve(self, target):
+        if target == 'positioners':
+            return self.positioners
+        if target == 0:
+            return self.positioners.all
+        return self.positioners[target]
+
+    def server_close(self):
+        super().server_close()
+        if sys.stdout is self.stdout:
+            sys.stdout = self.stdout.stdout
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                reply = {'ok': False, 'error': f'bad request: {e}', 'stdout': ''}
+            else:
+                reply = self.server.execute(request)
+            self.wfile.write((json.dumps(reply) + '\n').encode())
+            self.wfile.flush()
+
+
+class RemotePositioners:
+    '''Thin client for a running TendoDaemon, with the calling interface of tendo.Positioners.'''
+
+    def __init__(self, socket_path=default_socket_path):
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(socket_path)
+        self._file = self._sock.makefile('rwb')
+        self._units = {}  # pos_id --> RemotePositionerUnit, so that attributes set on them persist
+        self._commands = {k: set(v) for k, v in self.call('daemon', 'commands', print_output=False).items()}
+
+    def call(self, target, method, *args, print_output=True, **kwargs):
+        '''Sends one command to the daemon and returns its decoded result. Raises
+        RuntimeError if the command failed within the daemon.'''
+        request = {'target': target, 'method': method, 'args': list(args), 'kwargs': kwargs,
+                   'print': print_output}
+        with self._lock:
+            self._file.write((json.dumps(request) + '\n').encode())
+            self._file.flush()
+            line = self._file.readline()
+        if not line:
+            raise ConnectionError(f'tendo daemon at {self.socket_path} closed the connection')
+        reply = json.loads(line)
+        if print_output and reply['stdout']:
+            print(reply['stdout'], end='')
+        if not reply['ok']:
+            raise RuntimeError(f'tendo daemon: {reply["error"]}')
+        return decode(reply['result'])
+
+    def __getitem__(self, key):
+        if key not in self._units:
+            self._units[key] = RemotePositionerUnit(self, key)
+        return self._units[key]
+
+    def __iter__(self):
+        return iter(self.list_positioners(pr=False))
+
+    @property
+    def all(self):
+        return self[0]
+
+    def connect(self, *args, **kwargs):
+        '''The daemon already holds the connections, so there is nothing to do here.
+        Kept so that scripts written for Positioners run unmodified.'''
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._commands['positioners']:
+            raise AttributeError(f'{type(self).__name__} has no command {name}')
+        return lambda *args, **kwargs: self.call('positioners', name, *args, **kwargs)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+
+class RemotePositionerUnit:
+    '''Client-side stand-in for tendo.PositionerUnit.'''
+
+    def __init__(self, client, pos_id):
+        self.client = client
+        self.pos_id = pos_id
+        self.print = True
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.client._commands['unit']:
+            raise AttributeError(f'{type(self).__name__} has no command {name}')
+        return lambda *args, **kwargs: self.client.call(self.pos_id, name, *args, print_output=self.print, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--socket', type=str, default=default_socket_path, help='path of the Unix domain socket')
+    parser.add_argument('-n', '--serial', type=str, default=None, help='serial number of the Lawicel device to use (default is the first found)')
+    parser.add_argument('-p', '--probe_interval', type=float, default=None, help='period in sec of the quarantine probe (default per defines.py)')
+    inputs = parser.parse_args()
+
+    sys.path.append(os.path.realpath(os.path.join(os.path.dirname(__file__), '..')))  # for common modules
+    from tendo import Positioners
+    pos = Positioners()
+    pos.connect(desiredserial=inputs.serial)
+    if inputs.probe_interval is None:
+        pos.start_quarantine_probe()
+    else:
+        pos.start_quarantine_probe(inputs.probe_interval)
+    server = TendoDaemon(pos, inputs.socket)
+    print(f'tendo daemon serving on {inputs.socket}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('tendo daemon shutting down')
+    finally:
+        server.server_close()
+        pos.stop_quarantine_probe()
+        pos.close_connection(list(range(len(pos.connections)))[::-1])
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''
+Positions and arm lengths of the robots in an array, with an index of which robots'
+patrol zones overlap.
+
+Each robot's patrol zone is the disk it can reach, centered on its alpha axis with
+radius LENGTH_A + LENGTH_B (see trillium_transforms.py), plus an optional margin for
+the width of the arms. Two robots are neighbors if their patrol disks overlap. The
+overlapping pairs are found once, when the layout is loaded, with a KD-tree, and
+stored. So thereafter looking up the neighbors of a robot is O(1), and iterating
+over all overlapping pairs is O(N).
+
+The layout is read from a csv file in the data directory, with columns:
+
+    pos_id      ... int, positioner id
+    center_x    ... mm, CENTER_X, global position of the robot's alpha axis
+    center_y    ... mm, CENTER_Y
+    length_a    ... mm, LENGTH_A, kinematic length of alpha arm
+    length_b    ... mm, LENGTH_B, kinematic length of beta arm
+    offset_a    ... deg, OFFSET_A, alpha zero-point in the global system (optional, default 0)
+    limit_a0, limit_a1, limit_b0, limit_b1 ... deg, travel limits in arm coordinates
+                    (optional, defaults are trillium_transforms.nom_limits_a, nom_limits_b)
+
+Example:
+    from robot_layout import RobotLayout
+    layout = RobotLayout.from_csv()
+    layout.neighbors(1234)  # --> list of pos_ids
+    for pos_a, pos_b in layout.pair_ids: ...
+'''
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.table import Table
+import globals as gl
+from trillium_transforms import nom_limits_a, nom_limits_b
+
+default_path = os.path.join(gl.dirs['data'], 'robot_layout.csv')
+
+
+class RobotLayout:
+    '''Robot centers and arm lengths, with precomputed patrol zone overlaps.
+
+    INPUTS:
+        pos_ids ... sequence of positioner ids
+        center_x, center_y ... [mm] arrays of robot centers in the global system
+        length_a, length_b ... [mm] arrays (or scalars) of arm lengths
+        offset_a ... [deg] array (or scalar) of alpha zero-points in the global system
+        limits_a, limits_b ... [deg] travel limits as [lower, upper], each scalar or array
+        margin ... [mm] added to each patrol radius, e.g. for the arms' half-width
+    '''
+    def __init__(self, pos_ids, center_x, center_y, length_a, length_b, offset_a=0.,
+                 limits_a=nom_limits_a, limits_b=nom_limits_b, margin=0.):
+        self.pos_ids = np.asarray(pos_ids, dtype=int)
+        n = len(self.pos_ids)
+        self.center_x = np.broadcast_to(np.asarray(center_x, dtype=float), n).copy()
+        self.center_y = np.broadcast_to(np.asarray(center_y, dtype=float), n).copy()
+        self.length_a = np.broadcast_to(np.asarray(length_a, dtype=float), n).copy()
+        self.length_b = np.broadcast_to(np.asarray(length_b, dtype=float), n).copy()
+        self.offset_a = np.broadcast_to(np.asarray(offset_a, dtype=float), n).copy()
+        self.limits_a = [np.broadcast_to(np.asarray(lim, dtype=float), n).copy() for lim in limits_a]
+        self.limits_b = [np.broadcast_to(np.asarray(lim, dtype=float), n).copy() for lim in limits_b]
+        self.margin = margin
+        self._row = {pos_id: i for i, pos_id in enumerate(self.pos_ids)}
+        assert len(self._row) == n, 'duplicate pos_ids in layout'
+        self._build_index()
+
+    @classmethod
+    def from_csv(cls, path=default_path, margin=0.):
+        '''Loads layout from a csv file (see module docstring for its columns).'''
+        t = Table.read(path, format='ascii.csv')
+        optional = lambda name, default: t[name] if name in t.colnames else default
+        limits_a = [optional('limit_a0', nom_limits_a[0]), optional('limit_a1', nom_limits_a[1])]
+        limits_b = [optional('limit_b0', nom_limits_b[0]), optional('limit_b1', nom_limits_b[1])]
+        return cls(t['pos_id'], t['center_x'], t['center_y'], t['length_a'], t['length_b'],
+                   offset_a=optional('offset_a', 0.), limits_a=limits_a, limits_b=limits_b, margin=margin)
+
+    def subset(self, pos_ids):
+        '''Returns a new RobotLayout with only the argued robots.'''
+        r = self.rows(pos_ids)
+        return RobotLayout(self.pos_ids[r], self.center_x[r], self.center_y[r], self.length_a[r], self.length_b[r],
+                           offset_a=self.offset_a[r], limits_a=[lim[r] for lim in self.limits_a],
+                           limits_b=[lim[r] for lim in self.limits_b], margin=self.margin)
+
+    def __len__(self):
+        return len(self.pos_ids)
+
+    @property
+    def patrol_radius(self):
+        '''[mm] Radius of each robot's patrol disk, including margin.'''
+        return self.length_a + self.length_b + self.margin
+
+    def row(self, pos_id):
+        '''Index of pos_id in the layout's arrays.'''
+        return self._row[pos_id]
+
+    def rows(self, pos_ids):
+        return np.array([self._row[p] for p in pos_ids], dtype=int)
+
+    def _build_index(self):
+        '''Finds all pairs of robots whose patrol disks overlap.'''
+        radius = self.patrol_radius
+        xy = np.column_stack([self.center_x, self.center_y])
+        if len(xy) > 1:
+            candidates = cKDTree(xy).query_pairs(r=2*radius.max(), output_type='ndarray')
+        else:
+            candidates = np.zeros((0, 2), dtype=int)
+        i, j = candidates[:, 0], candidates[:, 1]
+        distance = np.hypot(xy[i, 0] - xy[j, 0], xy[i, 1] - xy[j, 1])
+        overlaps = distance < radius[i] + radius[j]
+        pairs = np.sort(candidates[overlaps], axis=1)
+        self.pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]  # (M, 2) row indices, i < j
+        self.pair_ids = self.pos_ids[self.pairs]  # (M, 2) pos_ids
+        both = np.concatenate([self.pairs, self.pairs[:, ::-1]])
+        both = both[np.lexsort((both[:, 1], both[:, 0]))]
+        splits = np.searchsorted(both[:, 0], np.arange(len(self)))
+        self._neighbor_rows = np.split(both[:, 1], splits[1:])
+
+    def neighbor_rows(self, row):
+        '''Array of row indices of robots whose patrol disks overlap that of robot at row.'''
+        return self._neighbor_rows[row]
+
+    def neighbors(self, pos_id):
+        '''List of pos_ids of robots whose patrol disks overlap that of pos_id.'''
+        return self.pos_ids[self._neighbor_rows[self._row[pos_id]]].tolist()
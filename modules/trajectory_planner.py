@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+'''
+Plans coordinated moves of many robots, producing the [angle_deg, time_s] point lists
+which PositionerUnit.send_trajectory() uploads.
+
+Each robot moves from its start to its target (a_arm, b_arm) along a straight line in
+arm space. Its alpha and beta motors follow one shared trapezoidal speed profile,
+scaled so that the motor with the longer travel is limited by max_speed and
+max_accel, while the other one finishes at the same time.
+
+If a CollisionChecker is given, the sampled fleet move is checked, and neighbors
+which would collide are deconflicted, in order of preference:
+    1. Retract beta first: the robot folds its beta arm to retract_b, rotates alpha,
+       then unfolds beta to its target.
+    2. Time-shift: one robot of the pair waits until the other has finished.
+Any collisions still remaining after max_iterations are reported in the plan.
+
+ANGLE CONVERSIONS:
+
+    Arm angles are converted to gearbox output angles with trillium_transforms.arm2box,
+    then to motor angles with box2mot and the true ratio gl.gear_ratio[motor_name].
+    The firmware internally multiplies trajectory angles by its own (integer)
+    reduction ratio, as set by set_alpha/beta_reduction_ratio(). So the values in the
+    output lists are motor angles divided by firmware_ratio, which by default is the
+    same rounded ratio used in bin/control/move.py.
+
+Example:
+    from robot_layout import RobotLayout
+    from collisions import CollisionChecker
+    from trajectory_planner import TrajectoryPlanner
+    layout = RobotLayout.from_csv()
+    checker = CollisionChecker(layout, half_width_a=1.0, half_width_b=1.0)
+    planner = TrajectoryPlanner(checker)
+    plan = planner.plan(start={1234: (0, 90), ...}, target={1234: (45, 120), ...})
+    planner.upload(pos, plan, start=True)  # pos is a tendo.Positioners
+'''
+import numpy as np
+import globals as gl
+from trillium_transforms import arm2box, box2mot, nom_idler, nom_limits_b
+
+# Nominal motor limits. These are conservative defaults; set per your hardware.
+nom_max_speed = 5000.  # rpm at the motor
+nom_max_accel = 20000.  # rpm/s at the motor
+
+
+class RobotPlan:
+    '''Planned move of one robot, as a list of arm-space waypoints, each segment of
+    which is traversed with a trapezoidal profile, starting after a delay.'''
+    def __init__(self, pos_id, waypoints, delay=0.):
+        self.pos_id = pos_id
+        self.waypoints = [tuple(float(x) for x in w) for w in waypoints]
+        self.delay = delay
+        self.retracted = False
+        self.segments = []  # list of (duration, accel time) per segment [s]
+
+    @property
+    def duration(self):
+        '''[s] Time from start of the fleet move until this robot is done.'''
+        return self.delay + sum(seg[0] for seg in self.segments)
+
+    def sample(self, t):
+        '''Returns arm angles (a_arm, b_arm) at times t [s], an array.'''
+        t = np.asarray(t, dtype=float)
+        a = np.full(t.shape, self.waypoints[0][0])
+        b = np.full(t.shape, self.waypoints[0][1])
+        t0 = self.delay
+        for (duration, t_acc), (a0, b0), (a1, b1) in zip(self.segments, self.waypoints[:-1], self.waypoints[1:]):
+            s = trapezoid_position(t - t0, duration, t_acc)
+            active = t >= t0
+            a = np.where(active, a0 + (a1 - a0)*s, a)
+            b = np.where(active, b0 + (b1 - b0)*s, b)
+            t0 += duration
+        return a, b
+
+    def __repr__(self):
+        mode = ', beta retracted' if self.retracted else ''
+        return f'pos{self.pos_id}-> {len(self.segments)} segments, delay {self.delay:.2f} s, done at {self.duration:.2f} s{mode}'
+
+
+class FleetPlan:
+    '''Result of TrajectoryPlanner.plan().
+
+    robots ... dict with keys pos_id and values RobotPlan
+    trajectories ... dict with keys pos_id and values (alpha_traj, beta_traj), for send_trajectory()
+    collisions ... dict with keys (pos_id, pos_id) and values time [s] of the first
+                   predicted collision, for any which could not be resolved
+    duration ... [s] time until the last robot is done
+    '''
+    def __init__(self, robots, trajectories, collisions):
+        self.robots = robots
+        self.trajectories = trajectories
+        self.collisions = collisions
+        self.duration = max((r.duration for r in robots.values()), default=0.)
+
+
+class TrajectoryPlanner:
+    '''Makes velocity- and acceleration-limited, collision-deconflicted fleet moves.
+
+    INPUTS:
+        checker ... collisions.CollisionChecker for the robots, or None to skip collision checks
+        motor_name ... key of gl.gear_ratio
+        firmware_ratio ... reduction ratio set in the firmware (default rounded true ratio)
+        max_speed ... [rpm] max motor speed
+        max_accel ... [rpm/s] max motor acceleration
+        time_step ... [s] spacing of the output trajectory points
+        check_step ... [s] spacing of the collision check samples
+        retract_b ... [deg] b_arm to which beta is folded when deconflicting
+        idler ... idler gear ratios, see trillium_transforms
+        max_iterations ... max number of deconfliction passes
+        printfunc ... function handle, to specify alternate to print (i.e. your logger)
+    '''
+    def __init__(self, checker=None, motor_name='namiki', firmware_ratio=None, max_speed=nom_max_speed,
+                 max_accel=nom_max_accel, time_step=0.1, check_step=0.05, retract_b=max(nom_limits_b),
+                 idler=nom_idler, max_iterations=10, printfunc=print):
+        self.checker = checker
+        self.gear_ratio = gl.gear_ratio[motor_name]
+        self.firmware_ratio = round(self.gear_ratio) if firmware_ratio is None else firmware_ratio
+        self.max_speed = max_speed * 6.0  # deg/s
+        self.max_accel = max_accel * 6.0  # deg/s^2
+        self.time_step = time_step
+        self.check_step = check_step
+        self.retract_b = retract_b
+        self.idler = idler
+        self.max_iterations = max_iterations
+        self.printfunc = printfunc
+
+    def plan(self, start, target):
+        '''Plans a fleet move. Start and target are dicts with keys pos_id and values
+        (a_arm, b_arm). Robots which should stay still may be included with target equal
+        to start, so that they are accounted for in the collision checks. Returns a
+        FleetPlan.'''
+        robots = {}
+        for pos_id in target:
+            robots[pos_id] = RobotPlan(pos_id, [start[pos_id], target[pos_id]])
+            self._time_segments(robots[pos_id])
+        collisions = self._deconflict(robots) if self.checker else {}
+        trajectories = {pos_id: self.trajectory(robot) for pos_id, robot in robots.items()}
+        plan = FleetPlan(robots, trajectories, collisions)
+        retracted = sum(r.retracted for r in robots.values())
+        delayed = sum(r.delay > 0 for r in robots.values())
+        self.printfunc(f'Planned move of {len(robots)} robots: duration {plan.duration:.2f} s, {retracted} with'
+                       f' beta retracted, {delayed} delayed, {len(collisions)} unresolved collisions')
+        return plan
+
+    def _time_segments(self, robot):
+        '''Computes duration and accel time of each segment of robot's waypoints.'''
+        robot.segments = []
+        for w0, w1 in zip(robot.waypoints[:-1], robot.waypoints[1:]):
+            box0 = arm2box(*w0, idler=self.idler)
+            box1 = arm2box(*w1, idler=self.idler)
+            travel = max(abs(box2mot(box1[i] - box0[i], self.gear_ratio)) for i in range(2))
+            robot.segments.append(trapezoid(travel, self.max_speed, self.max_accel))
+
+    def _retract(self, robot):
+        (a0, b0), (a1, b1) = robot.waypoints[0], robot.waypoints[-1]
+        robot.waypoints = [(a0, b0), (a0, self.retract_b), (a1, self.retract_b), (a1, b1)]
+        robot.retracted = True
+        self._time_segments(robot)
+
+    def sample(self, robots, pos_ids, t):
+        '''Returns arm angles of shape (len(t), len(pos_ids)) at times t [s].'''
+        angles = [robots[p].sample(t) for p in pos_ids]
+        a_arm = np.stack([a for a, b in angles], axis=-1)
+        b_arm = np.stack([b for a, b in angles], axis=-1)
+        return a_arm, b_arm
+
+    def _deconflict(self, robots):
+        '''Retracts or delays robots until no collisions are predicted, or max_iterations
+        is reached. Returns dict of any remaining collisions.'''
+        checker = self.checker
+        pos_ids = checker.layout.pos_ids.tolist()
+        missing = set(pos_ids) - set(robots)
+        assert not missing, f'no start / target for robots in checker layout: {sorted(missing)}'
+        for iteration in range(self.max_iterations + 1):
+            t = np.arange(0., max(r.duration for r in robots.values()) + self.check_step, self.check_step)
+            a_arm, b_arm = self.sample(robots, pos_ids, t)
+            first = checker.first_collisions(a_arm, b_arm)
+            if not first or iteration == self.max_iterations:
+                return {pair: float(t[i]) for pair, i in first.items()}
+            for (p, q), i in sorted(first.items(), key=lambda item: item[1]):
+                if not (robots[p].retracted and robots[q].retracted):
+                    for robot in (robots[p], robots[q]):
+                        if not robot.retracted:
+                            self._retract(robot)
+                else:
+                    # the robot which would finish sooner goes first, the other waits
+                    first_robot, waiting = sorted([robots[p], robots[q]], key=lambda r: (r.duration, r.pos_id))
+                    waiting.delay = max(waiting.delay, first_robot.duration)
+
+    def trajectory(self, robot):
+        '''Returns (alpha_traj, beta_traj), lists of [angle_deg, time_s] points for
+        PositionerUnit.send_trajectory(). Angles are absolute, so may be negative.'''
+        times = [0.]
+        t0 = robot.delay
+        for duration, t_acc in robot.segments:
+            n = max(1, int(np.ceil(duration / self.time_step)))
+            times.extend(t0 + np.linspace(0., duration, n + 1)[int(t0 == 0):])
+            t0 += duration
+        times = np.unique(np.round(times, 6))
+        a_arm, b_arm = robot.sample(times)
+        a_box, b_box = arm2box(a_arm, b_arm, idler=self.idler)
+        alpha = box2mot(a_box, self.gear_ratio) / self.firmware_ratio
+        beta = box2mot(b_box, self.gear_ratio) / self.firmware_ratio
+        alpha_traj = [[float(angle), float(t)] for angle, t in zip(alpha, times)]
+        beta_traj = [[float(angle), float(t)] for angle, t in zip(beta, times)]
+        return alpha_traj, beta_traj
+
+    def upload(self, positioners, plan, start=False):
+        '''Sends each robot's trajectory with send_trajectory(). If start is True and all
+        uploads succeeded, then broadcasts start_trajectory(). Returns dict with keys
+        pos_id and values the response text, for those which failed.'''
+        failed = {}
+        for pos_id, (alpha_traj, beta_traj) in plan.trajectories.items():
+            reply = positioners[pos_id].send_trajectory(alpha_traj, beta_traj)[-1]
+            if reply.response_raw != 0:
+                failed[pos_id] = reply.response
+        if failed:
+            self.printfunc(f'Trajectory upload failed for {len(failed)} robots: {failed}')
+        elif start:
+            positioners.all.start_trajectory()
+        return failed
+
+
+def trapezoid(travel, max_speed, max_accel):
+    '''Returns (duration, accel time) [s] of a trapezoidal (or triangular) profile over
+    travel distance [deg], with limits max_speed [deg/s] and max_accel [deg/s^2]. Works
+    on scalars or arrays.'''
+    travel = np.abs(np.asarray(travel, dtype=float))
+    triangular = travel <= max_speed**2 / max_accel
+    t_acc = np.where(triangular, np.sqrt(travel / max_accel), max_speed / max_accel)
+    duration = np.where(triangular, 2*t_acc, travel / max_speed + t_acc)
+    t_acc = np.where(travel > 0, t_acc, 0.)
+    return duration[()], t_acc[()]
+
+
+def trapezoid_position(t, duration, t_acc):
+    '''Fraction [0, 1] of a trapezoidal profile's travel completed at times t [s].
+    Arguments broadcast, so may be arrays.'''
+    duration = np.asarray(duration, dtype=float)
+    t = np.clip(t, 0., duration)
+    moving = duration > 0
+    v_peak = 1. / np.where(moving, duration - t_acc, 1.)
+    accel = v_peak / np.where(moving, t_acc, 1.)
+    s = np.where(t < t_acc, 0.5*accel*t**2,
+                 np.where(t <= duration - t_acc, 0.5*v_peak*t_acc + v_peak*(t - t_acc),
+                          1. - 0.5*accel*(duration - t)**2))
+    return np.where(moving, s, 1.)
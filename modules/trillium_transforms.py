@@ -35,6 +35,15 @@ COORDINATES:
                         offset with respect to a_arm, and b_gbl will be relative to the
                         global system, not relative to a_arm.
 
+    x_loc, y_loc    ... Units mm. Position of the fiber in the robot's local frame, with
+                        origin at the alpha axis and angles measured like a_arm. So:
+                            x_loc = LENGTH_A cos(a_arm) + LENGTH_B cos(a_arm + b_arm)
+                            y_loc = LENGTH_A sin(a_arm) + LENGTH_B sin(a_arm + b_arm)
+
+    x_gbl, y_gbl    ... Units mm. Position of the fiber in the global coordinate system,
+                        i.e. local position rotated by OFFSET_A and shifted by the robot's
+                        center (CENTER_X, CENTER_Y).
+
 PARAMETERS:
 
     GEARBOX_A,      ... Unitless floats. Ratios of motor shaft to output shaft for alpha
@@ -53,6 +62,12 @@ PARAMETERS:
 
     TEETH_3         ... Unitless int. Number of teeth on spur gear at bottom of beta arm shaft.
 
+    LENGTH_A,       ... Units mm. Kinematic lengths of alpha and beta arms, i.e. from alpha
+    LENGTH_B            axis to beta axis, and from beta axis to fiber.
+
+    CENTER_X,       ... Units mm. Position of robot's alpha axis in the global coordinate system.
+    CENTER_Y
+
     OFFSET_A        ... Units deg. Angular zero-point of alpha axis within global coordinate
                         system. By convention, we define: a_gbl = a_arm + OFFSET_A
     
@@ -66,7 +81,31 @@ PARAMETERS:
                         to them.) In practice we may distinguish between physical limits and
                         software limits, which are typically set a few deg inward of the actual
                         hard stops, to allow some margin for error.
+
+CALIBRATED ERRORS:
+
+    The transforms above are ideal by default. Measured periodic errors and backlash of
+    a gear stage may be argued as a PeriodicMap (see below), to errmap of mot2box and
+    box2mot (gearbox output error vs gearbox output angle), and to idler_map of box2arm
+    and arm2box (error of the idler stage, in b_box units, vs b_box). The forward
+    direction adds the error to the ideal angle, and the inverse direction solves for
+    the command which yields the desired angle. So folding the calibration into a blind
+    move is just a matter of arguing the maps when computing the commanded angles.
+
+    Backlash depends on the direction of motion, so these functions also take an
+    argument direction (+1, -1, or 0 if unknown, per robot if an array). Moving in the
+    positive direction, the output lags the ideal by half the backlash, and vice versa.
+
+ARRAYS:
+
+    All functions accept either scalars or numpy arrays (or lists) of angles, and
+    follow numpy broadcasting. So a whole fleet may be transformed in one call, with
+    angles of shape (N,) for N robots, or a trajectory with shape (T, N) for T time
+    samples of N robots. Per-robot parameters may likewise be arrays: gearbox_ratio,
+    offset_a, arm lengths and centers of shape (N,), idler as [ratio0, ratio1] with each of shape (N,), and limits
+    as [lower, upper] with each of shape (N,). Scalar inputs give scalar outputs.
 '''
+import numpy as np
 
 # For the Trillium2 and Trillium3 designs. Trillium1 had TEETH_1 = 10.
 nom_teeth = [10, 15, 10, 10]  # See comments above. These correspond to [TEETH_0, TEETH_1, TEETH_2, TEETH_3]
@@ -78,70 +117,234 @@ nom_limits_a = [-179.999, 180.]  # See comments above. These correspond to [LIMI
 nom_limits_b = [0., 180.]  # See comments above. These correspond to [LIMIT_B0, LIMIT_B1], and apply to b_arm coordinates.
 
 
-def mot2box(mot, gearbox_ratio):
+def mot2box(mot, gearbox_ratio, errmap=None, direction=0):
      '''Converts from motor field angle to gearbox output shaft angle, with idealized
      assumptions that (1) the motor shaft tracks the magnetic field 1:1, and (2) zero
-     mechanical backlash error in the gearbox.
+     mechanical backlash error in the gearbox. Unless a calibrated errmap (PeriodicMap)
+     is argued, in which case the error and backlash of the gearbox are included.
      '''
-     return mot / gearbox_ratio
+     box = np.asarray(mot, dtype=float) / gearbox_ratio
+     if errmap is not None:
+         box = errmap.forward(box, direction)
+     return box
 
-def box2mot(box, gearbox_ratio):
+def box2mot(box, gearbox_ratio, errmap=None, direction=0):
     '''Converts from gearbox output shaft angle to motor field angle, with idealized
      assumptions that (1) the motor shaft tracks the magnetic field 1:1, and (2) zero
-     mechanical backlash error in the gearbox.
+     mechanical backlash error in the gearbox. Unless a calibrated errmap (PeriodicMap)
+     is argued, in which case the returned motor angle compensates for the error and
+     backlash of the gearbox.
      '''
+    box = np.asarray(box, dtype=float)
+    if errmap is not None:
+        box = errmap.inverse(box, direction)
     return box * gearbox_ratio
 
-def box2arm(a_box, b_box, limits_a=nom_limits_a, limits_b=nom_limits_b, idler=nom_idler):
+def box2arm(a_box, b_box, limits_a=nom_limits_a, limits_b=nom_limits_b, idler=nom_idler, idler_map=None, direction_b=0):
     '''Converts from alpha and beta gearmotors' output shaft angles to the observable
     angles of their kinematic arms. Limit-checking can be skipped with an argument
     like None, empty container, or False. The return tuple has:
         a_arm, b_arm, contacts
     where contacts is a dictionary describing what if any hardstop contacts may have occurred.
+    Its values are booleans, or boolean arrays of the same shape as the angles.
+    Calibrated errors of the idler stage may be included by arguing idler_map (PeriodicMap).
     '''
-    a_arm = a_box
+    a_arm = np.asarray(a_box, dtype=float)[()]
+    b_box = np.asarray(b_box, dtype=float)[()]
+    if idler_map is not None:
+        b_box = idler_map.forward(b_box, direction_b)
     a_arm_limited = _apply_limits(a_arm, limits_a)  # ensure alpha limit will affect beta calculation 
     b_arm = a_arm_limited*idler[1] + b_box*(idler[0]*idler[1])
     b_arm_limited = _apply_limits(b_arm, limits_b)
-    a_arm_limited_by_beta = (b_arm_limited - b_box*(idler[0]*idler[1])) / idler[1]
+    beta_contact = b_arm_limited != b_arm
+    a_arm_limited_by_beta = np.where(beta_contact, (b_arm_limited - b_box*(idler[0]*idler[1])) / idler[1], a_arm_limited)[()]
     contacts = {
         'alpha hardstop contact': a_arm_limited != a_arm,
-        'beta hardstop contact': b_arm_limited != b_arm,
+        'beta hardstop contact': beta_contact,
         'alpha limited by beta contact': a_arm_limited_by_beta != a_arm_limited,
     }
     return a_arm_limited_by_beta, b_arm_limited, contacts
 
-def arm2box(a_arm, b_arm, idler=nom_idler):
+def arm2box(a_arm, b_arm, idler=nom_idler, idler_map=None, direction_b=0):
     '''Converts from the observable angles of the alpha and beta gearmotors' kinematic
-    arms to their output shaft angles.
+    arms to their output shaft angles. Calibrated errors of the idler stage may be
+    compensated by arguing idler_map (PeriodicMap).
     '''
+    a_arm = np.asarray(a_arm, dtype=float)[()]
     a_box = a_arm
-    b_box = (b_arm - a_arm*idler[1]) / (idler[0]*idler[1])
+    b_box = (np.asarray(b_arm, dtype=float) - a_arm*idler[1]) / (idler[0]*idler[1])
+    if idler_map is not None:
+        b_box = idler_map.inverse(b_box, direction_b)
     return a_box, b_box
 
 def arm2gbl(a_arm, b_arm, offset_a):
     '''Converts from alpha and beta arm angles to angles in a global coordinate system.
     '''
-    a_gbl = a_arm + offset_a
+    a_gbl = np.asarray(a_arm, dtype=float) + offset_a
     b_gbl = b_arm + a_gbl 
     return a_gbl, b_gbl
 
 def gbl2arm(a_gbl, b_gbl, offset_a):
     '''Converts from global angular coordinates to arm angles.
     '''
+    a_gbl = np.asarray(a_gbl, dtype=float)[()]
     a_arm = a_gbl - offset_a
     b_arm = b_gbl - a_gbl
     return a_arm, b_arm
 
+def arm2xyloc(a_arm, b_arm, length_a, length_b):
+    '''Forward kinematics, from arm angles to fiber position in the robot's local frame.
+    '''
+    a_rad = np.radians(a_arm)
+    ab_rad = np.radians(np.add(a_arm, b_arm))
+    x_loc = length_a*np.cos(a_rad) + length_b*np.cos(ab_rad)
+    y_loc = length_a*np.sin(a_rad) + length_b*np.sin(ab_rad)
+    return x_loc, y_loc
+
+def xyloc2arm(x_loc, y_loc, length_a, length_b, limits_a=nom_limits_a, limits_b=nom_limits_b):
+    '''Inverse kinematics, from fiber position in the robot's local frame to arm angles.
+    The return tuple has:
+        a_arm, b_arm, reachable
+    each with a leading axis of length 2 for the two elbow solutions: index 0 with
+    b_arm in [0, 180], index 1 with b_arm in [-180, 0] (before wrapping into limits).
+    Angles are wrapped by multiples of 360 into the travel limits where possible.
+    Reachable is a boolean array, False where the target is out of the arms' annulus
+    (in which case the angles are nan) or where the solution is outside the limits.
+    Limit-checking can be skipped with an argument like None, empty container, or False.
+    '''
+    x_loc = np.asarray(x_loc, dtype=float)
+    y_loc = np.asarray(y_loc, dtype=float)
+    cos_b = (x_loc**2 + y_loc**2 - np.square(length_a) - np.square(length_b)) / (2*np.multiply(length_a, length_b))
+    in_annulus = np.abs(cos_b) <= 1 + _tol
+    b_rad = np.arccos(np.clip(cos_b, -1, 1))
+    b_rad = np.where(in_annulus, b_rad, np.nan)
+    b_rad = np.stack([b_rad, -b_rad])
+    a_rad = np.arctan2(y_loc, x_loc) - np.arctan2(length_b*np.sin(b_rad), length_a + length_b*np.cos(b_rad))
+    a_arm = _wrap_to_limits(np.degrees(a_rad), limits_a)
+    b_arm = _wrap_to_limits(np.degrees(b_rad), limits_b)
+    reachable = in_annulus & _within_limits(a_arm, limits_a) & _within_limits(b_arm, limits_b)
+    return a_arm, b_arm, reachable
+
+def arm2xygbl(a_arm, b_arm, length_a, length_b, offset_a, center_x=0., center_y=0.):
+    '''Forward kinematics, from arm angles to fiber position in the global coordinate system.
+    '''
+    a_gbl, b_gbl = arm2gbl(a_arm, b_arm, offset_a)
+    x_gbl = center_x + length_a*np.cos(np.radians(a_gbl)) + length_b*np.cos(np.radians(b_gbl))
+    y_gbl = center_y + length_a*np.sin(np.radians(a_gbl)) + length_b*np.sin(np.radians(b_gbl))
+    return x_gbl, y_gbl
+
+def xygbl2arm(x_gbl, y_gbl, length_a, length_b, offset_a, center_x=0., center_y=0.,
+              limits_a=nom_limits_a, limits_b=nom_limits_b):
+    '''Inverse kinematics, from fiber position in the global coordinate system to arm
+    angles. Returns the same tuple as xyloc2arm, i.e. both elbow solutions.
+    '''
+    dx = np.subtract(x_gbl, center_x)
+    dy = np.subtract(y_gbl, center_y)
+    rot = np.radians(offset_a)
+    x_loc = dx*np.cos(rot) + dy*np.sin(rot)
+    y_loc = -dx*np.sin(rot) + dy*np.cos(rot)
+    return xyloc2arm(x_loc, y_loc, length_a, length_b, limits_a, limits_b)
+
+_tol = 1e-9  # numerical tolerance for limit and reach checks
+
+def _has_limits(limits):
+    return not (limits is None or limits is False or np.size(limits) == 0)
+
+def _wrap_to_limits(angle, limits):
+    '''Returns angle shifted by a multiple of 360 deg to be at or just above the lower
+    limit, so that it lands within limits whenever any equivalent angle does.'''
+    if not _has_limits(limits):
+        return angle
+    lower = np.min(np.asarray(limits, dtype=float), axis=0)
+    return lower - _tol + np.mod(angle - lower + _tol, 360.)
+
+def _within_limits(value, limits):
+    if not _has_limits(limits):
+        return np.ones(np.shape(value), dtype=bool)
+    limits = np.asarray(limits, dtype=float)
+    return (value >= np.min(limits, axis=0) - _tol) & (value <= np.max(limits, axis=0) + _tol)
+
 def _apply_limits(value, limits):
     '''Returns the argued value, bounded by the min and max of container limits.
     Application of limits may be skipped (always returning value unmodified) by
-    arguing None, empty container, or False, etc.
+    arguing None, empty container, or False, etc. Per-robot limits may be argued
+    as [lower, upper] with each an array.
+    '''
+    if not _has_limits(limits):
+        return value
+    limits = np.asarray(limits, dtype=float)
+    return np.clip(value, np.min(limits, axis=0), np.max(limits, axis=0))
+
+class PeriodicMap:
+    '''Calibrated error of a gear stage, periodic in its input angle, plus backlash.
+
+    INPUTS:
+        values ... Units deg. Error of the stage's output at K angles uniformly spaced over
+                   one period, starting at 0. Shape (K,) for one robot, or (N, K) for N
+                   robots, in which case angles passed to the methods must have a last
+                   axis of length N.
+        period ... Units deg. Period of the error, in input angle. E.g. 360 for once per
+                   output revolution, or 360 / n for a gear with n teeth.
+        backlash ... Units deg. Total backlash (dead band) of the stage. Scalar or shape (N,).
+
+    The error between samples is linearly interpolated, wrapping around the period.
     '''
-    if limits:
-        value = min(value, max(limits))
-        value = max(value, min(limits))
-    return value
+    def __init__(self, values, period=360., backlash=0.):
+        self.values = np.asarray(values, dtype=float)
+        self.period = float(period)
+        self.backlash = np.asarray(backlash, dtype=float)
+
+    def error(self, angle, direction=0):
+        '''Returns the error [deg] at angle, including backlash for direction of motion.'''
+        angle = np.asarray(angle, dtype=float)
+        k = self.values.shape[-1]
+        u = np.mod(angle, self.period) * (k / self.period)
+        i0 = np.floor(u).astype(int) % k
+        i1 = (i0 + 1) % k
+        frac = u - np.floor(u)
+        if self.values.ndim == 1:
+            v0, v1 = self.values[i0], self.values[i1]
+        else:
+            rows = np.broadcast_to(np.arange(self.values.shape[0]), i0.shape)
+            v0, v1 = self.values[rows, i0], self.values[rows, i1]
+        return v0 + (v1 - v0)*frac - np.sign(direction)*self.backlash/2
+
+    def forward(self, angle, direction=0):
+        '''Returns the actual angle, for an ideal angle.'''
+        return (np.asarray(angle, dtype=float) + self.error(angle, direction))[()]
+
+    def inverse(self, angle, direction=0, iterations=5):
+        '''Returns the ideal angle which yields the actual angle. Solved by fixed-point
+        iteration, which converges for any error map with slope well below 1.'''
+        angle = np.asarray(angle, dtype=float)
+        ideal = angle
+        for i in range(iterations):
+            ideal = angle - self.error(ideal, direction)
+        return ideal[()]
+
+    @classmethod
+    def fit(cls, angles, errors, nbins, period=360., backlash=0.):
+        '''Makes a single-robot map by averaging measured errors [deg] at angles [deg]
+        into nbins bins over the period. Empty bins are interpolated from their neighbors.
+        Multi-robot maps can then be made by stacking the values of several.'''
+        phase = np.mod(np.asarray(angles, dtype=float), period) * (nbins / period)
+        bins = np.round(phase).astype(int) % nbins
+        counts = np.bincount(bins, minlength=nbins)
+        sums = np.bincount(bins, weights=np.asarray(errors, dtype=float), minlength=nbins)
+        filled = counts > 0
+        centers = np.arange(nbins)
+        values = np.interp(centers, centers[filled], sums[filled] / counts[filled], period=nbins)
+        return cls(values, period, backlash)
+
+    def save(self, path):
+        '''Saves to a compressed numpy file.'''
+        np.savez_compressed(path, values=self.values, period=self.period, backlash=self.backlash)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['values'], float(data['period']), data['backlash'])
+
 
 if __name__ == '__main__':
 
@@ -160,3 +363,33 @@ if __name__ == '__main__':
         inversion_text = 'SUCCESS' if inversion_succeeded else 'FAILED'
         txt += f' ... inverse transform --> (a_arm\', b_arm\') = ({a_arm2:6.1f}, {b_arm2:6.1f}) [{inversion_text}]'
         print(txt)
+
+    # same transformations, on the whole set of angles at once
+    print('\n---------\n')
+    a_box, b_box = arm2box(a_arm, b_arm)
+    a_arm2, b_arm2, contacts = box2arm(a_box, b_box)
+    inversion_succeeded = np.all(np.abs(a_arm2 - a_arm) < tol) and np.all(np.abs(b_arm2 - b_arm) < tol)
+    print(f'array transform of {len(a_arm)} points: {"SUCCESS" if inversion_succeeded else "FAILED"}')
+    print(f'beta hardstop contacts: {contacts["beta hardstop contact"]}')
+
+    # forward and inverse xy kinematics, on the same set of angles
+    print('\n---------\n')
+    length_a, length_b = 1.0, 1.1
+    x_loc, y_loc = arm2xyloc(a_arm, b_arm, length_a, length_b)
+    a_arm3, b_arm3, reachable = xyloc2arm(x_loc, y_loc, length_a, length_b)
+    x_loc3, y_loc3 = arm2xyloc(a_arm3, b_arm3, length_a, length_b)
+    roundtrip = np.hypot(x_loc3 - x_loc, y_loc3 - y_loc) < tol
+    print(f'xy inverse kinematics of {len(a_arm)} points:')
+    print(f'  elbow solution 0: reachable {reachable[0].sum()}, xy round trip {"SUCCESS" if np.all(roundtrip[0]) else "FAILED"}')
+    print(f'  elbow solution 1: reachable {reachable[1].sum()}')
+
+    # blind move with a calibrated gearbox error map: compensate when commanding, then
+    # check that the simulated actual output lands on target
+    print('\n---------\n')
+    ratio = 337.
+    errmap = PeriodicMap(0.3*np.sin(np.radians(np.arange(0., 360., 10.))), period=360., backlash=0.2)
+    target_box = np.array(a_arm, dtype=float)
+    mot = box2mot(target_box, ratio, errmap=errmap, direction=1)
+    actual_box = mot2box(mot, ratio, errmap=errmap, direction=1)
+    print(f'calibrated blind move, max error: {np.max(np.abs(actual_box - target_box)):.2e} deg'
+          f' (vs {np.max(np.abs(mot2box(box2mot(target_box, ratio), ratio, errmap=errmap, direction=1) - target_box)):.2f} deg uncompensated)')
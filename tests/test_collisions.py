@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+'''Minimum distance between line segments, including degenerate (zero-length) ones.'''
+import os
+import sys
+import numpy as np
+this_file_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.join(this_file_dir, '../modules'))
+from collisions import segment_distance
+
+
+def distance(p1, q1, p2, q2):
+    return float(segment_distance(*[np.array(p, dtype=float) for p in (p1, q1, p2, q2)]))
+
+
+def test_crossing():
+    assert np.isclose(distance([0, 0], [2, 2], [0, 2], [2, 0]), 0.)
+
+
+def test_parallel():
+    assert np.isclose(distance([0, 0], [2, 0], [1, 1], [3, 1]), 1.)
+
+
+def test_zero_length_second_segment():
+    # point above the middle of segment 1, not nearest its start p1
+    assert np.isclose(distance([0, 0], [4, 0], [2, 3], [2, 3]), 3.)
+    assert np.isclose(distance([0, 0], [4, 0], [6, 0], [6, 0]), 2.)
+
+
+def test_zero_length_first_segment():
+    assert np.isclose(distance([2, 3], [2, 3], [0, 0], [4, 0]), 3.)
+
+
+def test_both_zero_length():
+    assert np.isclose(distance([0, 0], [0, 0], [3, 4], [3, 4]), 5.)
+
+
+def test_vectorized():
+    p1, q1 = np.array([[0., 0.], [0., 0.]]), np.array([[4., 0.], [4., 0.]])
+    p2, q2 = np.array([[2., 3.], [1., 1.]]), np.array([[2., 3.], [3., 1.]])
+    assert np.allclose(segment_distance(p1, q1, p2, q2), [3., 1.])
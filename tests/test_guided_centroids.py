@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+'''Guided centroiding of two close spots of unequal brightness: each guess must find its
+own spot, rather than both locking onto the brighter one.'''
+import os
+import sys
+import numpy as np
+import pytest
+this_file_dir = os.path.realpath(os.path.dirname(__file__))
+sys.path.append(os.path.join(this_file_dir, '../modules'))
+sys.path.append(os.path.join(this_file_dir, '../modules/camera'))
+sys.path.append(os.path.join(this_file_dir, '../modules/camera/SBIG'))
+import multicens
+import centroiders
+
+size_fitbox = 4
+spots = np.array([[100.3, 120.6], [108.8, 121.2], [60.2, 40.7]])  # [x,y] px, first two within 2 * size_fitbox
+brightness = np.array([20000., 4000., 10000.])
+
+
+def render(shape=(200, 240), sigma=1.5, seed=0):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.indices(shape)
+    img = rng.normal(0, 10, shape)
+    for (x, y), peak in zip(spots, brightness):
+        img += peak * np.exp(-((cols - x)**2 + (rows - y)**2) / (2 * sigma**2))
+    return np.rint(img).astype(np.int32)
+
+
+def guesses():
+    return (spots + [[1.5, -1.0], [-1.2, 1.4], [0.8, 0.9]]).tolist()
+
+
+def test_local_cens_close_pair():
+    xcen, ycen, peaks, fwhms, found = multicens.localCens(render(), guesses(), size_fitbox, parallel=False)
+    assert all(found)
+    assert np.allclose(np.column_stack([xcen, ycen]), spots, atol=0.3)
+
+
+def test_local_cens_shared_peak():
+    # both guesses nearest the bright spot: only the nearer one keeps it
+    xy_guess = [spots[0] + [1.0, 0.5], spots[0] + [3.0, 0.5]]
+    found = multicens.localCens(render(), xy_guess, size_fitbox, parallel=False)[4]
+    assert found == [True, False]
+
+
+def test_guided_cens_close_pair():
+    xcen, ycen = multicens.guidedCens(render(), guesses(), write_fits=False, size_fitbox=size_fitbox, parallel=False)[:2]
+    assert len(xcen) == len(spots)
+    assert np.allclose(np.column_stack([xcen, ycen]), spots, atol=0.3)
+
+
+def test_guided_cens_shared_peak_falls_back():
+    # the second guess is nearer the bright spot than its own, so loses it to the first,
+    # and its spot is found by full-frame detection instead
+    xy_guess = [spots[0] + [1.0, 0.5], spots[0] + [3.0, 0.5], spots[2]]
+    xcen, ycen = multicens.guidedCens(render(), xy_guess, write_fits=False, size_fitbox=size_fitbox, parallel=False)[:2]
+    assert len(xcen) == len(spots)
+    assert np.allclose(np.column_stack([xcen, ycen]), spots[[0, 2, 1]], atol=0.3)  # fallback spots come last
+
+
+def test_find_near_close_pair():
+    px, py, found = centroiders.find_near(render(), guesses(), size_fitbox, 2 * size_fitbox)
+    assert found.all()
+    assert np.abs(np.column_stack([px, py]) - spots).max() <= 1
+
+
+def test_find_near_shared_peak():
+    xy_guess = [spots[0] + [1.0, 0.5], spots[0] + [3.0, 0.5]]
+    found = centroiders.find_near(render(), xy_guess, size_fitbox, 2 * size_fitbox)[2]
+    assert found.tolist() == [True, False]
+
+
+@pytest.mark.parametrize('name', sorted(centroiders.registry))
+def test_centroiders_close_pair(name):
+    cen = centroiders.get(name, size_fitbox=size_fitbox, parallel=False)
+    xcen, ycen = cen.centroid(render(), len(spots), guesses())[:2]
+    assert len(xcen) == len(spots)
+    assert np.abs(np.column_stack([xcen, ycen]) - spots).max() < 1